@@ -0,0 +1,31 @@
+"""
+    mqlalchemy.benchmarks
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Performance benchmarks for MQLAlchemy, run against the Chinook
+    database and models used by the tests.
+
+"""
+# :copyright: (c) 2016-2025 by Nicholas Repole and contributors.
+#             See AUTHORS for more details.
+# :license: MIT - See LICENSE for more details.
+import os
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker, configure_mappers
+
+# Makes sure backref relationship attrs are attached to models.
+configure_mappers()
+
+
+def create_db_session():
+    """Create a session for the Chinook database used by the tests.
+
+    :return: A SQLAlchemy session, whose bind should be disposed of
+        when finished.
+
+    """
+    connect_string = "sqlite+pysqlite:///" + os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        "tests", "chinook.sqlite")
+    db_engine = create_engine(connect_string)
+    return sessionmaker(bind=db_engine)()
@@ -0,0 +1,96 @@
+"""
+    mqlalchemy.benchmarks.in_strategies
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Compare strategies for large ``$in`` lists on the Chinook database.
+
+    Run with ``python -m benchmarks.in_strategies``.
+
+"""
+# :copyright: (c) 2016-2025 by Nicholas Repole and contributors.
+#             See AUTHORS for more details.
+# :license: MIT - See LICENSE for more details.
+import argparse
+import random
+import timeit
+from sqlalchemy.exc import OperationalError
+from benchmarks import create_db_session
+from mqlalchemy import MqlBuilder
+from tests.models import Track
+
+
+class ExpandingMqlBuilder(MqlBuilder):
+
+    """Always uses a regular, expanding ``IN`` clause."""
+
+    large_in_threshold = None
+
+
+class JsonEachMqlBuilder(MqlBuilder):
+
+    """Always uses a single JSON parameter with ``json_each``."""
+
+    large_in_threshold = 0
+    large_in_strategy = "json_each"
+
+
+# The "array" strategy requires PostgreSQL and isn't included.
+STRATEGIES = {
+    "expanding": ExpandingMqlBuilder,
+    "json_each": JsonEachMqlBuilder
+}
+
+
+def run(db_session, builder, size, repeat):
+    """Time filtering tracks by an ``$in`` list of ``size`` ids.
+
+    :param db_session: SQLAlchemy session for the Chinook database.
+    :param builder: :class:`~mqlalchemy.MqlBuilder` class to use.
+    :param int size: Number of values in the ``$in`` list.
+    :param int repeat: Number of times to run the query.
+    :return: Best time in seconds for a single build and execute, or
+        ``None`` if the database rejected the query.
+
+    """
+    rng = random.Random(size)
+    filters = {"track_id": {"$in": [
+        rng.randint(1, 5000) for i in range(size)]}}
+
+    def query():
+        stmt = builder.apply_mql_filters(model_class=Track, filters=filters)
+        return db_session.execute(stmt).scalars().all()
+
+    try:
+        query()
+    except OperationalError:
+        # e.g. too many SQL variables
+        db_session.rollback()
+        return None
+    return min(timeit.repeat(query, number=1, repeat=repeat))
+
+
+def main(argv=None):
+    """Run the benchmark and print a table of results."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[100, 1000, 10000, 50000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args(argv)
+    db_session = create_db_session()
+    print("%-10s" % "size" + "".join(
+        "%14s" % name for name in STRATEGIES))
+    for size in args.sizes:
+        row = "%-10d" % size
+        for builder in STRATEGIES.values():
+            result = run(db_session, builder, size, args.repeat)
+            if result is None:
+                row += "%14s" % "failed"
+            else:
+                row += "%12.2fms" % (result * 1000)
+        print(row)
+    db_session.close()
+    db_session.bind.dispose()
+
+
+if __name__ == "__main__":    # pragma no cover
+    main()
@@ -0,0 +1,86 @@
+"""
+    mqlalchemy.benchmarks.relation_strategies
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Compare relation strategies for filtering on the Chinook database.
+
+    Run with ``python -m benchmarks.relation_strategies``.
+
+"""
+# :copyright: (c) 2016-2025 by Nicholas Repole and contributors.
+#             See AUTHORS for more details.
+# :license: MIT - See LICENSE for more details.
+import argparse
+import timeit
+from benchmarks import create_db_session
+from mqlalchemy import MqlBuilder
+from tests.models import Album, InvoiceLine, Track
+
+
+STRATEGIES = ("exists", "join", "semi_join_in")
+
+# name: (model_class, filters)
+CASES = {
+    "many_to_one": (
+        Track, {"album.artist.name": "Iron Maiden"}),
+    "many_to_one_deep": (
+        InvoiceLine, {
+            "track.album.artist.name": "Iron Maiden",
+            "invoice.customer.country": "USA"}),
+    "one_to_many": (
+        Album, {"tracks.milliseconds": {"$gt": 600000}}),
+    "many_to_many": (
+        Track, {"playlists.name": "Grunge"}),
+    "negated": (
+        Track, {"$not": {"album.artist.name": "Iron Maiden"}})
+}
+
+
+def run(db_session, model_class, filters, relation_strategy, repeat):
+    """Time filtering by relationships using a relation strategy.
+
+    :param db_session: SQLAlchemy session for the Chinook database.
+    :param model_class: SQLAlchemy model class to query.
+    :param dict filters: MQL filters to apply.
+    :param str relation_strategy: Strategy to pass to
+        :meth:`~mqlalchemy.MqlBuilder.apply_mql_filters`.
+    :param int repeat: Number of times to run the query.
+    :return: Best time in seconds for a single build and execute.
+
+    """
+    def query():
+        stmt = MqlBuilder.apply_mql_filters(
+            model_class=model_class,
+            filters=filters,
+            relation_strategy=relation_strategy)
+        return db_session.execute(stmt).scalars().all()
+
+    query()
+    return min(timeit.repeat(query, number=1, repeat=repeat))
+
+
+def main(argv=None):
+    """Run the benchmark and print a table of results."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--cases", nargs="+", choices=list(CASES), default=list(CASES))
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args(argv)
+    db_session = create_db_session()
+    print("%-18s" % "case" + "".join(
+        "%14s" % name for name in STRATEGIES))
+    for name in args.cases:
+        model_class, filters = CASES[name]
+        row = "%-18s" % name
+        for relation_strategy in STRATEGIES:
+            result = run(
+                db_session, model_class, filters, relation_strategy,
+                args.repeat)
+            row += "%12.2fms" % (result * 1000)
+        print(row)
+    db_session.close()
+    db_session.bind.dispose()
+
+
+if __name__ == "__main__":    # pragma no cover
+    main()
@@ -0,0 +1,248 @@
+"""
+    mqlalchemy.benchmarks.suite
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Benchmarks for parsing filters and running the resulting queries
+    against the Chinook database.
+
+    Run with ``python -m benchmarks.suite``. Results can be saved as
+    JSON with ``--json results.json``, and compared against previously
+    saved results with ``--compare baseline.json``, which exits with a
+    non zero status if any benchmark got slower than ``--threshold``.
+
+"""
+# :copyright: (c) 2016-2025 by Nicholas Repole and contributors.
+#             See AUTHORS for more details.
+# :license: MIT - See LICENSE for more details.
+import argparse
+import gc
+import json
+import platform
+import statistics
+import sys
+import timeit
+import tracemalloc
+import sqlalchemy
+import mqlalchemy
+from benchmarks import create_db_session
+from mqlalchemy import MqlBuilder
+from tests.models import Album, Employee, Playlist, Track
+
+
+def _nested_filters(depth):
+    """Build filters alternating between ``$and``, ``$or``, ``$not``."""
+    filters = {"milliseconds": {"$gt": 1000}}
+    for i in range(depth):
+        if i % 3 == 0:
+            filters = {"$and": [filters, {"track_id": {"$ne": i}}]}
+        elif i % 3 == 1:
+            filters = {"$or": [filters, {"bytes": {"$lt": i}}]}
+        else:
+            filters = {"$not": filters}
+    return filters
+
+
+# name: (model_class, filters)
+PARSE_CASES = {
+    "flat": (Track, {
+        "name": "Balls to the Wall",
+        "milliseconds": {"$gt": 100000},
+        "bytes": {"$lte": 10000000},
+        "composer": {"$ne": None},
+        "unit_price": 0.99
+    }),
+    "deeply_nested": (Track, _nested_filters(30)),
+    "wide_or": (Track, {
+        "$or": [{"track_id": i} for i in range(200)]
+    }),
+    "large_in": (Track, {
+        "track_id": {"$in": list(range(10000))}
+    }),
+    "heavy_elem_match": (Album, {
+        "tracks": {"$elemMatch": {
+            "milliseconds": {"$gt": 100000},
+            "genre.name": {"$in": ["Rock", "Metal"]},
+            "playlists": {"$elemMatch": {
+                "name": {"$like": "Music"},
+                "tracks": {"$elemMatch": {"media_type.name": {
+                    "$ne": "Protected AAC audio file"}}}
+            }}
+        }},
+        "artist.name": {"$like": "a"},
+        "$or": [
+            {"tracks.composer": {"$like": "Steve"}},
+            {"tracks.unit_price": {"$gt": 0.99}}
+        ]
+    })
+}
+
+# name: (model_class, filters)
+EXECUTE_CASES = {
+    "execute_flat": (Track, {
+        "milliseconds": {"$gt": 300000},
+        "composer": {"$like": "Steve"}
+    }),
+    "execute_relation": (Album, {
+        "tracks.playlists.name": "Grunge"
+    }),
+    "execute_self_referential": (Employee, {
+        "manager.first_name": "Andrew"
+    }),
+    "execute_many_to_many": (Playlist, {
+        "tracks.album.artist.name": "AC/DC"
+    })
+}
+
+
+def measure(func, repeat, number):
+    """Time a function and measure the memory it allocates.
+
+    :param callable func: The function to benchmark.
+    :param int repeat: Number of timing samples to take.
+    :param int number: Number of calls per timing sample.
+    :return: A dict of results, with times in seconds per call. Memory
+        is measured for a single call, as the peak bytes allocated and
+        the number of memory blocks still allocated afterwards.
+
+    """
+    func()
+    samples = [
+        sample / number for sample in
+        timeit.repeat(func, repeat=repeat, number=number)]
+    gc.collect()
+    tracemalloc.start()
+    try:
+        snapshot_before = tracemalloc.take_snapshot()
+        func()
+        snapshot_after = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    stats = snapshot_after.compare_to(snapshot_before, "filename")
+    return {
+        "min": min(samples),
+        "median": statistics.median(samples),
+        "mean": statistics.mean(samples),
+        "ops_per_sec": 1 / min(samples),
+        "peak_bytes": peak,
+        "retained_blocks": sum(stat.count_diff for stat in stats)
+    }
+
+
+def run(names=None, repeat=5, number=None):
+    """Run the benchmarks.
+
+    :param names: Optional list of benchmark names to run, defaults to
+        all of them.
+    :param int repeat: Number of timing samples to take.
+    :param number: Number of calls per timing sample. If ``None``, a
+        number is picked per benchmark so each sample takes at least
+        roughly 0.1 seconds.
+    :return: A dict of results, suitable for saving as JSON.
+
+    """
+    db_session = create_db_session()
+    results = {}
+    benchmarks = {}
+    for name, (model_class, filters) in PARSE_CASES.items():
+        benchmarks["parse_" + name] = (
+            lambda model_class=model_class, filters=filters:
+            MqlBuilder.parse_mql_filters(model_class, filters))
+    for name, (model_class, filters) in EXECUTE_CASES.items():
+        benchmarks[name] = (
+            lambda model_class=model_class, filters=filters:
+            db_session.execute(MqlBuilder.apply_mql_filters(
+                model_class, filters=filters)).scalars().all())
+    try:
+        for name, func in benchmarks.items():
+            if names and name not in names:
+                continue
+            if number is None:
+                calls, _ = timeit.Timer(func).autorange()
+                calls = max(1, calls // 2)
+            else:
+                calls = number
+            results[name] = measure(func, repeat, calls)
+            results[name]["number"] = calls
+    finally:
+        db_session.close()
+        db_session.bind.dispose()
+    return {
+        "meta": {
+            "mqlalchemy": mqlalchemy.__version__,
+            "sqlalchemy": sqlalchemy.__version__,
+            "python": platform.python_version(),
+            "platform": platform.platform()
+        },
+        "results": results
+    }
+
+
+def compare(baseline, current, threshold):
+    """Compare results against a baseline.
+
+    Benchmarks are compared by their minimum time, which is the least
+    affected by noise from other processes.
+
+    :param dict baseline: Previously saved results from :func:`run`.
+    :param dict current: New results from :func:`run`.
+    :param float threshold: Fraction a benchmark may slow down by
+        before it's considered a regression, e.g. ``0.1`` for 10%.
+    :return: A list of ``(name, baseline_min, current_min, ratio,
+        regressed)`` tuples, for benchmarks found in both.
+
+    """
+    comparisons = []
+    for name, result in current["results"].items():
+        base_result = baseline["results"].get(name)
+        if base_result is None:
+            continue
+        ratio = result["min"] / base_result["min"]
+        comparisons.append((
+            name, base_result["min"], result["min"], ratio,
+            ratio > 1 + threshold))
+    return comparisons
+
+
+def main(argv=None):
+    """Run the benchmarks and print, save, or compare the results.
+
+    :return: Exit status, ``1`` if a regression was found.
+
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--only", nargs="+", help="Benchmarks to run.")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--number", type=int, default=None)
+    parser.add_argument("--json", help="Save results to this file.")
+    parser.add_argument("--compare", help="Compare with a results file.")
+    parser.add_argument("--threshold", type=float, default=0.1)
+    args = parser.parse_args(argv)
+    results = run(names=args.only, repeat=args.repeat, number=args.number)
+    if args.json:
+        with open(args.json, "w") as results_file:
+            json.dump(results, results_file, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        comparisons = compare(baseline, results, args.threshold)
+        print("%-28s%14s%14s%10s" % ("benchmark", "baseline", "current",
+                                     "ratio"))
+        for name, base_min, current_min, ratio, regressed in comparisons:
+            print("%-28s%12.3fms%12.3fms%9.2fx%s" % (
+                name, base_min * 1000, current_min * 1000, ratio,
+                "  REGRESSED" if regressed else ""))
+        if any(comparison[-1] for comparison in comparisons):
+            return 1
+        return 0
+    print("%-28s%14s%14s%14s%14s" % (
+        "benchmark", "min", "median", "ops/sec", "peak memory"))
+    for name, result in results["results"].items():
+        print("%-28s%12.3fms%12.3fms%14.1f%12.1fKB" % (
+            name, result["min"] * 1000, result["median"] * 1000,
+            result["ops_per_sec"], result["peak_bytes"] / 1024))
+    return 0
+
+
+if __name__ == "__main__":    # pragma no cover
+    sys.exit(main())
@@ -0,0 +1,379 @@
+"""
+    mqlalchemy.benchmarks.synthetic
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Synthetic schemas and filters for testing how parsing scales.
+
+    :func:`build_schema` creates declarative models in layers, with
+    each model having one to many relationships to models in the next
+    layer, and many to one backrefs to the previous. :func:`generate_filters`
+    creates random, valid filters over those models.
+
+    Run with ``python -m benchmarks.synthetic`` to time
+    ``parse_mql_filters`` against filter size and schema depth, and
+    report any that grow faster than linearly.
+
+"""
+# :copyright: (c) 2016-2025 by Nicholas Repole and contributors.
+#             See AUTHORS for more details.
+# :license: MIT - See LICENSE for more details.
+import argparse
+import json
+import math
+import random
+import sys
+import timeit
+from sqlalchemy import (
+    Boolean, Column, Date, DateTime, Float, ForeignKey, Integer, Unicode)
+from sqlalchemy.orm import configure_mappers, declarative_base, relationship
+from mqlalchemy import MqlBuilder
+
+# column name prefix: SQLAlchemy type
+COLUMN_TYPES = {
+    "int": Integer,
+    "text": Unicode(100),
+    "float": Float,
+    "flag": Boolean,
+    "created": DateTime,
+    "day": Date
+}
+
+# Operators that may be used for each column name prefix.
+COLUMN_OPS = {
+    "int": ["$eq", "$ne", "$lt", "$lte", "$gt", "$gte", "$in", "$nin",
+            "$mod", "$exists"],
+    "text": ["$eq", "$ne", "$like", "$in", "$nin", "$exists"],
+    "float": ["$eq", "$ne", "$lt", "$lte", "$gt", "$gte", "$exists"],
+    "flag": ["$eq", "$ne", "$exists"],
+    "created": ["$eq", "$lt", "$gt", "$exists"],
+    "day": ["$eq", "$lt", "$gt", "$exists"]
+}
+
+
+class SyntheticSchema(object):
+
+    """A set of generated models, see :func:`build_schema`."""
+
+    def __init__(self, base, layers, columns):
+        """Initializes a new schema.
+
+        :param base: The declarative base the models were built with.
+        :param list layers: Lists of model classes, one per layer.
+        :param dict columns: Column names keyed by model class.
+
+        """
+        self.base = base
+        self.layers = layers
+        self.columns = columns
+        #: Relationship names for each model class, mapped to their
+        #: target model class.
+        self.relationships = {}
+        for layer in layers:
+            for model_class in layer:
+                self.relationships[model_class] = {}
+        for layer in layers:
+            for model_class in layer:
+                for prop in model_class.__mapper__.relationships:
+                    self.relationships[model_class][prop.key] = (
+                        prop.mapper.class_)
+
+    @property
+    def root(self):
+        """The first model of the first layer."""
+        return self.layers[0][0]
+
+    @property
+    def models(self):
+        """All of the model classes in the schema."""
+        return [model_class for layer in self.layers
+                for model_class in layer]
+
+
+def build_schema(width=10, depth=3, fanout=2, columns=6, seed=0):
+    """Build a set of synthetic declarative models.
+
+    Models are built in ``depth`` layers of ``width`` models, for a
+    total of ``width * depth`` mapped classes. Each model has a one to
+    many relationship to ``fanout`` models in the next layer, each with
+    a many to one backref.
+
+    :param int width: Number of models per layer.
+    :param int depth: Number of layers.
+    :param int fanout: Number of relationships from each model to
+        models in the next layer.
+    :param int columns: Number of non key columns per model, cycling
+        through the types in :data:`COLUMN_TYPES`.
+    :param int seed: Seed for picking which models are related.
+    :return: The generated schema.
+    :rtype: :class:`SyntheticSchema`
+
+    """
+    rng = random.Random(seed)
+    base = declarative_base()
+    names = [["Model%d_%d" % (level, index) for index in range(width)]
+             for level in range(depth)]
+    attrs = {}
+    column_names = {}
+    for level in range(depth):
+        for name in names[level]:
+            attrs[name] = {
+                "__tablename__": name.lower(),
+                "id": Column(Integer, primary_key=True)
+            }
+            column_names[name] = []
+            prefixes = list(COLUMN_TYPES)
+            for i in range(columns):
+                prefix = prefixes[i % len(prefixes)]
+                column_name = "%s_%d" % (prefix, i)
+                attrs[name][column_name] = Column(COLUMN_TYPES[prefix])
+                column_names[name].append(column_name)
+    for level in range(depth - 1):
+        for name in names[level]:
+            children = rng.sample(names[level + 1], min(fanout, width))
+            for child_name in children:
+                attrs[child_name][name.lower() + "_id"] = Column(
+                    Integer, ForeignKey(name.lower() + ".id"))
+                attrs[name][child_name.lower() + "s"] = relationship(
+                    child_name, backref=name.lower())
+    layers = []
+    columns_by_class = {}
+    for level in range(depth):
+        layer = []
+        for name in names[level]:
+            model_class = type(name, (base, ), attrs[name])
+            columns_by_class[model_class] = column_names[name]
+            layer.append(model_class)
+        layers.append(layer)
+    configure_mappers()
+    return SyntheticSchema(base, layers, columns_by_class)
+
+
+def _generate_value(rng, prefix, op):
+    """Generate a random value for a column type and op."""
+    if op == "$exists":
+        return rng.random() < 0.5
+    elif op == "$mod":
+        return [rng.randint(2, 10), rng.randint(0, 1)]
+    elif op == "$in" or op == "$nin":
+        return [_generate_value(rng, prefix, "$eq")
+                for i in range(rng.randint(1, 10))]
+    elif prefix == "int":
+        return rng.randint(0, 1000)
+    elif prefix == "text":
+        return "".join(rng.choice("abcdefgh") for i in range(4))
+    elif prefix == "float":
+        return rng.random() * 1000
+    elif prefix == "flag":
+        return rng.random() < 0.5
+    elif prefix == "created":
+        return "2020-01-%02d 12:00:00" % rng.randint(1, 28)
+    return "2020-01-%02d" % rng.randint(1, 28)
+
+
+def generate_filters(schema, model_class=None, size=10, path_depth=2,
+                     nesting=0.3, elem_match=0.1, op_weights=None, seed=0):
+    """Generate random, valid filters for a synthetic schema.
+
+    :param schema: Schema from :func:`build_schema`.
+    :param model_class: Model class to generate filters for, defaults
+        to ``schema.root``.
+    :param int size: Number of leaf comparisons in the filters.
+    :param int path_depth: Max number of relationships to follow from
+        ``model_class`` for a single leaf, including ``$elemMatch``.
+    :param float nesting: Chance that a group of leaves is combined
+        using a nested ``$and``, ``$or``, ``$nor``, or ``$not``, rather
+        than sibling keys.
+    :param float elem_match: Chance that a leaf on a relationship is
+        generated as an explicit ``$elemMatch``.
+    :param dict op_weights: Relative weights for picking operators,
+        e.g. ``{"$eq": 5, "$in": 1}``. Operators not included aren't
+        used, unless no allowed operator for a column is included.
+    :param int seed: Seed for the random generator.
+    :return: A dict of filters.
+
+    """
+    rng = random.Random(seed)
+    if model_class is None:
+        model_class = schema.root
+
+    def pick_op(prefix):
+        ops = COLUMN_OPS[prefix]
+        if op_weights:
+            weights = [op_weights.get(op, 0) for op in ops]
+            if any(weights):
+                return rng.choices(ops, weights)[0]
+        return rng.choice(ops)
+
+    def generate_leaf(current_class, depth):
+        relationships = schema.relationships[current_class]
+        if (depth < path_depth and relationships and
+                rng.random() < 0.5):
+            name = rng.choice(sorted(relationships))
+            target = relationships[name]
+            if rng.random() < elem_match:
+                return {name: {
+                    "$elemMatch": generate_leaf(target, depth + 1)}}
+            sub_filters = generate_leaf(target, depth + 1)
+            key = list(sub_filters)[0]
+            return {name + "." + key: sub_filters[key]}
+        column_name = rng.choice(schema.columns[current_class])
+        prefix = column_name.split("_")[0]
+        op = pick_op(prefix)
+        value = _generate_value(rng, prefix, op)
+        if op == "$eq" and rng.random() < 0.5:
+            return {column_name: value}
+        return {column_name: {op: value}}
+
+    def combine(leaves):
+        if len(leaves) == 1:
+            return leaves[0]
+        if rng.random() < nesting:
+            op = rng.choice(["$and", "$or", "$nor", "$not"])
+            if op == "$not":
+                return {"$not": combine(leaves)}
+            groups = rng.randint(2, min(4, len(leaves)))
+            split = sorted(rng.sample(range(1, len(leaves)), groups - 1))
+            bounds = [0] + split + [len(leaves)]
+            return {op: [combine(leaves[bounds[i]:bounds[i + 1]])
+                         for i in range(groups)]}
+        filters = {}
+        for leaf in leaves:
+            key = list(leaf)[0]
+            if key in filters:
+                # duplicate key, nest it to keep both
+                filters.setdefault("$and", []).append(leaf)
+            else:
+                filters[key] = leaf[key]
+        return filters
+
+    leaves = [generate_leaf(model_class, 0) for i in range(size)]
+    return combine(leaves)
+
+
+def count_leaves(filters):
+    """Count the leaf comparisons in a set of filters."""
+    if isinstance(filters, list):
+        return sum(count_leaves(item) for item in filters)
+    count = 0
+    for key, value in filters.items():
+        if key in ("$and", "$or", "$nor", "$not", "$elemMatch"):
+            count += count_leaves(value)
+        elif isinstance(value, dict) and not any(
+                sub_key.startswith("$") for sub_key in value):
+            count += count_leaves(value)
+        else:
+            count += 1
+    return count
+
+
+def time_parse(model_class, filters, repeat=5):
+    """Get the best time in seconds to parse filters.
+
+    :param model_class: Model class the filters are for.
+    :param dict filters: Filters to parse.
+    :param int repeat: Number of timing samples to take.
+    :return: Best time for a single parse.
+
+    """
+    def parse():
+        return MqlBuilder.parse_mql_filters(model_class, filters)
+
+    calls, _ = timeit.Timer(parse).autorange()
+    calls = max(1, calls // 4)
+    return min(timeit.repeat(parse, number=calls, repeat=repeat)) / calls
+
+
+def scaling_exponent(sizes, times):
+    """Estimate ``k`` in ``time ~ size ** k`` from the last two points.
+
+    :param list sizes: Increasing input sizes.
+    :param list times: Time taken for each size.
+    :return: The estimated exponent, or ``None`` with fewer than two
+        points.
+
+    """
+    if len(sizes) < 2 or times[-2] <= 0:
+        return None
+    return (math.log(times[-1] / times[-2]) /
+            math.log(sizes[-1] / sizes[-2]))
+
+
+def run(widths, depths, sizes, fanout=2, nesting=0.3, repeat=5, seed=0):
+    """Time parsing across schema shapes and filter sizes.
+
+    :return: A list of result dicts, suitable for saving as JSON. Each
+        has the schema shape, filter size, parse time, and the
+        exponent of the growth in parse time compared to the previous
+        filter size.
+
+    """
+    results = []
+    for width in widths:
+        for depth in depths:
+            schema = build_schema(
+                width=width, depth=depth, fanout=fanout, seed=seed)
+            run_sizes = []
+            run_times = []
+            for size in sizes:
+                filters = generate_filters(
+                    schema, size=size, path_depth=depth - 1,
+                    nesting=nesting, seed=seed)
+                parse_time = time_parse(schema.root, filters, repeat)
+                run_sizes.append(count_leaves(filters))
+                run_times.append(parse_time)
+                results.append({
+                    "width": width,
+                    "depth": depth,
+                    "models": width * depth,
+                    "size": run_sizes[-1],
+                    "seconds": parse_time,
+                    "seconds_per_leaf": parse_time / run_sizes[-1],
+                    "exponent": scaling_exponent(run_sizes, run_times)
+                })
+    return results
+
+
+def main(argv=None):
+    """Run the scaling benchmark and print a table of results.
+
+    :return: Exit status, ``1`` if ``--max-exponent`` was exceeded.
+
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--widths", type=int, nargs="+", default=[30])
+    parser.add_argument("--depths", type=int, nargs="+", default=[2, 4, 8])
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--fanout", type=int, default=2)
+    parser.add_argument("--nesting", type=float, default=0.3)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="Save results to this file.")
+    parser.add_argument(
+        "--max-exponent", type=float, default=1.25,
+        help="Flag growth in parse time faster than size ** this.")
+    args = parser.parse_args(argv)
+    results = run(args.widths, args.depths, args.sizes, fanout=args.fanout,
+                  nesting=args.nesting, repeat=args.repeat, seed=args.seed)
+    if args.json:
+        with open(args.json, "w") as results_file:
+            json.dump(results, results_file, indent=2)
+    print("%8s%8s%8s%8s%14s%14s%10s" % (
+        "models", "depth", "width", "leaves", "parse", "per leaf",
+        "exponent"))
+    superlinear = False
+    for result in results:
+        exponent = result["exponent"]
+        flagged = exponent is not None and exponent > args.max_exponent
+        superlinear = superlinear or flagged
+        print("%8d%8d%8d%8d%12.3fms%12.2fus%10s%s" % (
+            result["models"], result["depth"], result["width"],
+            result["size"], result["seconds"] * 1000,
+            result["seconds_per_leaf"] * 1000000,
+            "-" if exponent is None else "%.2f" % exponent,
+            "  SUPERLINEAR" if flagged else ""))
+    return 1 if superlinear else 0
+
+
+if __name__ == "__main__":    # pragma no cover
+    sys.exit(main())
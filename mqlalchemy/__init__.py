@@ -13,21 +13,79 @@
 from mqlalchemy.utils import dummy_gettext
 import sqlalchemy
 from sqlalchemy import select
-from sqlalchemy.orm import ColumnProperty, RelationshipProperty
+from sqlalchemy.orm import (
+    ColumnProperty, RelationshipProperty, MANYTOONE, Session, aliased,
+    defaultload, defer, joinedload, lazyload, load_only, selectinload,
+    subqueryload)
+from sqlalchemy.orm.loading import merge_frozen_result
+from sqlalchemy.engine import IteratorResult
+from sqlalchemy.engine.result import SimpleResultMetaData
 from sqlalchemy.types import (
     String, Text, Unicode, UnicodeText, Enum, Integer, BigInteger,
     SmallInteger, Boolean, Date, DateTime, Float, Numeric, Time, BIGINT,
     BOOLEAN, CHAR, CLOB, DATE, DATETIME, DECIMAL, FLOAT, INT, INTEGER,
     NCHAR, NVARCHAR, NUMERIC, REAL, SMALLINT, TEXT, TIME, TIMESTAMP,
-    VARCHAR)
+    VARCHAR, ARRAY)
+from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.inspection import inspect
+from sqlalchemy.sql.elements import False_, True_
+from sqlalchemy.sql.expression import ClauseElement, Executable
+from sqlalchemy.sql.schema import Table
+from sqlalchemy.sql.util import find_tables
+import asyncio
+import base64
+import collections
+import contextvars
 import datetime
+import decimal
+import functools
+import hashlib
+import json
+import operator
+import re
+import threading
+import time
+import weakref
+from inspect import isawaitable, iscoroutinefunction, isroutine
+try:
+    import numpy
+except ImportError:    # pragma: no cover
+    numpy = None
 
 
 __all__ = ["MqlBuilder", "InvalidMqlException", "MqlTooComplex",
-           "MqlFieldError", "MqlFieldPermissionError", "apply_mql_filters",
+           "MqlFieldError", "MqlFieldPermissionError", "MqlFilterPlan",
+           "MqlPlanCache", "MqlPathInfo", "MqlSchemaIndex",
+           "MqlWhitelist", "MqlProfile", "MqlProfiler", "MqlCost",
+           "MqlCostModel", "MqlLoadPlan", "MqlCountCache",
+           "MqlLRUCache", "MqlResultCache",
+           "apply_mql_filters",
            "convert_to_alchemy_type"]
-__version__ = "1.0.0"
+__version__ = "1.1.0"
+
+# Python types that are passed as is in a JSON encoded list of values.
+_json_types = (int, float, str, bool)
+
+# Comparison operators that translate directly to a Python operator.
+_COMPARISON_OPS = {
+    "$lt": operator.lt,
+    "$lte": operator.le,
+    "$eq": operator.eq,
+    "$ne": operator.ne,
+    "$gte": operator.ge,
+    "$gt": operator.gt
+}
+
+# Operators that match everything or nothing, regardless of any field.
+_CONSTANT_OPS = frozenset(["$alwaysTrue", "$alwaysFalse"])
+
+# Range operators, as ``(is_lower_bound, is_strict)`` tuples.
+_RANGE_OPS = {
+    "$gt": (True, True),
+    "$gte": (True, False),
+    "$lt": (False, True),
+    "$lte": (False, False)
+}
 
 
 class InvalidMqlException(Exception):
@@ -83,431 +141,3596 @@ class MqlFieldPermissionError(MqlFieldError):
     pass
 
 
-class MqlBuilder(object):
+class MqlFilterPlan(object):
 
-    """Class for building queries using MQL style filters."""
+    """Pre-parsed filters that can be reused with new values.
 
-    # Default types used for converting user input into
-    # SQLAlchemy friendly data.
-    # Will need to override these and :meth:`convert_to_alchemy_type`
-    # if wanting to use db vendor specific data types, or anything more
-    # complex than the primitive types included here.
-    text_types = [String, Unicode, Enum, Text, UnicodeText, CHAR, CLOB, NCHAR,
-                  NVARCHAR, TEXT, VARCHAR]
-    int_types = [Integer, BigInteger, SmallInteger, BIGINT, INT, INTEGER,
-                 SMALLINT]
-    bool_types = [Boolean, BOOLEAN]
-    date_types = [Date, DATE]
-    datetime_types = [DateTime, DATETIME, TIMESTAMP]
-    float_types = [Float, Numeric, DECIMAL, FLOAT, NUMERIC, REAL]
-    time_types = [Time, TIME]
+    Created by :meth:`MqlBuilder.compile`. All whitelist checks and
+    attribute and relationship resolution are done once when the plan
+    is compiled, while user supplied values are represented by
+    :func:`~sqlalchemy.sql.expression.bindparam` objects. Binding new
+    values only requires converting them to the proper types.
 
-    @classmethod
-    def _generate_expressions(cls, op, value, attr, target_type, full_data_key,
-                              gettext):
-        """Generate a filter expression on an attr for an op and value.
+    Any filters used with a plan must have the same structure as the
+    filters the plan was compiled from. That is, the same keys and
+    operators in the same order, with ``null`` values, lists, and
+    ``$exists`` values in the same places. Literal values and the
+    length of ``$in`` lists are free to change.
 
-        :param str op: An operator starting with ``"$"``.
-        :param value: The user supplied value for the provided ``op``.
-        :param attr: The attribute of the model being filtered by.
-        :param target_type: Python data type the provided ``value`` will
-            attempt to be converted into.
-        :param full_data_key: Full dot separated path to the attribute
-            being queried, as supplied by the user. Used for error
-            message generation.
-        :param callable gettext: Used for translating error messages
-            if applicable.
-        :return: A SQLAlchemy expression for filtering.
+    """
+
+    def __init__(self, model_class, shape, nodes, slots, relations=None):
+        """Initializes a new plan.
+
+        :param model_class: SQLAlchemy model class the plan queries.
+        :param shape: Hashable structural key of the compiled filters.
+        :param nodes: List of :class:`_MqlPlanNode` objects and constant
+            SQLAlchemy expressions, or ``None`` if the compiled filters
+            produced no expressions.
+        :param list slots: :class:`_MqlBindSlot` objects in the order
+            their values are found in a set of filters.
+        :param relations: Dot separated relationship paths filtered on.
+        :type relations: set or None
 
         """
-        _ = gettext
-        try:
-            if op == "$lt":
-                expression = attr < cls.convert_to_alchemy_type(
-                    value, target_type)
-            elif op == "$lte":
-                expression = attr <= cls.convert_to_alchemy_type(
-                    value, target_type)
-            elif op == "$eq":
-                expression = attr == cls.convert_to_alchemy_type(
-                    value, target_type)
-            elif op == "$ne":
-                expression = attr != cls.convert_to_alchemy_type(
-                    value, target_type)
-            elif op == "$gte":
-                expression = attr >= cls.convert_to_alchemy_type(
-                    value, target_type)
-            elif op == "$gt":
-                expression = attr > cls.convert_to_alchemy_type(
-                    value, target_type)
-            elif op == "$like":
-                expression = attr.like(
-                    "%" + str(value) + "%")
-            elif op == "$in" or op == "$nin":
-                if not isinstance(value, list):
-                    raise MqlFieldError(
-                        data_key=full_data_key,
-                        op=op,
-                        filters=value,
-                        message=_("$in and $nin values must "
-                                  "be a list."),
-                        code="invalid_in_comp"
-                    )
-                converted_list = []
-                for value in value:
-                    converted_list.append(
-                        cls.convert_to_alchemy_type(
-                            value, target_type))
-                expression = attr.in_(converted_list)
-                if op == "$nin":
-                    expression = sqlalchemy.not_(expression)
-            elif op == "$mod":
-                if target_type not in cls.int_types:
-                    raise MqlFieldError(
-                        data_key=full_data_key,
-                        op=op,
-                        filters=value,
-                        message=_("$mod may only be used on integer fields."),
-                        code="invalid_op"
-                    )
-                if (isinstance(value, list) and
-                        len(value) == 2):
-                    try:
-                        divider = int(value[0])
-                        if int(value[0]) != value[0]:
-                            raise TypeError(
-                                "Decimal provided "
-                                "instead of int.")
-                        result = int(value[1])
-                        if int(value[1]) != value[1]:
-                            raise TypeError(
-                                "Decimal provided "
-                                "instead of int.")
-                    except (TypeError, ValueError):
-                        raise MqlFieldError(
-                            data_key=full_data_key,
-                            op=op,
-                            filters=value,
-                            message=_(
-                                "Non int $mod value supplied"),
-                            code="invalid_mod_values"
-                        )
-                    expression = (
-                            attr.op("%")(divider) == result)
-                else:
-                    raise MqlFieldError(
-                        data_key=full_data_key,
-                        filters=value,
-                        op=op,
-                        message=_("$mod value must be list of "
-                                  "two integers."),
-                        code="invalid_mod_values"
-                    )
-            elif op == "$exists":
-                exists = cls.convert_to_alchemy_type(value, target_type)
-                if isinstance(attr.property, RelationshipProperty):
-                    if not attr.property.uselist:
-                        expression = attr.has() if exists else ~attr.has()
-                    else:
-                        expression = attr.any() if exists else ~attr.any()
-                else:
-                    expression = ~attr.is_(None) if exists else attr.is_(None)
-            else:
-                raise MqlFieldError(
-                    data_key=full_data_key,
-                    filters=value,
-                    op=op,
-                    message=_("Invalid operator."),
-                    code="invalid_op"
-                )
-        except (TypeError, ValueError):
-            raise MqlFieldError(
-                data_key=full_data_key,
-                filters=value,
-                op=op,
-                message=_("Unable to convert provided data to the proper "
-                          "type for this field."),
-                code="data_conversion_error"
-            )
-        return expression
+        self.model_class = model_class
+        self.shape = shape
+        self.nodes = nodes
+        self.slots = slots
+        self.relations = frozenset(relations or ())
+        self.expressions = self._build(None)
 
-    @classmethod
-    def apply_mql_filters(cls, model_class, query=None, filters=None, 
-                          whitelist=None, nested_conditions=None,
-                          stack_size_limit=None, convert_key_names_func=None,
-                          gettext=None):
-        """Applies filters to a select statement and returns it.
+    def _build(self, values):
+        """Build the plan's expressions.
 
-        Bulk of the work here is done by :meth:`parse_filters`, more
-        detailed documentation can be found there.
+        :param values: Bindable values collected from a set of filters,
+            in the same order as :attr:`slots`. If ``None``, expressions
+            containing bound parameters are returned instead.
+        :type values: list or None
+        :return: A list of SQLAlchemy expressions, or ``None``.
+
+        """
+        if self.nodes:
+            return [
+                node.build(values) if isinstance(node, _MqlPlanNode) else node
+                for node in self.nodes]
+
+    def _split(self, filters):
+        """Collect the bindable values from filters.
 
-        :param model_class: SQLAlchemy model class you want to query.
-        :type model_class: :class:`~sqlalchemy.orm.DeclarativeMeta` or
-            :class:`~sqlalchemy.orm.util.AliasedClass`
-        :param query: A select statement that directly references
-            the provided `model_class`. Optional, useful if there
-            are already some set of filters previously applied.
-        :type query: :class:`~sqlalchemy.sql.selectable.Select`
         :param dict filters: Dictionary of MongoDB style query filters.
-        :param whitelist: Used to determine whether it's permissible to
-            filter by a given field.
-            The field being checked will be a dot notation attr name
-            (e.g. for Album ``tracks.playlists.playlist_id``) that has
-            already been processed by ``convert_key_names_func`` when
-            applicable.
-            If a callable is provided, it should take in a dot separated
-            field name and return ``True`` if it is acceptable to query
-            that field, or ``False`` if not.
-            If a list of field names is provided, field names will be
-            checked against that list to determine whether or not it
-            is an allowed field to be queried.
-            If ``None`` is provided, all fields and relationships of a
-            model will be queryable.
-        :type whitelist: callable, list, or None
-        :param nested_conditions: Provides SQL expressions, as would be
-            used directly by :meth:`~sqlalchemy.orm.query.Query.filter`,
-            for additional filtering on any nested relationships. Can be
-            a callable accepting a single param, or a dict, where the
-            param/key is the relationship being filtered will be
-            provided as a dot notation name (e.g. for Album
-            ``tracks.playlists``) that has already been processed by
-            ``convert_key_names_func`` when applicable. The value
-            returned can be a single item, list, or tuple.
-        :param nested_conditions: callable, dict, or None
-        :param convert_key_names_func: Optional function used to convert
-            a user provided attribute name into a field name for a model.
-            Should take one parameter, which is a dot separated name,
-            and should return a converted string in the same dot
-            separated format. For example, say you want to be able to
-            query your model, which contains field names with
-            underscores, using lowerCamelCase instead. The provided
-            function should take a string such as ``"tracks.unitPrice"``
-            and convert it to ``"tracks.unit_price"``. For the sake of
-            raising more useful exceptions, the function should return
-            ``None`` if an invalid field name is provided, however this
-            is not necessary.
-        :type convert_key_names_func: callable
-        :param stack_size_limit: Optional parameter used to limit the
-            allowable complexity of the provided filters. Can be useful
-            in preventing malicious query attempts.
-        :type stack_size_limit: int or None
-        :param gettext: Supply a translation function to convert error
-            messages to the desired language. Note that no translations
-            are included by default, you must generate your own.
-        :type gettext: callable or None
-        :return: A filtered SQLAlchemy select object of the provided
-            `model_class`.
+        :raises InvalidMqlException: If ``filters`` doesn't match the
+            structure of this plan.
+        :return: List of bindable values.
+        :rtype: list
+
+        """
+        values = []
+        shape, template = _split_filters(filters, values)
+        if shape != self.shape:
+            raise InvalidMqlException(
+                "Filters don't match the structure of the compiled plan.")
+        return values
+
+    def matches(self, filters):
+        """Check whether filters can be used with this plan.
+
+        :param dict filters: Dictionary of MongoDB style query filters.
+        :return: ``True`` if ``filters`` has the same structure as the
+            filters this plan was compiled from.
+        :rtype: bool
+
+        """
+        shape, template = _split_filters(filters, None)
+        return shape == self.shape
+
+    def get_params(self, filters):
+        """Convert the values in filters to bound parameter values.
+
+        :param dict filters: Dictionary of MongoDB style query filters
+            matching the structure of this plan.
+        :raises InvalidMqlException: If ``filters`` doesn't match the
+            structure of this plan.
+        :raises MqlFieldError: If a value can't be converted to the
+            proper type for its field.
+        :return: A dict of bound parameter names to converted values.
+        :rtype: dict
+
+        """
+        params = {}
+        for slot, value in zip(self.slots, self._split(filters)):
+            slot.update_params(params, value)
+        return params
+
+    def bind(self, filters):
+        """Build the plan's expressions using values from filters.
+
+        :param dict filters: Dictionary of MongoDB style query filters
+            matching the structure of this plan.
+        :raises InvalidMqlException: If ``filters`` doesn't match the
+            structure of this plan.
+        :raises MqlFieldError: If a value can't be converted to the
+            proper type for its field.
+        :return: A list of SQLAlchemy expressions, or ``None`` if the
+            plan has no expressions.
+
+        """
+        return self._build(self._split(filters))
+
+    def apply(self, query=None, filters=None):
+        """Apply the plan's expressions to a select statement.
+
+        If ``filters`` is ``None``, the returned statement's bound
+        parameters are left without values, and they should be supplied
+        at execution time using :meth:`get_params`. This allows the same
+        statement object to be reused for every execution:
+
+        .. code-block:: python
+
+            stmt = plan.apply(select(Album))
+            db_session.execute(stmt, plan.get_params(filters))
+
+        As the statement is built before any values are known, ``$in``
+        and ``$nin`` lists always use a regular, expanding ``IN``, and
+        :attr:`MqlBuilder.large_in_threshold` has no effect. Statements
+        built with ``filters``, including any using
+        :attr:`MqlBuilder.plan_cache`, still use
+        :attr:`MqlBuilder.large_in_strategy` for lists over the
+        threshold.
+
+        :param query: A select statement that directly references the
+            plan's `model_class`. A new one is created if not provided.
+        :type query: :class:`~sqlalchemy.sql.selectable.Select`
+        :param filters: Optional dictionary of MongoDB style query
+            filters to bind values from.
+        :type filters: dict or None
+        :return: A filtered SQLAlchemy select object.
         :rtype: sqlalchemy.sql.selectable.Select
 
         """
-        expressions = cls.parse_mql_filters(
-            model_class=model_class,
-            filters=filters,
-            whitelist=whitelist,
-            nested_conditions=nested_conditions,
-            stack_size_limit=stack_size_limit,
-            convert_key_names_func=convert_key_names_func,
-            gettext=gettext
-        )
         if query is None:
-            query = select(model_class)
+            query = select(self.model_class)
+        if filters is None:
+            expressions = self.expressions
+        else:
+            expressions = self.bind(filters)
         if expressions:
             query = query.where(sqlalchemy.and_(*expressions))
         return query
 
-    @classmethod
-    def parse_mql_filters(cls, model_class, filters=None, whitelist=None,
-                          nested_conditions=None, stack_size_limit=None,
-                          convert_key_names_func=None, gettext=None):
-        """Applies filters to a query and returns it.
 
-        Supported operators include:
+class _MqlPlanNode(object):
 
-        * $and
-        * $or
-        * $not
-        * $nor
-        * $in
-        * $nin
-        * $gt
-        * $gte
-        * $lt
-        * $lte
-        * $ne
-        * $mod
+    """Recipe for building part of a plan's expression tree."""
 
-        Custom operators added for convenience:
+    __slots__ = ("op", "children")
 
-        * $eq - Explicit equality check.
-        * $like - Search a text field for the given value.
+    def __init__(self, op, children):
+        """Initializes a new node.
 
-        Filtering here works similarly to how MongoDB handles querying,
-        with SQLAlchemy relationships being treated like MongoDB treats
-        nested documents.
+        :param op: A query tree op, as used while parsing filters.
+        :param list children: Child nodes and constant expressions.
 
-        The ``whitelist`` and ``nested_conditions`` parameters can be
-        used for fine grain access control, with both serving distinct
-        purposes. ``whitelist`` can be used to apply rules regarding
-        which fields can generally be queried, while
-        ``nested_conditions`` can be used to apply rules regarding
-        what nested records can be accessed in a query.
+        """
+        self.op = op
+        self.children = children
 
-        As an example, say you want a user to be able to query an album
-        based on the playlists that album's tracks belong to. Your
-        ``whitelist`` would only need ``tracks.playlists.name`` to be
-        included. If the user isn't supposed to have access to playlists
-        with ``"Private"`` in their name, your ``nested_conditions``
-        could look like:
+    def build(self, values):
+        """Build this node's expression.
 
-        .. code-block:: python
+        :param values: Bindable values, or ``None`` to use bound params.
+        :return: A SQLAlchemy expression.
 
-            def nested_conditions(key):
-                if key == "tracks.playlists":
-                    return not Playlist.name.contains("Private")
+        """
+        expressions = [
+            child.build(values) if isinstance(child, _MqlPlanNode) else child
+            for child in self.children]
+        if self.op is sqlalchemy.and_ or self.op is sqlalchemy.or_:
+            return self.op(*expressions)
+        elif self.op is sqlalchemy.not_:
+            return sqlalchemy.not_(expressions[0])
+        # should be a .has or .any
+        return self.op(sqlalchemy.and_(*expressions))
 
-        Now if the user provides
-        ``filters={"tracks.playlists.name": { "$like": "Private"}}``,
-        no resulting albums will be returned, even though the user does
-        have access to the ``tracks.playlists.name`` field.
 
-        :param model_class: SQLAlchemy model class you want to query.
-        :param dict filters: Dictionary of MongoDB style query filters.
-        :param whitelist: Used to determine whether it's permissible to
-            filter by a given field.
-            The field being checked will be a dot notation attr name
-            (e.g. for Album ``tracks.playlists.playlist_id``) that has
-            already been processed by ``convert_key_names_func`` when
-            applicable.
-            If a callable is provided, it should take in a dot separated
-            field name and return ``True`` if it is acceptable to query
-            that field, or ``False`` if not.
-            If a list of field names is provided, field names will be
-            checked against that list to determine whether or not it
-            is an allowed field to be queried.
-            If ``None`` is provided, all fields and relationships of a
-            model will be queryable.
-        :type whitelist: callable, list, or None
-        :param nested_conditions: Provides SQL expressions, as would be
-            used directly by :meth:`~sqlalchemy.orm.query.Query.filter`,
-            for additional filtering on any nested relationships. Can be
-            a callable accepting a single param, or a dict, where the
-            param/key is the relationship being filtered will be
-            provided as a dot notation name (e.g. for Album
-            ``tracks.playlists``) that has already been processed by
-            ``convert_key_names_func`` when applicable. The value
-            returned can be a single item, list, or tuple.
-        :param nested_conditions: callable, dict, or None
-        :param convert_key_names_func: Optional function used to convert
-            a provided attribute name into a field name for a model.
-            Should take one parameter, which is a dot separated name,
-            and should return a converted string in the same dot
-            separated format. For example, say you want to be able to
-            query your model, which contains field names with
-            underscores, using lowerCamelCase instead. The provided
-            function should take a string such as ``"tracks.unitPrice"``
-            and convert it to ``"tracks.unit_price"``. For the sake of
-            raising more useful exceptions, the function should return
-            ``None`` if an invalid field name is provided, however this
-            is not necessary.
-        :type convert_key_names_func: callable
-        :param stack_size_limit: Optional parameter used to limit the
-            allowable complexity of the provided filters. Can be useful
-            in preventing malicious query attempts.
-        :type stack_size_limit: int or None
-        :param gettext: Supply a translation function to convert error
-            messages to the desired language. Note that no translations
-            are included by default, you must generate your own.
-        :type gettext: callable or None
+class _MqlPlanLeaf(_MqlPlanNode):
+
+    """Recipe for building a single filter expression of a plan."""
+
+    __slots__ = ("index", "generate", "expression")
+
+    def __init__(self, index, generate, expression):
+        """Initializes a new leaf.
+
+        :param int index: Index of this leaf's value in a list of
+            bindable values.
+        :param callable generate: Takes a value and returns an
+            expression for it.
+        :param expression: Expression using a bound param in place of
+            a value.
 
         """
-        if convert_key_names_func is None:
-            def convert_key_names_func(x): return x
-        if isinstance(whitelist, list):
-            def is_whitelisted(data_key):
-                """Uses the default, built in whitelist checker."""
-                return _is_whitelisted(model_class, data_key, whitelist)
-        elif callable(whitelist):
-            def is_whitelisted(data_key):
-                """Uses the provided whitelist function."""
-                return whitelist(data_key)
-        else:
-            def is_whitelisted(data_key):
-                """All attributes will be queryable."""
-                if data_key:
-                    return True
-        if isinstance(nested_conditions, dict):
-            def build_nested_conditions(data_key):
-                """Uses the built in nested_conditions getter."""
-                return nested_conditions.get(data_key)
-        elif callable(nested_conditions):
-            # Uses the provided required filters function.
-            build_nested_conditions = nested_conditions
-        else:
-            def build_nested_conditions(data_key):
-                """No filters will be built."""
+        super(_MqlPlanLeaf, self).__init__(None, None)
+        self.index = index
+        self.generate = generate
+        self.expression = expression
+
+    def build(self, values):
+        """Build this leaf's expression.
+
+        :param values: Bindable values, or ``None`` to use bound params.
+        :return: A SQLAlchemy expression.
+
+        """
+        if values is None:
+            return self.expression
+        return self.generate(values[self.index])
+
+
+class _MqlBindSlot(object):
+
+    """Placeholder for a bindable value while compiling a plan."""
+
+    __slots__ = ("index", "key", "op", "target_type", "data_key", "gettext",
+                 "builder")
+
+    def __init__(self, index):
+        """Initializes a new slot.
+
+        :param int index: Position of this slot's value in a list of
+            bindable values.
+
+        """
+        self.index = index
+        self.key = "mql_%d" % index
+        self.op = None
+        self.target_type = None
+        self.data_key = None
+        self.gettext = None
+        self.builder = None
+
+    def attach(self, builder, op, target_type, data_key, gettext):
+        """Record how values for this slot should be converted.
+
+        :param builder: :class:`MqlBuilder` class doing the conversion.
+        :param str op: Operator the slot's value is used with.
+        :param target_type: SQLAlchemy data type of the attr.
+        :param str data_key: Dot separated field name for errors.
+        :param callable gettext: Used for translating error messages.
+
+        """
+        self.builder = builder
+        self.op = op
+        self.target_type = target_type
+        self.data_key = data_key
+        self.gettext = gettext
+
+    def update_params(self, params, value):
+        """Convert a value and add it to a dict of bound params.
+
+        :param dict params: Bound parameter values being built.
+        :param value: User supplied value for this slot.
+        :raises MqlFieldError: If the value is invalid for this slot.
+
+        """
+        if self.op is None:
+            # slot never made it into an expression.
+            return
+        _ = self.gettext
+        cls = self.builder
+        try:
+            if self.op == "$like":
+                params[self.key] = "%" + str(value) + "%"
+            elif self.op == "$in" or self.op == "$nin":
+                if not isinstance(value, list):
+                    raise MqlFieldError(
+                        data_key=self.data_key,
+                        op=self.op,
+                        filters=value,
+                        message=_("$in and $nin values must be a list."),
+                        code="invalid_in_comp"
+                    )
+                params[self.key] = cls.convert_list_to_alchemy_type(
+                    value, self.target_type)
+            elif self.op == "$mod":
+                divider, result = cls._convert_mod_values(
+                    value, self.data_key, _)
+                params[self.key + "_divider"] = divider
+                params[self.key + "_result"] = result
+            else:
+                params[self.key] = cls.convert_to_alchemy_type(
+                    value, self.target_type)
+        except (TypeError, ValueError):
+            raise MqlFieldError(
+                data_key=self.data_key,
+                filters=value,
+                op=self.op,
+                message=_("Unable to convert provided data to the proper "
+                          "type for this field."),
+                code="data_conversion_error"
+            )
+
+
+class _MqlRelationFilters(object):
+
+    """Sibling filters grouped on a shared relationship while parsing."""
+
+    __slots__ = ("attr_name", "c_attr_name", "filters", "original")
+
+    def __init__(self, attr_name, c_attr_name, filters, original):
+        """Initializes a new group.
+
+        :param str attr_name: Dot separated name of the relationship,
+            relative to the current position in the filters.
+        :param str c_attr_name: ``attr_name`` converted by
+            ``convert_key_names_func``.
+        :param dict filters: Filters on the relationship, keyed by attr
+            names relative to the relationship.
+        :param original: :class:`_MqlKeyFrame` with the first filter
+            added to the group, as it was provided.
+
+        """
+        self.attr_name = attr_name
+        self.c_attr_name = c_attr_name
+        self.filters = filters
+        self.original = original
+
+
+class _MqlStackMarker(object):
+
+    """Base for parse stack frames that only mark where to stop.
+
+    Markers aren't counted as nodes visited when profiling.
+
+    """
+
+    __slots__ = ()
+
+
+class _MqlKeyFrame(object):
+
+    """A single filter key and its value, waiting to be parsed."""
+
+    __slots__ = ("key", "value")
+
+    def __init__(self, key, value):
+        """Initializes a new frame.
+
+        :param str key: Field name or operator.
+        :param value: The filters or value for ``key``.
+
+        """
+        self.key = key
+        self.value = value
+
+
+class _MqlTreeFrame(_MqlStackMarker):
+
+    """Expressions being collected to be combined by a single op."""
+
+    __slots__ = ("op", "expressions")
+
+    def __init__(self, op, expressions):
+        """Initializes a new frame.
+
+        :param op: Callable used to combine ``expressions``, e.g.
+            :func:`sqlalchemy.and_` or a relationship's ``.any``.
+        :param list expressions: Expressions built so far.
+
+        """
+        self.op = op
+        self.expressions = expressions
+
+
+class _MqlRestoreFrame(_MqlStackMarker):
+
+    """Marks where parsing returns to a previous position."""
+
+    __slots__ = ("state", )
+
+    def __init__(self, state):
+        """Initializes a new frame.
+
+        :param state: :class:`_MqlParseState` to return to.
+
+        """
+        self.state = state
+
+
+class _MqlParseState(object):
+
+    """Current position in a set of filters being parsed.
+
+    A state isn't changed once in use, entering a field or relationship
+    creates a new one instead. Names are tuples, starting with the
+    model class name, and the joined data keys used for resolving
+    paths and in errors are only built once per state.
+
+    """
+
+    __slots__ = ("attr_names", "c_attr_names", "sub_query_names",
+                 "c_sub_query_names", "entity", "data_key", "c_data_key",
+                 "c_sub_query_key")
+
+    def __init__(self, attr_names, c_attr_names, sub_query_names,
+                 c_sub_query_names, entity, data_key, c_data_key,
+                 c_sub_query_key):
+        """Initializes a new state.
+
+        :param tuple attr_names: Attr names of the current position.
+        :param tuple c_attr_names: Converted ``attr_names``.
+        :param tuple sub_query_names: Attr names of the relationships
+            that have sub queries, relative to their parent sub query.
+        :param tuple c_sub_query_names: Converted ``sub_query_names``.
+        :param entity: Aliased entity of a joined relationship, or
+            ``None`` if attrs of the mapped class are used as is.
+        :param str data_key: ``attr_names`` joined, without the model
+            class name.
+        :param str c_data_key: Converted ``data_key``.
+        :param str c_sub_query_key: ``c_sub_query_names`` joined,
+            without the model class name.
+
+        """
+        self.attr_names = attr_names
+        self.c_attr_names = c_attr_names
+        self.sub_query_names = sub_query_names
+        self.c_sub_query_names = c_sub_query_names
+        self.entity = entity
+        self.data_key = data_key
+        self.c_data_key = c_data_key
+        self.c_sub_query_key = c_sub_query_key
+
+    @classmethod
+    def for_model(cls, model_class):
+        """Get the state for the top level of filters on a model.
+
+        :param model_class: SQLAlchemy model class being queried.
+        :return: A new :class:`_MqlParseState`.
+
+        """
+        names = (model_class.__name__, )
+        return cls(names, names, names, names, None, "", "", "")
+
+    def get_data_key(self, key, converted=False):
+        """Get the full data key for a key at this position.
+
+        :param str key: Dot separated key, relative to this position.
+        :param bool converted: If ``True``, ``key`` is joined to the
+            converted attr names.
+        :return: A dot separated data key, or an empty string if
+            ``key`` is empty.
+        :rtype: str
+
+        """
+        if not key:
+            return ""
+        if len(self.attr_names) == 1:
+            return key
+        if converted:
+            return self.c_data_key + "." + key
+        return self.data_key + "." + key
+
+    def push_attr(self, attr_name, c_attr_name):
+        """Get the state for a field relative to this position.
+
+        :param str attr_name: Dot separated attr name.
+        :param str c_attr_name: Converted ``attr_name``.
+        :return: A new :class:`_MqlParseState`.
+
+        """
+        return _MqlParseState(
+            self.attr_names + (attr_name, ),
+            self.c_attr_names + (c_attr_name, ),
+            self.sub_query_names,
+            self.c_sub_query_names,
+            self.entity,
+            self.get_data_key(attr_name),
+            self.get_data_key(c_attr_name, converted=True),
+            self.c_sub_query_key)
+
+    def push_sub_query(self):
+        """Get the state for a sub query on the current relationship.
+
+        :return: A new :class:`_MqlParseState`, with no ``entity``.
+
+        """
+        sub_query_name = ".".join(self.attr_names)[
+            len(".".join(self.sub_query_names)) + 1:]
+        c_sub_query_name = ".".join(self.c_attr_names)[
+            len(".".join(self.c_sub_query_names)) + 1:]
+        c_sub_query_names = self.c_sub_query_names + (c_sub_query_name, )
+        return _MqlParseState(
+            self.attr_names,
+            self.c_attr_names,
+            self.sub_query_names + (sub_query_name, ),
+            c_sub_query_names,
+            None,
+            self.data_key,
+            self.c_data_key,
+            ".".join(c_sub_query_names[1:]))
+
+
+class MqlLRUCache(object):
+
+    """Bounded, thread safe LRU cache.
+
+    Used as the default backend of a :class:`MqlResultCache`, and as
+    the base of :class:`MqlPlanCache`. Any other backend used in its
+    place needs the same ``get`` and ``set`` methods.
+
+    """
+
+    def __init__(self, maxsize=128):
+        """Initializes a new cache.
+
+        :param int maxsize: Maximum number of values to store before
+            evicting the least recently used one.
+
+        """
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Get a value, marking it as the most recently used.
+
+        :param key: Hashable cache key.
+        :return: The cached value, or ``None``.
+
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
                 return None
-        if gettext is None:
-            gettext = dummy_gettext
-        _ = gettext
-        if filters is not None:
-            # NOTE: Any variable with a c_ prefix is used to store
-            # converted key names, in accordance with convert_key_names
-            # e.g. attr_name_stack = ["someAttr", "otherAttr"]
-            # c_attr_name_stack = ["some_attr", "other_attr"]
-            query_stack = list()
-            c_attr_name_stack = list()
-            attr_name_stack = list()
-            sub_query_name_stack = list()
-            c_sub_query_name_stack = list()
-            relation_type_stack = list()
-            query_tree_stack = list()
-            query_tree_stack.append({
-                "op": sqlalchemy.and_,
-                "expressions": []
-            })
-            query_stack.append(filters)
-            relation_type_stack.append(model_class)
-            attr_name_stack.append(model_class.__name__)
-            c_attr_name_stack.append(model_class.__name__)
-            sub_query_name_stack.append(model_class.__name__)
-            c_sub_query_name_stack.append(model_class.__name__)
-            while query_stack:
-                if stack_size_limit and len(query_stack) > stack_size_limit:
-                    raise MqlTooComplex(_("This query is too complex."))
-                item = query_stack.pop()
-                if isinstance(item, str):
-                    if item == "POP_attr_name_stack":
-                        attr_name_stack.pop()
-                        c_attr_name_stack.pop()
-                    elif item == "POP_sub_query_name_stack":
-                        sub_query_name_stack.pop()
-                        c_sub_query_name_stack.pop()
-                        relation_type_stack.pop()
-                    elif item == "POP_query_tree_stack":
-                        query_tree = query_tree_stack.pop()
-                        query_tree["expressions"] = (
-                            query_tree["expressions"] or [True])
-                        if (query_tree["op"] == sqlalchemy.and_ or
-                                query_tree["op"] == sqlalchemy.or_):
-                            expressions = [query_tree["op"](
-                                *query_tree["expressions"])]
-                        elif query_tree["op"] == sqlalchemy.not_:
-                            expressions = [sqlalchemy.not_(
-                                query_tree["expressions"][0])]
-                        else:
-                            # should be a .has or .any
-                            expressions = [query_tree["op"](
-                                sqlalchemy.and_(*query_tree["expressions"]))]
-                        query_tree_stack[-1]["expressions"].extend(expressions)
-                if isinstance(item, dict):
-                    if len(item) > 1:
-                        query_tree_stack.append({
-                            "op": sqlalchemy.and_,
-                            "expressions": []
-                        })
-                        query_stack.append("POP_query_tree_stack")
-                        for key in item:
-                            query_stack.append({key: item[key]})
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def set(self, key, value):
+        """Store a value, evicting the least recently used if needed.
+
+        :param key: Hashable cache key.
+        :param value: The value to store, which may not be ``None``.
+
+        """
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        """Remove all values and reset the counters."""
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+
+class MqlPlanCache(MqlLRUCache):
+
+    """Bounded LRU cache of compiled filter plans.
+
+    Enable by setting :attr:`MqlBuilder.plan_cache`, either on
+    :class:`MqlBuilder` itself or on a subclass:
+
+    .. code-block:: python
+
+        class CachedMqlBuilder(MqlBuilder):
+            plan_cache = MqlPlanCache(maxsize=512)
+
+    Plans are keyed by the shape of the provided filters, along with
+    the builder class, so subclasses sharing a cache don't share plans,
+    and the model class, ``whitelist``, ``nested_conditions``,
+    ``convert_key_names_func``, ``stack_size_limit``, and ``gettext``
+    params used. Lists, tuples, and dicts are compared by value, while
+    callables and other objects are compared by identity, so a new
+    function object created for every call will never hit the cache.
+    Filters parsed with a callable ``whitelist`` or
+    ``nested_conditions`` aren't cached at all, as their results may
+    change between calls.
+
+    """
+
+    def get(self, key):
+        """Get a plan, marking it as the most recently used.
+
+        :param key: Hashable cache key.
+        :return: The cached :class:`MqlFilterPlan`, or ``None``.
+
+        """
+        entry = super(MqlPlanCache, self).get(key)
+        if entry is not None:
+            return entry[0]
+
+    def set(self, key, plan, refs=None):
+        """Store a plan, evicting the least recently used if needed.
+
+        :param key: Hashable cache key.
+        :param plan: The :class:`MqlFilterPlan` to store.
+        :param refs: Any objects that should be kept alive as long as
+            the plan is cached.
+
+        """
+        super(MqlPlanCache, self).set(key, (plan, refs))
+
+
+class MqlResultCache(object):
+
+    """Cache of query results, invalidated when their tables change.
+
+    Enable by setting :attr:`MqlBuilder.result_cache`, used by
+    :meth:`MqlBuilder.execute_mql_filters`, and listening for changes
+    made by sessions:
+
+    .. code-block:: python
+
+        class CachedMqlBuilder(MqlBuilder):
+            result_cache = MqlResultCache()
+
+        CachedMqlBuilder.result_cache.listen()
+
+    Each table has a version, which is part of the key of any results
+    read from it. When a session flushes or commits changes to a
+    table, its version is bumped, so older results are no longer used
+    and eventually evicted from the backend.
+
+    Only changes made through the ORM in this process are noticed.
+    Changes made by bulk ``UPDATE`` or ``DELETE`` statements, raw SQL,
+    or other processes require calling :meth:`invalidate` directly.
+
+    """
+
+    def __init__(self, backend=None, maxsize=256):
+        """Initializes a new cache.
+
+        :param backend: Optional object to store results in, with
+            ``get(key)`` and ``set(key, value)`` methods. Defaults to a
+            new :class:`MqlLRUCache`.
+        :param int maxsize: Max size of the default backend.
+
+        """
+        if backend is None:
+            backend = MqlLRUCache(maxsize=maxsize)
+        self.backend = backend
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get_versions(self, tables):
+        """Get the current versions of tables.
+
+        :param tables: Iterable of SQLAlchemy tables.
+        :return: A hashable, sorted tuple of table names and versions.
+        :rtype: tuple
+
+        """
+        with self._lock:
+            return tuple(sorted(
+                (table.fullname, self._versions.get(table.fullname, 0))
+                for table in tables))
+
+    def get(self, key, tables):
+        """Get cached results, if none of their tables have changed.
+
+        :param key: Hashable key for the query.
+        :param tables: Tables the query reads from.
+        :return: The cached results, or ``None``.
+
+        """
+        return self.backend.get((key, self.get_versions(tables)))
+
+    def set(self, key, tables, value, versions=None):
+        """Store results.
+
+        :param key: Hashable key for the query.
+        :param tables: Tables the query reads from.
+        :param value: The results to store.
+        :param versions: Table versions from before the query was run,
+            from :meth:`get_versions`. Results are stored under these,
+            so if a table changed while the query ran the results
+            won't be used.
+        :type versions: tuple or None
+
+        """
+        if versions is None:
+            versions = self.get_versions(tables)
+        self.backend.set((key, versions), value)
+
+    def invalidate(self, tables):
+        """Stop using any cached results read from tables.
+
+        :param tables: Iterable of SQLAlchemy tables.
+
+        """
+        with self._lock:
+            for table in tables:
+                self._versions[table.fullname] = self._versions.get(
+                    table.fullname, 0) + 1
+
+    def listen(self, target=Session):
+        """Invalidate results when sessions flush or commit changes.
+
+        Tables are invalidated both after a flush, so the session
+        making changes sees them, and after the commit, so results
+        cached by other sessions in the meantime are dropped.
+
+        :param target: A :class:`~sqlalchemy.orm.session.Session`
+            class, instance, or ``sessionmaker`` to listen to. Defaults
+            to all sessions.
+
+        """
+        sqlalchemy.event.listen(target, "after_flush", self._after_flush)
+        sqlalchemy.event.listen(target, "after_commit", self._after_commit)
+        sqlalchemy.event.listen(
+            target, "after_soft_rollback", self._after_soft_rollback)
+
+    def remove(self, target=Session):
+        """Stop listening to sessions set up by :meth:`listen`.
+
+        :param target: The same ``target`` given to :meth:`listen`.
+
+        """
+        sqlalchemy.event.remove(target, "after_flush", self._after_flush)
+        sqlalchemy.event.remove(target, "after_commit", self._after_commit)
+        sqlalchemy.event.remove(
+            target, "after_soft_rollback", self._after_soft_rollback)
+
+    def _after_flush(self, session, flush_context):
+        """Invalidate tables changed by a flush, and remember them."""
+        tables = set()
+        for obj in list(session.new) + list(session.dirty) + list(
+                session.deleted):
+            mapper = inspect(obj).mapper
+            tables.update(mapper.tables)
+            for prop in mapper.relationships:
+                if prop.secondary is not None:
+                    tables.add(prop.secondary)
+        if tables:
+            session.info.setdefault(
+                "mqlalchemy_changed_tables", set()).update(tables)
+            self.invalidate(tables)
+
+    def _after_commit(self, session):
+        """Invalidate tables changed during a committed transaction."""
+        tables = session.info.pop("mqlalchemy_changed_tables", None)
+        if tables:
+            self.invalidate(tables)
+
+    def _after_soft_rollback(self, session, previous_transaction):
+        """Invalidate tables changed during a rolled back transaction.
+
+        Results read after a flush in the transaction may include
+        changes that are now rolled back.
+
+        """
+        tables = session.info.pop("mqlalchemy_changed_tables", None)
+        if tables:
+            self.invalidate(tables)
+
+
+class MqlCountCache(object):
+
+    """Bounded LRU cache of exact counts that expire after a TTL.
+
+    Enable by setting :attr:`MqlBuilder.count_cache`, used by
+    :meth:`MqlBuilder.count_mql_filters`:
+
+    .. code-block:: python
+
+        class CachedMqlBuilder(MqlBuilder):
+            count_cache = MqlCountCache(ttl=30)
+
+    Counts are keyed by the generated count statement and its bound
+    values, so filters with the same structure and values share a
+    cached count, as long as any ``nested_conditions`` and preexisting
+    query are also the same. Counts may be stale by up to ``ttl``
+    seconds.
+
+    """
+
+    def __init__(self, ttl=60, maxsize=1024, timer=time.monotonic):
+        """Initializes a new cache.
+
+        :param float ttl: Seconds a count may be used for.
+        :param int maxsize: Maximum number of counts to store before
+            evicting the least recently used one.
+        :param callable timer: Function returning the current time in
+            seconds.
+
+        """
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.timer = timer
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Get a count if it hasn't expired.
+
+        :param key: Hashable cache key.
+        :return: The cached count, or ``None``.
+
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] <= self.timer():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, count):
+        """Store a count, evicting the least recently used if needed.
+
+        :param key: Hashable cache key.
+        :param int count: The count to store.
+
+        """
+        with self._lock:
+            self._entries[key] = (count, self.timer() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """Remove all counts and reset the counters."""
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+class MqlPathInfo(object):
+
+    """Resolved info about a dot separated attr name for a model."""
+
+    __slots__ = ("path", "attrs", "kind", "column_type", "direction",
+                 "uselist", "target", "relation_indexes")
+
+    def __init__(self, model_class, path):
+        """Resolve a path for a model class.
+
+        :param model_class: A SQLAlchemy model class.
+        :param str path: A dot separated data key.
+        :raises AttributeError: If an invalid attribute name is given.
+
+        """
+        attrs = _get_class_attributes(model_class, path)
+        segments = path.split(".") if path else []
+        #: The path with any list index segments removed.
+        self.path = ".".join(
+            [segment for segment in segments if not segment[:1].isdigit()])
+        #: The attributes for each segment of the path, preceded by the
+        #: model class itself. See :func:`_get_class_attributes`.
+        self.attrs = attrs
+        #: One of ``"model"``, ``"column"``, ``"relationship"``, or
+        #: ``"other"`` depending on the final attr of the path.
+        self.kind = "other"
+        #: SQLAlchemy type class for a ``"column"`` path.
+        self.column_type = None
+        #: :class:`~sqlalchemy.orm.RelationshipDirection` for a
+        #: ``"relationship"`` path.
+        self.direction = None
+        #: Whether a ``"relationship"`` path refers to a collection.
+        self.uselist = None
+        #: Model class a ``"relationship"`` path refers to.
+        self.target = None
+        # Indexes of attrs that are relationships that will need their
+        # own sub query, i.e. that aren't followed by a list index.
+        self.relation_indexes = []
+        for i, attr in enumerate(attrs):
+            if (hasattr(attr, "property") and
+                    isinstance(attr.property, RelationshipProperty)):
+                if (i == len(attrs) - 1 or
+                        not segments[i][:1].isdigit()):
+                    self.relation_indexes.append(i)
+        attr = attrs[-1]
+        prop = getattr(attr, "property", None)
+        if isinstance(prop, ColumnProperty):
+            self.kind = "column"
+            self.column_type = type(prop.columns[0].type)
+        elif isinstance(prop, RelationshipProperty):
+            self.kind = "relationship"
+            self.direction = prop.direction
+            self.uselist = prop.uselist
+            self.target = prop.mapper.class_
+        elif len(attrs) == 1 or isinstance(attr, type):
+            self.kind = "model"
+
+
+class MqlSchemaIndex(object):
+
+    """Cache of resolved attribute paths for a single model class.
+
+    Paths are resolved lazily the first time they're requested, after
+    which looking one up is a single dict lookup. Use :meth:`warm_up`
+    to resolve paths ahead of time, e.g. when an app is starting up.
+
+    Only valid paths are stored, and only up to :attr:`max_size` of
+    them, so user supplied filters can't grow an index indefinitely.
+
+    """
+
+    #: Maximum number of paths to store per model class.
+    max_size = 10000
+
+    def __init__(self, model_class):
+        """Initializes a new, empty index.
+
+        :param model_class: A SQLAlchemy model class.
+
+        """
+        self.model_class = model_class
+        self._paths = {}
+
+    def __len__(self):
+        return len(self._paths)
+
+    def resolve(self, path):
+        """Get info about a dot separated attr name.
+
+        :param str path: A dot separated data key, relative to the
+            model class, e.g. ``"tracks.playlists.playlist_id"``.
+        :raises AttributeError: If an invalid attribute name is given.
+        :return: Resolved info for the path.
+        :rtype: :class:`MqlPathInfo`
+
+        """
+        try:
+            return self._paths[path]
+        except KeyError:
+            path_info = MqlPathInfo(self.model_class, path)
+            if len(self._paths) < self.max_size:
+                self._paths[path] = path_info
+            return path_info
+
+    def warm_up(self, max_depth=2):
+        """Resolve every column and relationship path ahead of time.
+
+        :param int max_depth: Maximum number of relationships to follow
+            away from the model class.
+        :return: The number of paths resolved.
+        :rtype: int
+
+        """
+        count = 0
+        pending = [("", inspect(self.model_class).mapper, 0)]
+        while pending:
+            prefix, mapper, depth = pending.pop()
+            for name in mapper.attrs.keys():
+                path = prefix + name
+                path_info = self.resolve(path)
+                count += 1
+                if (path_info.kind == "relationship" and
+                        depth < max_depth):
+                    pending.append((
+                        path + ".", inspect(path_info.target).mapper,
+                        depth + 1))
+        return count
+
+
+class MqlWhitelist(object):
+
+    """Compiled set of dot separated attr names that may be queried.
+
+    Any list of field names passed as a ``whitelist`` is compiled into
+    one of these while parsing. For large whitelists that are reused
+    across requests, compile one ahead of time and pass it in as the
+    ``whitelist`` instead:
+
+    .. code-block:: python
+
+        album_whitelist = MqlWhitelist(["album_id", "artist.name"])
+
+    """
+
+    #: Maximum number of checked attr names to remember results for.
+    max_size = 10000
+
+    def __init__(self, fields):
+        """Initializes a new whitelist.
+
+        :param fields: Iterable of dot separated attr names that are ok
+            to be queried, e.g. ``"tracks.playlists.playlist_id"``.
+
+        """
+        self.fields = frozenset(fields)
+        self._results = {}
+
+    def is_whitelisted(self, model_class, attr_name):
+        """Check if this attr_name is approved to be filtered.
+
+        Any list index references are removed from ``attr_name`` before
+        checking, so ``"tracks.0.track_id"`` is approved if
+        ``"tracks.track_id"`` is in the whitelist. The attr_name must
+        also be valid for ``model_class``.
+
+        :param model_class: A SQLAlchemy model class.
+        :param str attr_name: A dot separated data key.
+        :return: ``True`` if the attr_name is whitelisted, otherwise
+            ``False``.
+        :rtype: bool
+
+        """
+        key = (model_class, attr_name)
+        try:
+            return self._results[key]
+        except KeyError:
+            pass
+        result = False
+        split_attr = attr_name.split(".")
+        if any(attr[:1].isdigit() for attr in split_attr):
+            normalized_name = ".".join(
+                [attr for attr in split_attr if not attr[:1].isdigit()])
+        else:
+            normalized_name = attr_name
+        if normalized_name in self.fields:
+            try:
+                MqlBuilder.get_schema_index(model_class).resolve(attr_name)
+                result = True
+            except AttributeError:
+                # model_class doesn't contain this attr_name,
+                # therefor it can't be queried.
+                pass
+        if len(self._results) < self.max_size:
+            self._results[key] = result
+        return result
+
+
+class MqlProfile(object):
+
+    """Timings and counters recorded while parsing a set of filters.
+
+    Created for each parse by :class:`MqlProfiler`. Times are in
+    seconds, and each is exclusive of any other phase called within
+    it, e.g. a whitelist function that resolves attr names doesn't add
+    to ``"resolve"``.
+
+    Phases in :attr:`timings`:
+
+    * ``"key_conversion"`` - calls to ``convert_key_names_func``.
+    * ``"whitelist"`` - whitelist checks.
+    * ``"resolve"`` - resolving attr names to model attributes.
+    * ``"nested_conditions"`` - building ``nested_conditions``.
+    * ``"type_conversion"`` - converting values to column types.
+    * ``"build"`` - building expressions for each comparison and
+      relationship sub query, other than converting values.
+    * ``"other"`` - everything else, mostly walking the filters and
+      combining expressions.
+
+    Counters in :attr:`counters`:
+
+    * ``"nodes_visited"`` - filter nodes taken off the parse stack.
+    * ``"max_stack_depth"`` - largest size of the parse stack.
+    * ``"sub_queries"`` - relationship sub queries created.
+    * ``"comparisons"`` - comparisons built.
+    * ``"values_converted"`` - values converted to column types.
+    * ``"whitelist_calls"`` - whitelist checks.
+    * ``"key_conversions"`` - calls to ``convert_key_names_func``.
+    * ``"resolves"`` - attr name lookups.
+
+    """
+
+    phases = ("key_conversion", "whitelist", "resolve", "nested_conditions",
+              "type_conversion", "build", "other")
+    counter_names = ("nodes_visited", "max_stack_depth", "sub_queries",
+                     "comparisons", "values_converted", "whitelist_calls",
+                     "key_conversions", "resolves")
+
+    def __init__(self, model_class):
+        """Initializes a new profile.
+
+        :param model_class: SQLAlchemy model class being filtered.
+
+        """
+        self.model_class = model_class
+        self.total = 0.0
+        self.error = None
+        self.timings = dict.fromkeys(self.phases, 0.0)
+        self.counters = dict.fromkeys(self.counter_names, 0)
+        # Time spent in phases nested within the current one.
+        self._nested = 0.0
+
+    def wrap(self, phase, func, counter=None):
+        """Wrap a function so calls to it are timed and counted.
+
+        :param str phase: Key in :attr:`timings` to add time to.
+        :param callable func: The function to wrap.
+        :param counter: Optional key in :attr:`counters` to increment.
+        :type counter: str or None
+        :return: The wrapped function.
+
+        """
+        counters = self.counters
+
+        def timed(*args, **kwargs):
+            if counter is not None:
+                counters[counter] += 1
+            return self.time(phase, func, *args, **kwargs)
+        return timed
+
+    def time(self, phase, func, *args, **kwargs):
+        """Call a function, adding the time it takes to a phase.
+
+        :param str phase: Key in :attr:`timings` to add time to.
+        :param callable func: The function to call.
+        :return: The result of ``func``.
+
+        """
+        outer = self._nested
+        self._nested = 0.0
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.timings[phase] += elapsed - self._nested
+            self._nested = outer + elapsed
+
+    def finish(self, total, error=None):
+        """Record the total time, and the time not spent in a phase.
+
+        :param float total: Total time taken to parse, in seconds.
+        :param error: The exception raised while parsing, if any.
+
+        """
+        self.total = total
+        self.error = error
+        self.timings["other"] = max(0.0, total - sum(
+            value for key, value in self.timings.items() if key != "other"))
+
+    def as_dict(self):
+        """Get the profile as a JSON serializable dict.
+
+        :return: A dict with ``"model"``, ``"total"``, ``"error"``,
+            ``"timings"``, and ``"counters"`` keys.
+
+        """
+        return {
+            "model": getattr(self.model_class, "__name__",
+                             str(self.model_class)),
+            "total": self.total,
+            "error": type(self.error).__name__ if self.error else None,
+            "timings": dict(self.timings),
+            "counters": dict(self.counters)
+        }
+
+
+class MqlProfiler(object):
+
+    """Records timings and counters each time filters are parsed.
+
+    Enable by setting :attr:`MqlBuilder.profiler`, either on
+    :class:`MqlBuilder` itself or on a subclass:
+
+    .. code-block:: python
+
+        def send_metrics(profile):
+            for phase, seconds in profile.timings.items():
+                statsd.timing("mql.parse." + phase, seconds * 1000)
+
+        class ProfiledMqlBuilder(MqlBuilder):
+            profiler = MqlProfiler(callback=send_metrics)
+
+    Each parse creates a :class:`MqlProfile` that's passed to
+    ``callback`` and added to the running totals. Parsing with no
+    profiler set has no overhead beyond checking the attribute.
+    Building expressions from a cached :class:`MqlFilterPlan` doesn't
+    parse, so isn't profiled.
+
+    """
+
+    def __init__(self, callback=None):
+        """Initializes a new profiler.
+
+        :param callback: Optional callable that's passed each
+            :class:`MqlProfile` once parsing has finished, including
+            when parsing raised an exception.
+        :type callback: callable or None
+
+        """
+        self.callback = callback
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Clear the running totals."""
+        with self._lock:
+            self.parses = 0
+            self.errors = 0
+            self.total = 0.0
+            self.timings = dict.fromkeys(MqlProfile.phases, 0.0)
+            self.counters = dict.fromkeys(MqlProfile.counter_names, 0)
+
+    def run(self, profile, func):
+        """Call a parse function, recording a profile of it.
+
+        :param profile: The :class:`MqlProfile` that ``func`` records
+            timings and counters in.
+        :param callable func: The function to call, taking no params.
+        :return: The result of ``func``.
+
+        """
+        token = _active_profile.set(profile)
+        error = None
+        start = time.perf_counter()
+        try:
+            return func()
+        except Exception as exc:
+            error = exc
+            raise
+        finally:
+            profile.finish(time.perf_counter() - start, error)
+            _active_profile.reset(token)
+            self.record(profile)
+
+    def record(self, profile):
+        """Add a finished profile to the totals and pass it on.
+
+        :param profile: A finished :class:`MqlProfile`.
+
+        """
+        with self._lock:
+            self.parses += 1
+            self.errors += 1 if profile.error is not None else 0
+            self.total += profile.total
+            for key, value in profile.timings.items():
+                self.timings[key] += value
+            for key, value in profile.counters.items():
+                if key == "max_stack_depth":
+                    self.counters[key] = max(self.counters[key], value)
+                else:
+                    self.counters[key] += value
+        if self.callback is not None:
+            self.callback(profile)
+
+
+class MqlCostModel(object):
+
+    """Weights used to estimate how expensive filters are to run.
+
+    The cost of a set of filters is the sum of:
+
+    * A weight for each comparison, taken from ``op_weights``, or
+      ``comparison`` for ops not found there.
+    * ``in_value`` for each value in an ``$in`` or ``$nin`` list.
+    * A weight for each ``$and``, ``$or``, ``$not``, or ``$nor``, taken
+      from ``op_weights``, or ``logical`` for ops not found there.
+    * ``relation`` for each many to one relationship sub query, or
+      ``collection_relation`` for each relationship sub query that may
+      match many records.
+
+    Set :attr:`MqlBuilder.cost_model` to use different weights.
+
+    """
+
+    logical_ops = frozenset(["$and", "$or", "$not", "$nor"])
+
+    def __init__(self, comparison=1.0, logical=0.0, in_value=0.1,
+                 relation=5.0, collection_relation=20.0, op_weights=None):
+        """Initializes a new cost model.
+
+        :param float comparison: Default weight for a comparison.
+        :param float logical: Default weight for a logical op.
+        :param float in_value: Weight for each ``$in`` or ``$nin``
+            value.
+        :param float relation: Weight for a sub query on a many to one
+            relationship.
+        :param float collection_relation: Weight for a sub query on a
+            one to many or many to many relationship.
+        :param op_weights: Weights keyed by op, overriding
+            ``comparison`` or ``logical``. Defaults to a weight of
+            ``5.0`` for ``$like`` and ``2.0`` for ``$mod``.
+        :type op_weights: dict or None
+
+        """
+        self.comparison = comparison
+        self.logical = logical
+        self.in_value = in_value
+        self.relation = relation
+        self.collection_relation = collection_relation
+        if op_weights is None:
+            op_weights = {"$like": 5.0, "$mod": 2.0}
+        self.op_weights = op_weights
+
+    def op_cost(self, op, value):
+        """Get the cost of an op.
+
+        :param str op: An operator starting with ``"$"``.
+        :param value: The user supplied value for the provided ``op``.
+        :return: The cost of ``op``.
+        :rtype: float
+
+        """
+        if op in self.logical_ops:
+            return self.op_weights.get(op, self.logical)
+        cost = self.op_weights.get(op, self.comparison)
+        if (op == "$in" or op == "$nin") and isinstance(value, list):
+            cost += self.in_value * len(value)
+        return cost
+
+    def relation_cost(self, relation_property):
+        """Get the cost of a sub query on a relationship.
+
+        :param relation_property: The relationship's
+            :class:`~sqlalchemy.orm.RelationshipProperty`.
+        :return: The cost of the sub query.
+        :rtype: float
+
+        """
+        if relation_property.uselist:
+            return self.collection_relation
+        return self.relation
+
+
+class MqlCost(object):
+
+    """The running cost of filters being parsed, limited to a budget.
+
+    Pass to :meth:`MqlBuilder.parse_mql_filters` or
+    :meth:`MqlBuilder.apply_mql_filters` as ``cost``, then read the
+    total from :attr:`cost` afterwards, e.g. for rate limiting:
+
+    .. code-block:: python
+
+        cost = MqlCost(max_cost=100)
+        stmt = MqlBuilder.apply_mql_filters(
+            Album, filters=filters, cost=cost)
+        rate_limiter.consume(user, cost.cost)
+
+    Costs are estimated using a :class:`MqlCostModel`. Each cost is
+    checked against ``max_cost`` before the comparison or sub query it
+    belongs to is built, so parsing stops at the first part of the
+    filters that goes over budget.
+
+    A new instance should be used for each set of filters.
+
+    """
+
+    def __init__(self, max_cost=None, cost_model=None):
+        """Initializes a new cost.
+
+        :param max_cost: Optional budget that, if exceeded, causes
+            :class:`MqlTooComplex` to be raised.
+        :type max_cost: int, float, or None
+        :param cost_model: Weights used to estimate costs. Defaults to
+            the ``cost_model`` of the builder class used.
+        :type cost_model: :class:`MqlCostModel` or None
+
+        """
+        self.max_cost = max_cost
+        self.cost_model = cost_model
+        #: Estimated cost of the filters parsed so far.
+        self.cost = 0.0
+
+    def add(self, amount, gettext=None):
+        """Add to the running cost.
+
+        :param float amount: Cost to add.
+        :param callable gettext: Used for translating error messages
+            if applicable.
+        :raise MqlTooComplex: If the new cost is over ``max_cost``.
+
+        """
+        self.cost += amount
+        if self.max_cost is not None and self.cost > self.max_cost:
+            _ = gettext or dummy_gettext
+            raise MqlTooComplex(_("This query is too complex."))
+
+
+class MqlLoadPlan(object):
+
+    """Plan for eagerly loading the relationships of query results.
+
+    Pass one as the ``load_plan`` to
+    :meth:`MqlBuilder.apply_mql_filters`, and any relationships that
+    are filtered on or projected are eagerly loaded, avoiding a lazy
+    load for each result when they're accessed later. By default
+    collections are loaded using ``selectin`` loading, and many to one
+    relationships using ``joined`` loading. Afterwards, :attr:`paths`
+    reports how each relationship is loaded.
+
+    .. code-block:: python
+
+        load_plan = MqlLoadPlan(strategies={"tracks.playlists": "lazy"})
+        stmt = MqlBuilder.apply_mql_filters(
+            Album, filters={"tracks.playlists.name": "Grunge"},
+            load_plan=load_plan)
+        # {"tracks": "selectin", "tracks.playlists": "lazy"}
+        print(load_plan.paths)
+
+    Use a new plan for each query.
+
+    """
+
+    #: Loader option functions for each strategy. ``"lazy"`` leaves a
+    #: relationship to be loaded when it's accessed.
+    loaders = {
+        "selectin": selectinload,
+        "joined": joinedload,
+        "subquery": subqueryload,
+        "lazy": lazyload
+    }
+
+    def __init__(self, collection_strategy="selectin",
+                 scalar_strategy="joined", strategies=None):
+        """Initializes a new plan.
+
+        :param str collection_strategy: Strategy for relationships that
+            refer to a collection.
+        :param str scalar_strategy: Strategy for relationships that
+            refer to a single object, e.g. many to one.
+        :param strategies: Optional dict of dot separated relationship
+            paths, as converted attr names, to the strategy to use for
+            that path, overriding the defaults.
+        :type strategies: dict or None
+        :raise ValueError: If an unknown strategy is given.
+
+        """
+        self.collection_strategy = collection_strategy
+        self.scalar_strategy = scalar_strategy
+        self.strategies = dict(strategies or {})
+        for strategy in ([collection_strategy, scalar_strategy] +
+                         list(self.strategies.values())):
+            if strategy not in self.loaders:
+                raise ValueError("Unknown load strategy: %s" % strategy)
+        #: Dict of each planned relationship path to the strategy used.
+        self.paths = {}
+
+    @property
+    def round_trips(self):
+        """Queries expected to run for the results, including the main one.
+
+        Each ``selectin`` or ``subquery`` loaded path adds a query,
+        while ``joined`` paths are loaded along with their parent.
+        ``selectin`` loading may use more than one query for very large
+        numbers of results, and ``lazy`` paths aren't counted.
+
+        """
+        return 1 + sum(
+            1 for strategy in self.paths.values()
+            if strategy in ("selectin", "subquery"))
+
+    def get_strategy(self, path, relation_property):
+        """Get the strategy to load a relationship path with.
+
+        :param str path: Dot separated relationship path.
+        :param relation_property: The relationship's
+            :class:`~sqlalchemy.orm.RelationshipProperty`.
+        :return: The name of a strategy in :attr:`loaders`.
+        :rtype: str
+
+        """
+        strategy = self.strategies.get(path)
+        if strategy is None:
+            if relation_property.uselist:
+                strategy = self.collection_strategy
+            else:
+                strategy = self.scalar_strategy
+        return strategy
+
+    def get_loader(self, path, attr):
+        """Get a loader option for a relationship path, and record it.
+
+        :param str path: Dot separated relationship path.
+        :param attr: The relationship attribute.
+        :return: A loader option for ``attr``.
+
+        """
+        strategy = self.get_strategy(path, attr.property)
+        self.paths[path] = strategy
+        return self.loaders[strategy](attr)
+
+
+class MqlBuilder(object):
+
+    """Class for building queries using MQL style filters."""
+
+    # Default types used for converting user input into
+    # SQLAlchemy friendly data.
+    # Will need to override these and :meth:`convert_to_alchemy_type`
+    # if wanting to use db vendor specific data types, or anything more
+    # complex than the primitive types included here.
+    # Subclasses of these types are converted the same way. Converters
+    # are looked up from these lists once per type and then cached.
+    text_types = [String, Unicode, Enum, Text, UnicodeText, CHAR, CLOB, NCHAR,
+                  NVARCHAR, TEXT, VARCHAR]
+    int_types = [Integer, BigInteger, SmallInteger, BIGINT, INT, INTEGER,
+                 SMALLINT]
+    bool_types = [Boolean, BOOLEAN]
+    date_types = [Date, DATE]
+    datetime_types = [DateTime, DATETIME, TIMESTAMP]
+    float_types = [Float, Numeric, DECIMAL, FLOAT, NUMERIC, REAL]
+    time_types = [Time, TIME]
+
+    # Optional :class:`MqlPlanCache`. When set, :meth:`parse_mql_filters`
+    # will reuse compiled plans for filters with a previously seen
+    # shape, rather than parsing them from scratch each time.
+    plan_cache = None
+
+    # Optional max number of values in an ``$in`` or ``$nin`` list that
+    # will be sent as a regular, expanding ``IN`` clause. Larger lists
+    # use :attr:`large_in_strategy`, see
+    # :meth:`_generate_large_in_expression` for the options. Ignored
+    # when values are only bound at execution time, see
+    # :meth:`MqlFilterPlan.apply`.
+    large_in_threshold = None
+    large_in_strategy = "json_each"
+
+    # If ``True``, sibling filters on the same one to many or many to
+    # many relationship, e.g. ``{"tracks.name": "x", "tracks.bytes": 5}``,
+    # must match the same related record, as if they were given in a
+    # single ``$elemMatch``. Sibling filters on a many to one
+    # relationship are always combined, as there's only one related
+    # record for them to match.
+    merge_relation_filters = False
+
+    # Weights used to estimate the cost of filters, when parsed with an
+    # :class:`MqlCost`.
+    cost_model = MqlCostModel()
+
+    # Optional :class:`MqlProfiler`. When set, timings and counters are
+    # recorded each time filters are parsed.
+    profiler = None
+
+    # Optional :class:`MqlCountCache`. When set, exact counts from
+    # :meth:`count_mql_filters` are cached.
+    count_cache = None
+
+    # Optional :class:`MqlResultCache`. When set, results from
+    # :meth:`execute_mql_filters` are cached.
+    result_cache = None
+
+    # If ``True``, filters are simplified by :meth:`normalize_mql_filters`
+    # before they're parsed.
+    normalize_filters = False
+
+    # If ``True``, filters are parsed by :meth:`_parse_frames`, which
+    # tracks its position using typed frames rather than marker strings
+    # and parallel name stacks. Results and errors are the same as the
+    # default parser.
+    frame_parser = False
+
+    # If ``True``, :meth:`paginate_mql_filters` compares sort columns
+    # using a row value, e.g. ``(a, b) > (:a, :b)``, when they're all
+    # sorted in the same direction. Set to ``False`` for databases
+    # without row value comparisons, such as SQL Server, to always use
+    # the equivalent ``a > :a OR (a = :a AND b > :b)`` instead.
+    keyset_row_values = True
+
+    # Converters found by :meth:`_get_converter`, keyed by alchemy type.
+    _converters = {}
+
+    def __init_subclass__(cls, **kwargs):
+        """Give each subclass its own cache of type converters.
+
+        Subclasses may override any of the ``*_types`` lists, so they
+        can't share converters found for their parent class.
+
+        """
+        super(MqlBuilder, cls).__init_subclass__(**kwargs)
+        cls._converters = {}
+
+    @classmethod
+    def get_schema_index(cls, model_class):
+        """Get the shared attribute path index for a model class.
+
+        :param model_class: A SQLAlchemy model class.
+        :return: The index for ``model_class``, created if needed.
+        :rtype: :class:`MqlSchemaIndex`
+
+        """
+        try:
+            return _schema_indexes[model_class]
+        except KeyError:
+            schema_index = MqlSchemaIndex(model_class)
+            _schema_indexes[model_class] = schema_index
+            return schema_index
+
+    @classmethod
+    def warm_up(cls, model_classes, max_depth=2):
+        """Build the attribute path index for model classes up front.
+
+        Indexes are otherwise built lazily as paths are used. To warm
+        up every model in a declarative base at app startup:
+
+        .. code-block:: python
+
+            MqlBuilder.warm_up(
+                [mapper.class_ for mapper in Base.registry.mappers])
+
+        :param model_classes: Iterable of SQLAlchemy model classes.
+        :param int max_depth: Maximum number of relationships to follow
+            away from each model class.
+        :return: The total number of paths resolved.
+        :rtype: int
+
+        """
+        count = 0
+        for model_class in model_classes:
+            count += cls.get_schema_index(model_class).warm_up(max_depth)
+        return count
+
+    @classmethod
+    def _generate_expressions(cls, op, value, attr, target_type, full_data_key,
+                              gettext):
+        """Generate a filter expression on an attr for an op and value.
+
+        :param str op: An operator starting with ``"$"``.
+        :param value: The user supplied value for the provided ``op``.
+        :param attr: The attribute of the model being filtered by.
+        :param target_type: Python data type the provided ``value`` will
+            attempt to be converted into.
+        :param full_data_key: Full dot separated path to the attribute
+            being queried, as supplied by the user. Used for error
+            message generation.
+        :param callable gettext: Used for translating error messages
+            if applicable.
+        :return: A SQLAlchemy expression for filtering.
+
+        """
+        _ = gettext
+        if isinstance(value, _MqlBindSlot):
+            # compiling a plan, generate a recipe for future values.
+            return _MqlPlanLeaf(
+                index=value.index,
+                generate=functools.partial(
+                    cls._generate_expressions, op, attr=attr,
+                    target_type=target_type, full_data_key=full_data_key,
+                    gettext=gettext),
+                expression=cls._generate_bound_expressions(
+                    op, value, attr, target_type, full_data_key, gettext)
+            )
+        in_values = None
+        try:
+            if op == "$lt":
+                expression = attr < cls.convert_to_alchemy_type(
+                    value, target_type)
+            elif op == "$lte":
+                expression = attr <= cls.convert_to_alchemy_type(
+                    value, target_type)
+            elif op == "$eq":
+                expression = attr == cls.convert_to_alchemy_type(
+                    value, target_type)
+            elif op == "$ne":
+                expression = attr != cls.convert_to_alchemy_type(
+                    value, target_type)
+            elif op == "$gte":
+                expression = attr >= cls.convert_to_alchemy_type(
+                    value, target_type)
+            elif op == "$gt":
+                expression = attr > cls.convert_to_alchemy_type(
+                    value, target_type)
+            elif op == "$like":
+                expression = attr.like(
+                    "%" + str(value) + "%")
+            elif op == "$in" or op == "$nin":
+                if not isinstance(value, list):
+                    raise MqlFieldError(
+                        data_key=full_data_key,
+                        op=op,
+                        filters=value,
+                        message=_("$in and $nin values must "
+                                  "be a list."),
+                        code="invalid_in_comp"
+                    )
+                in_values = cls.convert_list_to_alchemy_type(
+                    value, target_type)
+                if (cls.large_in_threshold is None or
+                        len(in_values) <= cls.large_in_threshold):
+                    expression = attr.in_(in_values)
+                    in_values = None
+                if op == "$nin" and in_values is None:
+                    expression = sqlalchemy.not_(expression)
+            elif op == "$mod":
+                if target_type not in cls.int_types:
+                    raise MqlFieldError(
+                        data_key=full_data_key,
+                        op=op,
+                        filters=value,
+                        message=_("$mod may only be used on integer fields."),
+                        code="invalid_op"
+                    )
+                divider, result = cls._convert_mod_values(
+                    value, full_data_key, _)
+                expression = (
+                        attr.op("%")(divider) == result)
+            elif op == "$exists":
+                exists = cls.convert_to_alchemy_type(value, target_type)
+                if isinstance(attr.property, RelationshipProperty):
+                    if not attr.property.uselist:
+                        expression = attr.has() if exists else ~attr.has()
+                    else:
+                        expression = attr.any() if exists else ~attr.any()
+                else:
+                    expression = ~attr.is_(None) if exists else attr.is_(None)
+            else:
+                raise MqlFieldError(
+                    data_key=full_data_key,
+                    filters=value,
+                    op=op,
+                    message=_("Invalid operator."),
+                    code="invalid_op"
+                )
+        except (TypeError, ValueError):
+            raise MqlFieldError(
+                data_key=full_data_key,
+                filters=value,
+                op=op,
+                message=_("Unable to convert provided data to the proper "
+                          "type for this field."),
+                code="data_conversion_error"
+            )
+        if in_values is not None:
+            # Generated outside of the conversion error handling, as a
+            # bad large_in_strategy is a configuration error.
+            expression = cls._generate_large_in_expression(attr, in_values)
+            if op == "$nin":
+                expression = sqlalchemy.not_(expression)
+        return expression
+
+    @classmethod
+    def _generate_large_in_expression(cls, attr, values):
+        """Generate an ``$in`` expression for a large list of values.
+
+        Uses the approach set by :attr:`large_in_strategy`:
+
+        * ``"json_each"`` - ``attr IN (SELECT value FROM json_each(:v))``,
+          passing all values as a single JSON encoded parameter. This
+          avoids driver limits on the number of parameters in a
+          statement. Requires SQLite. Lists with values that don't map
+          directly to JSON, such as dates, use a regular ``IN`` clause.
+        * ``"array"`` - ``attr = ANY(:values)``, passing all values as a
+          single array parameter. Requires a database with array
+          support, such as PostgreSQL.
+
+        :param attr: The attribute of the model being filtered by.
+        :param list values: Values already converted for ``attr``.
+        :raise ValueError: If :attr:`large_in_strategy` is unknown.
+        :return: A SQLAlchemy expression for filtering.
+
+        """
+        if cls.large_in_strategy == "json_each":
+            if all(value is None or type(value) in _json_types
+                   for value in values):
+                json_values = sqlalchemy.func.json_each(
+                    sqlalchemy.literal(json.dumps(values), String)
+                ).table_valued("value")
+                return attr.in_(select(json_values.c.value))
+            return attr.in_(values)
+        elif cls.large_in_strategy == "array":
+            return attr == sqlalchemy.any_(
+                sqlalchemy.literal(values, ARRAY(attr.type)))
+        raise ValueError(
+            "Unknown large_in_strategy: %s" % cls.large_in_strategy)
+
+    @classmethod
+    def _generate_bound_expressions(cls, op, slot, attr, target_type,
+                                    full_data_key, gettext):
+        """Generate a filter expression using a bound parameter.
+
+        Used when compiling a :class:`MqlFilterPlan`. Rather than
+        converting a value, ``slot`` records how to convert values
+        supplied later on.
+
+        :param str op: An operator starting with ``"$"``.
+        :param slot: The :class:`_MqlBindSlot` standing in for a value.
+        :param attr: The attribute of the model being filtered by.
+        :param target_type: SQLAlchemy data type values will be
+            converted into.
+        :param full_data_key: Full dot separated path to the attribute
+            being queried, as supplied by the user.
+        :param callable gettext: Used for translating error messages
+            if applicable.
+        :return: A SQLAlchemy expression for filtering.
+
+        """
+        _ = gettext
+        if op in _COMPARISON_OPS:
+            param = sqlalchemy.bindparam(slot.key, type_=attr.type)
+            expression = _COMPARISON_OPS[op](attr, param)
+        elif op == "$like":
+            expression = attr.like(sqlalchemy.bindparam(slot.key))
+        elif op == "$in" or op == "$nin":
+            expression = attr.in_(
+                sqlalchemy.bindparam(slot.key, expanding=True))
+            if op == "$nin":
+                expression = sqlalchemy.not_(expression)
+        elif op == "$mod" and target_type in cls.int_types:
+            expression = (
+                attr.op("%")(sqlalchemy.bindparam(
+                    slot.key + "_divider", type_=Integer)) ==
+                sqlalchemy.bindparam(slot.key + "_result", type_=Integer))
+        elif op == "$mod":
+            raise MqlFieldError(
+                data_key=full_data_key,
+                op=op,
+                filters=slot,
+                message=_("$mod may only be used on integer fields."),
+                code="invalid_op"
+            )
+        else:
+            raise MqlFieldError(
+                data_key=full_data_key,
+                filters=slot,
+                op=op,
+                message=_("Invalid operator."),
+                code="invalid_op"
+            )
+        slot.attach(cls, op, target_type, full_data_key, gettext)
+        return expression
+
+    @classmethod
+    def _convert_operand(cls, op, value, target_type, full_data_key,
+                         gettext):
+        """Validate and convert a user supplied value for an op.
+
+        Used when filters are evaluated in memory rather than by the
+        database, with the same validation as
+        :meth:`_generate_expressions`.
+
+        See :meth:`_generate_expressions` for details on the parameters.
+
+        :return: The converted value. A list for ``$in`` and ``$nin``,
+            a ``(divider, result)`` tuple for ``$mod``, and a string for
+            ``$like``.
+
+        """
+        _ = gettext
+        try:
+            if op in _COMPARISON_OPS or op == "$exists":
+                return cls.convert_to_alchemy_type(value, target_type)
+            elif op == "$like":
+                return str(value)
+            elif op == "$in" or op == "$nin":
+                if not isinstance(value, list):
+                    raise MqlFieldError(
+                        data_key=full_data_key,
+                        op=op,
+                        filters=value,
+                        message=_("$in and $nin values must "
+                                  "be a list."),
+                        code="invalid_in_comp"
+                    )
+                return cls.convert_list_to_alchemy_type(value, target_type)
+            elif op == "$mod":
+                if target_type not in cls.int_types:
+                    raise MqlFieldError(
+                        data_key=full_data_key,
+                        op=op,
+                        filters=value,
+                        message=_("$mod may only be used on integer fields."),
+                        code="invalid_op"
+                    )
+                return cls._convert_mod_values(value, full_data_key, _)
+        except (TypeError, ValueError):
+            raise MqlFieldError(
+                data_key=full_data_key,
+                filters=value,
+                op=op,
+                message=_("Unable to convert provided data to the proper "
+                          "type for this field."),
+                code="data_conversion_error"
+            )
+        raise MqlFieldError(
+            data_key=full_data_key,
+            filters=value,
+            op=op,
+            message=_("Invalid operator."),
+            code="invalid_op"
+        )
+
+    @classmethod
+    def _generate_predicate(cls, op, value, attr, target_type, full_data_key,
+                            gettext):
+        """Generate an in memory predicate on an attr for an op and value.
+
+        The in memory equivalent of :meth:`_generate_expressions`.
+        Values of the object being checked are converted to
+        ``target_type`` when they aren't already of the proper type.
+
+        See :meth:`_generate_expressions` for details on the parameters.
+
+        :return: A callable taking a model instance or dict and
+            returning ``True``, ``False``, or ``None`` if the result is
+            unknown, as comparisons with a SQL ``NULL`` would be.
+
+        """
+        key = attr.key
+        operand = cls._convert_operand(
+            op, value, target_type, full_data_key, gettext)
+        if op in _COMPARISON_OPS:
+            get_value = cls._get_predicate_getter(key, target_type)
+            if operand is None:
+                # comparisons with null are only meaningful for
+                # equality, which becomes IS NULL or IS NOT NULL.
+                if op == "$eq":
+                    return lambda obj: get_value(obj) is None
+                elif op == "$ne":
+                    return lambda obj: get_value(obj) is not None
+                return lambda obj: None
+            compare = _COMPARISON_OPS[op]
+
+            def predicate(obj):
+                obj_value = get_value(obj)
+                if obj_value is None:
+                    return None
+                try:
+                    return compare(obj_value, operand)
+                except TypeError:
+                    return None
+        elif op == "$like":
+            search = _compile_like(operand).search
+
+            def predicate(obj):
+                obj_value = (obj.get(key) if type(obj) is dict
+                             else getattr(obj, key, None))
+                if obj_value is None:
+                    return None
+                return search(str(obj_value)) is not None
+        elif op == "$in" or op == "$nin":
+            get_value = cls._get_predicate_getter(key, target_type)
+            # a null in the list makes a non match unknown
+            not_found = None if None in operand else False
+            try:
+                in_values = frozenset(operand)
+            except TypeError:
+                in_values = operand
+            is_in = op == "$in"
+
+            def predicate(obj):
+                obj_value = get_value(obj)
+                if obj_value is None:
+                    return None
+                try:
+                    found = obj_value in in_values
+                except TypeError:
+                    return None
+                if found:
+                    return is_in
+                elif not_found is None:
+                    return None
+                return not is_in
+        elif op == "$mod":
+            divider, result = operand
+            get_value = cls._get_predicate_getter(key, target_type)
+
+            def predicate(obj):
+                obj_value = get_value(obj)
+                if obj_value is None or divider == 0:
+                    return None
+                # SQL's % truncates towards zero, unlike Python's.
+                remainder = abs(obj_value) % abs(divider)
+                if obj_value < 0:
+                    remainder = -remainder
+                return remainder == result
+        else:
+            # $exists
+            uselist = (isinstance(attr.property, RelationshipProperty) and
+                       attr.property.uselist)
+
+            def predicate(obj):
+                obj_value = (obj.get(key) if type(obj) is dict
+                             else getattr(obj, key, None))
+                if uselist:
+                    return bool(obj_value) == operand
+                return (obj_value is not None) == operand
+        return predicate
+
+    @classmethod
+    def _get_predicate_getter(cls, key, target_type):
+        """Get a function that gets a converted value from an object.
+
+        :param str key: Name of the attribute to get.
+        :param target_type: SQLAlchemy type the value should be
+            converted to.
+        :return: A callable taking a model instance or dict and
+            returning its value for ``key``. Values that can't be
+            converted are returned as is.
+
+        """
+        python_type = _converter_python_types.get(
+            cls._get_converter(target_type))
+
+        def get_value(obj):
+            value = (obj.get(key) if type(obj) is dict
+                     else getattr(obj, key, None))
+            if value is None or type(value) is python_type:
+                return value
+            try:
+                return cls.convert_to_alchemy_type(value, target_type)
+            except (TypeError, ValueError):
+                return value
+        return get_value
+
+    @classmethod
+    def _generate_mask(cls, op, value, attr, target_type, full_data_key,
+                       gettext):
+        """Generate a vectorized filter on a column for an op and value.
+
+        The columnar equivalent of :meth:`_generate_predicate`.
+
+        See :meth:`_generate_expressions` for details on the parameters.
+
+        :return: A callable taking a :class:`_MqlColumnBatch` and
+            returning a ``(true, false)`` tuple of boolean NumPy arrays.
+            Rows where the result is unknown, as comparisons with a
+            SQL ``NULL`` would be, are in neither.
+
+        """
+        _ = gettext
+        if isinstance(attr.property, RelationshipProperty):
+            raise MqlFieldError(
+                data_key=full_data_key,
+                op=op,
+                filters=value,
+                code="invalid_relation_filter",
+                message=_(
+                    "Relationships can't be filtered using columnar data.")
+            )
+        key = attr.key
+        operand = cls._convert_operand(
+            op, value, target_type, full_data_key, gettext)
+
+        def convert(column_value):
+            return cls.convert_to_alchemy_type(column_value, target_type)
+        python_type = _converter_python_types.get(
+            cls._get_converter(target_type))
+        if op in _COMPARISON_OPS:
+            compare = _COMPARISON_OPS[op]
+
+            def mask(batch):
+                values, nulls = batch.get(key, convert, python_type)
+                if operand is None:
+                    if op == "$eq":
+                        return nulls, ~nulls
+                    elif op == "$ne":
+                        return ~nulls, nulls
+                    return batch.unknown()
+                try:
+                    return batch.apply(
+                        values, nulls, lambda present: compare(
+                            present, operand))
+                except TypeError:
+                    return batch.unknown()
+        elif op == "$like":
+            search = _compile_like(operand).search
+            needle = operand.lower()
+            if "%" in operand or "_" in operand:
+                def match(present):
+                    return numpy.fromiter(
+                        (search(str(present_value)) is not None
+                         for present_value in present),
+                        dtype=bool, count=len(present))
+            else:
+                def match(present):
+                    return numpy.char.find(numpy.char.lower(
+                        present.astype(str)), needle) >= 0
+
+            def mask(batch):
+                values, nulls = batch.get(key, None, None)
+                return batch.apply(values, nulls, match)
+        elif op == "$in" or op == "$nin":
+            in_values = [
+                in_value for in_value in operand if in_value is not None]
+            has_null = len(in_values) != len(operand)
+            try:
+                in_set = frozenset(in_values)
+            except TypeError:
+                in_set = in_values
+
+            def match(present):
+                if present.dtype.kind == "O":
+                    return numpy.fromiter(
+                        (present_value in in_set
+                         for present_value in present),
+                        dtype=bool, count=len(present))
+                return numpy.isin(present, in_values)
+
+            def mask(batch):
+                values, nulls = batch.get(key, convert, python_type)
+                try:
+                    true, false = batch.apply(values, nulls, match)
+                except TypeError:
+                    return batch.unknown()
+                if has_null:
+                    # a null in the list makes a non match unknown
+                    false = numpy.zeros(batch.size, dtype=bool)
+                if op == "$nin":
+                    return false, true
+                return true, false
+        elif op == "$mod":
+            divider, result = operand
+
+            def mask(batch):
+                values, nulls = batch.get(key, convert, python_type)
+                if divider == 0:
+                    return batch.unknown()
+                return batch.apply(
+                    values, nulls, lambda present: numpy.fmod(
+                        present.astype(numpy.int64), divider) == result)
+        else:
+            # $exists
+            def mask(batch):
+                values, nulls = batch.get(key, None, None)
+                if operand:
+                    return ~nulls, nulls
+                return nulls, ~nulls
+        return mask
+
+    @classmethod
+    def _convert_mod_values(cls, value, full_data_key, gettext):
+        """Convert a user supplied $mod value into a divider and result.
+
+        :param value: The user supplied value for a ``$mod`` op.
+        :param full_data_key: Full dot separated path to the attribute
+            being queried, as supplied by the user.
+        :param callable gettext: Used for translating error messages
+            if applicable.
+        :raises MqlFieldError: If ``value`` isn't a list of two ints.
+        :return: A tuple of the divider and expected result.
+        :rtype: tuple
+
+        """
+        _ = gettext
+        if (isinstance(value, list) and
+                len(value) == 2):
+            try:
+                divider = int(value[0])
+                if int(value[0]) != value[0]:
+                    raise TypeError(
+                        "Decimal provided "
+                        "instead of int.")
+                result = int(value[1])
+                if int(value[1]) != value[1]:
+                    raise TypeError(
+                        "Decimal provided "
+                        "instead of int.")
+            except (TypeError, ValueError):
+                raise MqlFieldError(
+                    data_key=full_data_key,
+                    op="$mod",
+                    filters=value,
+                    message=_(
+                        "Non int $mod value supplied"),
+                    code="invalid_mod_values"
+                )
+            return divider, result
+        raise MqlFieldError(
+            data_key=full_data_key,
+            filters=value,
+            op="$mod",
+            message=_("$mod value must be list of "
+                      "two integers."),
+            code="invalid_mod_values"
+        )
+
+    @classmethod
+    def apply_mql_filters(cls, model_class, query=None, filters=None, 
+                          whitelist=None, nested_conditions=None,
+                          stack_size_limit=None, convert_key_names_func=None,
+                          gettext=None, relation_strategy="exists",
+                          cost=None, sort=None, projection=None,
+                          load_plan=None, relations=None):
+        """Applies filters to a select statement and returns it.
+
+        Bulk of the work here is done by :meth:`parse_filters`, more
+        detailed documentation can be found there.
+
+        :param model_class: SQLAlchemy model class you want to query.
+        :type model_class: :class:`~sqlalchemy.orm.DeclarativeMeta` or
+            :class:`~sqlalchemy.orm.util.AliasedClass`
+        :param query: A select statement that directly references
+            the provided `model_class`. Optional, useful if there
+            are already some set of filters previously applied.
+        :type query: :class:`~sqlalchemy.sql.selectable.Select`
+        :param dict filters: Dictionary of MongoDB style query filters.
+        :param whitelist: Used to determine whether it's permissible to
+            filter by a given field.
+            The field being checked will be a dot notation attr name
+            (e.g. for Album ``tracks.playlists.playlist_id``) that has
+            already been processed by ``convert_key_names_func`` when
+            applicable.
+            If a callable is provided, it should take in a dot separated
+            field name and return ``True`` if it is acceptable to query
+            that field, or ``False`` if not.
+            If a list of field names is provided, field names will be
+            checked against that list to determine whether or not it
+            is an allowed field to be queried. Tuples, sets, and a
+            precompiled :class:`MqlWhitelist` are also accepted.
+            If ``None`` is provided, all fields and relationships of a
+            model will be queryable.
+        :type whitelist: callable, list, MqlWhitelist, or None
+        :param nested_conditions: Provides SQL expressions, as would be
+            used directly by :meth:`~sqlalchemy.orm.query.Query.filter`,
+            for additional filtering on any nested relationships. Can be
+            a callable accepting a single param, or a dict, where the
+            param/key is the relationship being filtered will be
+            provided as a dot notation name (e.g. for Album
+            ``tracks.playlists``) that has already been processed by
+            ``convert_key_names_func`` when applicable. The value
+            returned can be a single item, list, or tuple.
+        :param nested_conditions: callable, dict, or None
+        :param convert_key_names_func: Optional function used to convert
+            a user provided attribute name into a field name for a model.
+            Should take one parameter, which is a dot separated name,
+            and should return a converted string in the same dot
+            separated format. For example, say you want to be able to
+            query your model, which contains field names with
+            underscores, using lowerCamelCase instead. The provided
+            function should take a string such as ``"tracks.unitPrice"``
+            and convert it to ``"tracks.unit_price"``. For the sake of
+            raising more useful exceptions, the function should return
+            ``None`` if an invalid field name is provided, however this
+            is not necessary.
+        :type convert_key_names_func: callable
+        :param stack_size_limit: Optional parameter used to limit the
+            allowable complexity of the provided filters. Can be useful
+            in preventing malicious query attempts.
+        :type stack_size_limit: int or None
+        :param gettext: Supply a translation function to convert error
+            messages to the desired language. Note that no translations
+            are included by default, you must generate your own.
+        :type gettext: callable or None
+        :param str relation_strategy: How filters on relationships are
+            applied.
+            ``"exists"`` uses a correlated ``EXISTS`` sub query for each
+            relationship, via ``.any()`` or ``.has()``.
+            ``"join"`` instead joins many to one relationships to the
+            query, using one aliased join per relationship path, as
+            long as the relationship isn't nested in an ``$or``,
+            ``$not``, ``$nor``, or another sub query, and has no
+            ``nested_conditions``. Other relationships use ``"exists"``.
+            ``"semi_join_in"`` uses an uncorrelated
+            ``local_col IN (SELECT remote_col ...)`` sub query for
+            relationships with a single foreign key column and no
+            secondary table. Other relationships use ``"exists"``.
+        :param cost: Optional :class:`MqlCost` used to estimate the
+            cost of the filters, and limit it to a budget.
+        :type cost: :class:`MqlCost` or None
+        :param sort: Optional MongoDB style sort, as a dict of field
+            names to ``1`` for ascending or ``-1`` for descending order,
+            or a list of ``(field_name, direction)`` pairs. Field names
+            are converted with ``convert_key_names_func`` and checked
+            against the ``whitelist`` in the same way as filters, and
+            must refer to columns of ``model_class``.
+        :type sort: dict, list, or None
+        :param projection: Optional MongoDB style projection, limiting
+            which fields are loaded. See :meth:`get_projection_options`.
+        :type projection: dict, list, or None
+        :param load_plan: Optional :class:`MqlLoadPlan` used to eagerly
+            load the relationships that are filtered on or projected,
+            which afterwards reports how each one is loaded.
+        :type load_plan: :class:`MqlLoadPlan` or None
+        :param relations: Optional set that the dot separated paths of
+            any relationships filtered on are added to.
+        :type relations: set or None
+        :raise ValueError: If an unknown ``relation_strategy`` is given.
+        :raise MqlFieldError: If an invalid sort or projection is given.
+        :raise MqlFieldPermissionError: If a sort or projection field
+            isn't whitelisted.
+        :return: A filtered SQLAlchemy select object of the provided
+            `model_class`. If the filters are known to match everything
+            or nothing, e.g. after being normalized, the
+            ``"mqlalchemy_constant"`` execution option of the select is
+            set to ``True`` or ``False``, which execution helpers such
+            as :meth:`execute_mql_filters` use to skip the database.
+        :rtype: sqlalchemy.sql.selectable.Select
+
+        """
+        joins = []
+        if relations is None and load_plan is not None:
+            relations = set()
+        if relation_strategy == "exists":
+            expressions = cls.parse_mql_filters(
+                model_class=model_class,
+                filters=filters,
+                whitelist=whitelist,
+                nested_conditions=nested_conditions,
+                stack_size_limit=stack_size_limit,
+                convert_key_names_func=convert_key_names_func,
+                gettext=gettext,
+                cost=cost,
+                relations=relations
+            )
+        elif (relation_strategy == "join" or
+                relation_strategy == "semi_join_in"):
+            if cls.normalize_filters and filters is not None:
+                filters = cls.normalize_mql_filters(
+                    model_class, filters, convert_key_names_func)
+            expressions = cls._parse_mql_filters(
+                model_class=model_class,
+                filters=filters,
+                whitelist=whitelist,
+                nested_conditions=nested_conditions,
+                stack_size_limit=stack_size_limit,
+                convert_key_names_func=convert_key_names_func,
+                gettext=gettext,
+                relation_strategy=relation_strategy,
+                joins=joins,
+                cost=cost,
+                relations=relations
+            )
+        else:
+            raise ValueError(
+                "Unknown relation_strategy: %s" % relation_strategy)
+        if query is None:
+            query = select(model_class)
+        for onclause in joins:
+            query = query.join(onclause)
+        if expressions:
+            query = query.where(sqlalchemy.and_(*expressions))
+        constant = _get_constant(filters, expressions)
+        if constant is not None:
+            query = query.execution_options(mqlalchemy_constant=constant)
+        if sort:
+            query = query.order_by(*[
+                attr.desc() if descending else attr.asc()
+                for attr, descending in cls._parse_sort(
+                    model_class, sort, whitelist, convert_key_names_func,
+                    gettext, unique=False)])
+        if projection is not None or load_plan is not None:
+            query = query.options(*cls.get_projection_options(
+                model_class, projection, whitelist, convert_key_names_func,
+                gettext, load_plan, relations))
+        return query
+
+    @classmethod
+    def get_projection_options(cls, model_class, projection=None,
+                               whitelist=None, convert_key_names_func=None,
+                               gettext=None, load_plan=None, relations=None):
+        """Get loader options that load only the projected fields.
+
+        Projections work like those in MongoDB. Either every field is
+        ``1`` to include it, or ``0`` to exclude it, and a list of
+        field names may be given to include just those fields.
+
+        Included columns are loaded using
+        :func:`~sqlalchemy.orm.load_only`, along with primary key
+        columns and any foreign key columns needed for included
+        relationships. Included relationships, or relationships with
+        included fields such as ``"album.title"``, are eagerly loaded,
+        using :func:`~sqlalchemy.orm.selectinload` unless a
+        ``load_plan`` says otherwise, while any others aren't loaded
+        until accessed.
+
+        Excluded columns are deferred using
+        :func:`~sqlalchemy.orm.defer`, and excluded relationships aren't
+        loaded until accessed.
+
+        .. code-block:: python
+
+            stmt = select(Track).options(
+                *MqlBuilder.get_projection_options(
+                    Track, {"name": 1, "album.title": 1}))
+
+        To instead select plain rows of some columns, see the
+        ``columns`` param of :meth:`stream_mql_filters`.
+
+        :param model_class: SQLAlchemy model class being queried.
+        :param projection: A dict of dot separated field names to ``1``
+            or ``0``, or a list of field names to include. Field names
+            are converted with ``convert_key_names_func`` and checked
+            against the ``whitelist`` in the same way as filters.
+        :type projection: dict, list, or None
+        :param whitelist: See :meth:`apply_mql_filters`.
+        :param convert_key_names_func: See :meth:`apply_mql_filters`.
+        :param gettext: See :meth:`apply_mql_filters`.
+        :param load_plan: Optional :class:`MqlLoadPlan` that decides how
+            relationships are eagerly loaded, and records them.
+        :type load_plan: :class:`MqlLoadPlan` or None
+        :param relations: Optional dot separated relationship paths,
+            such as those found by :meth:`parse_mql_filters`, to also
+            eagerly load using ``load_plan``. Paths left out of an
+            including projection, or excluded by one, aren't loaded.
+        :type relations: set or None
+        :raise MqlFieldError: If an invalid projection is given.
+        :raise MqlFieldPermissionError: If a projection field isn't
+            whitelisted.
+        :return: A list of loader options, for use with
+            :meth:`~sqlalchemy.sql.expression.Select.options`.
+        :rtype: list
+
+        """
+        _ = gettext or dummy_gettext
+        if projection is None:
+            projection = []
+        elif isinstance(projection, dict):
+            projection = list(projection.items())
+        else:
+            projection = [(key, 1) for key in projection]
+        if convert_key_names_func is None:
+            def convert_key_names_func(x): return x
+        is_whitelisted = cls._get_whitelist_checker(model_class, whitelist)
+        schema_index = cls.get_schema_index(model_class)
+        include = None
+        # Each node is a dict of columns, a flag for whether every
+        # column is included or excluded, a flag for whether to eagerly
+        # load it, and any child relationships.
+        tree = _new_projection_node()
+        for key, value in projection:
+            if value not in (0, 1):
+                raise MqlFieldError(
+                    data_key=key,
+                    op=None,
+                    filters=value,
+                    code="invalid_projection",
+                    message=_("Projection values must be 1 or 0.")
+                )
+            if include is None:
+                include = bool(value)
+            elif include != bool(value):
+                raise MqlFieldError(
+                    data_key=key,
+                    op=None,
+                    filters=value,
+                    code="invalid_projection",
+                    message=_(
+                        "Projections can't both include and exclude "
+                        "fields.")
+                )
+            c_key = convert_key_names_func(key) if isinstance(
+                key, str) else None
+            try:
+                path_info = schema_index.resolve(c_key)
+            except (AttributeError, TypeError):
+                path_info = None
+            if (path_info is None or path_info.path != c_key or
+                    path_info.kind not in ("column", "relationship")):
+                raise MqlFieldError(
+                    data_key=key,
+                    op=None,
+                    filters=value,
+                    code="invalid_projection",
+                    message=_("Only columns and relationships can be "
+                              "projected.")
+                )
+            if not is_whitelisted(c_key):
+                raise MqlFieldPermissionError(
+                    data_key=key,
+                    op=None,
+                    filters=value,
+                    code="invalid_whitelist_permission",
+                    message=_(
+                        "Attempt made to project a field without proper "
+                        "permission.")
+                )
+            relation_attrs = path_info.attrs[1:]
+            column = None
+            if path_info.kind == "column":
+                relation_attrs, column = (
+                    relation_attrs[:-1], relation_attrs[-1])
+            node = tree
+            for attr in relation_attrs:
+                if attr.key not in node["relations"]:
+                    node["relations"][attr.key] = (
+                        attr, _new_projection_node())
+                node = node["relations"][attr.key][1]
+                node["load"] = include
+            if column is None:
+                node["all"] = True
+            else:
+                node["columns"].append(column)
+        if load_plan is not None and relations and not include:
+            for path in sorted(relations):
+                node = tree
+                for attr in schema_index.resolve(path).attrs[1:]:
+                    if attr.key not in node["relations"]:
+                        node["relations"][attr.key] = (
+                            attr, _new_projection_node())
+                    node = node["relations"][attr.key][1]
+                    if node["all"]:
+                        # excluded relationship.
+                        break
+                    node["load"] = True
+        if include:
+            return cls._get_include_options(model_class, tree, load_plan)
+        return cls._get_exclude_options(tree, load_plan)
+
+    @classmethod
+    def _get_include_options(cls, model_class, node, load_plan, path=""):
+        """Get loader options for a node of included fields.
+
+        :param model_class: Model class, or relationship target, the
+            node is for.
+        :param dict node: A node from :meth:`get_projection_options`.
+        :param load_plan: Optional :class:`MqlLoadPlan` used to load
+            relationships.
+        :param str path: Dot separated path of the node.
+        :return: A list of loader options.
+        :rtype: list
+
+        """
+        options = []
+        if not node["all"]:
+            mapper = inspect(model_class).mapper
+            attrs = list(node["columns"])
+            columns = list(mapper.primary_key)
+            for attr, _child in node["relations"].values():
+                columns.extend(attr.property.local_columns)
+            for column in columns:
+                prop = mapper.get_property_by_column(column)
+                attrs.append(getattr(model_class, prop.key))
+            options.append(load_only(*attrs))
+            options.append(lazyload("*"))
+        for attr, child in node["relations"].values():
+            child_path = path + attr.key
+            if load_plan is not None:
+                loader = load_plan.get_loader(child_path, attr)
+            else:
+                loader = selectinload(attr)
+            child_options = cls._get_include_options(
+                attr.property.mapper.class_, child, load_plan,
+                child_path + ".")
+            if child_options:
+                loader = loader.options(*child_options)
+            options.append(loader)
+        return options
+
+    @classmethod
+    def _get_exclude_options(cls, node, load_plan, path=""):
+        """Get loader options for a node of excluded fields.
+
+        :param dict node: A node from :meth:`get_projection_options`.
+        :param load_plan: Optional :class:`MqlLoadPlan` used to load
+            relationships marked to be loaded.
+        :param str path: Dot separated path of the node.
+        :return: A list of loader options.
+        :rtype: list
+
+        """
+        options = [defer(attr) for attr in node["columns"]]
+        for attr, child in node["relations"].values():
+            child_path = path + attr.key
+            if child["all"]:
+                options.append(lazyload(attr))
+                continue
+            if child["load"]:
+                loader = load_plan.get_loader(child_path, attr)
+            else:
+                loader = defaultload(attr)
+            child_options = cls._get_exclude_options(
+                child, load_plan, child_path + ".")
+            if child_options:
+                loader = loader.options(*child_options)
+            options.append(loader)
+        return options
+
+    @classmethod
+    def execute_mql_filters(cls, session, model_class, query=None,
+                            filters=None, whitelist=None,
+                            nested_conditions=None, stack_size_limit=None,
+                            convert_key_names_func=None, gettext=None,
+                            relation_strategy="exists", cost=None, sort=None,
+                            projection=None, load_plan=None, cache_key=None):
+        """Filter and execute a query.
+
+        .. code-block:: python
+
+            albums = MqlBuilder.execute_mql_filters(
+                db_session, Album, filters={"artist.name": "AC/DC"}).all()
+
+        When :attr:`result_cache` is set, filters are canonicalized
+        using :meth:`canonicalize_mql_filters`, so equivalent filters
+        share cached results. Results are cached as a
+        :class:`~sqlalchemy.engine.FrozenResult`, and merged into
+        ``session`` without loading them again when used. The tables
+        read by the query, including any joined or used in sub queries
+        of ``query``, and of any relationships projected or loaded by
+        ``load_plan``, are used to invalidate them. Filters are still
+        parsed each time, so permission errors are raised even if
+        results are cached.
+
+        If the filters are known to match nothing, see
+        :meth:`get_mql_filters_constant`, an empty result is returned
+        without running the query.
+
+        See :meth:`apply_mql_filters` for details on the other params.
+
+        :param session: A SQLAlchemy
+            :class:`~sqlalchemy.orm.session.Session`.
+        :param cache_key: Optional hashable value added to the
+            :attr:`result_cache` key, e.g. to tell apart results from
+            different databases.
+        :return: The result of the filtered query, with the first
+            entity selected for each row, e.g. instances of
+            ``model_class``.
+        :rtype: :class:`~sqlalchemy.engine.ScalarResult`
+
+        """
+        result_cache = cls.result_cache
+        relations = set() if result_cache is not None else None
+        if result_cache is not None and filters is not None:
+            filters = cls.canonicalize_mql_filters(filters)
+        stmt = cls.apply_mql_filters(
+            model_class=model_class,
+            query=query,
+            filters=filters,
+            whitelist=whitelist,
+            nested_conditions=nested_conditions,
+            stack_size_limit=stack_size_limit,
+            convert_key_names_func=convert_key_names_func,
+            gettext=gettext,
+            relation_strategy=relation_strategy,
+            cost=cost,
+            sort=sort,
+            projection=projection,
+            load_plan=load_plan,
+            relations=relations
+        )
+        if _is_empty_statement(stmt):
+            return _get_empty_result()
+        if result_cache is None:
+            return session.scalars(stmt)
+        if projection and convert_key_names_func is not None:
+            relations.update(
+                convert_key_names_func(key) for key in projection)
+        elif projection:
+            relations.update(projection)
+        key, tables = cls._get_result_cache_key(
+            model_class, stmt, filters, relations, projection, load_plan,
+            cache_key)
+        frozen_result = result_cache.get(key, tables)
+        if frozen_result is not None:
+            return merge_frozen_result(
+                session, stmt, frozen_result, load=False)().scalars()
+        versions = result_cache.get_versions(tables)
+        frozen_result = session.execute(stmt).freeze()
+        result_cache.set(key, tables, frozen_result, versions)
+        return frozen_result().scalars()
+
+    @classmethod
+    def _get_result_cache_key(cls, model_class, stmt, filters, paths,
+                              projection, load_plan, cache_key):
+        """Get the :attr:`result_cache` key and tables for a query.
+
+        :param model_class: SQLAlchemy model class being queried.
+        :param stmt: The filtered select statement.
+        :param filters: The canonicalized filters.
+        :param set paths: Dot separated paths that were filtered on or
+            projected, as converted attr names. Tables of these are
+            added to those found in ``stmt``, as relationships loaded
+            by options aren't part of it.
+        :param projection: The projection applied, if any.
+        :param load_plan: The :class:`MqlLoadPlan` applied, if any.
+        :param cache_key: Optional hashable value to add to the key.
+        :return: A tuple of the hashable key, and the tables read.
+        :rtype: tuple
+
+        """
+        paths = set(paths)
+        if load_plan is not None:
+            paths.update(load_plan.paths)
+        schema_index = cls.get_schema_index(model_class)
+        tables = set(inspect(model_class).mapper.tables)
+        for path in paths:
+            for attr in schema_index.resolve(path).attrs[1:]:
+                prop = getattr(attr, "property", None)
+                if isinstance(prop, RelationshipProperty):
+                    tables.update(prop.mapper.tables)
+                    if prop.secondary is not None:
+                        tables.add(prop.secondary)
+        compiled = stmt.compile()
+        # Tables from the statement as compiled, including joins and
+        # sub queries from a provided query, which paths don't cover.
+        compile_state = getattr(compiled, "compile_state", None)
+        tables.update(
+            table for table in find_tables(
+                getattr(compile_state, "statement", stmt),
+                include_joins=True)
+            if isinstance(table, Table))
+        params = tuple(sorted(
+            (name, _freeze_value(value))
+            for name, value in compiled.params.items()))
+        key = (
+            cls.hash_mql_filters(filters) if filters is not None else None,
+            str(compiled), params, _freeze(projection),
+            _freeze(load_plan.paths) if load_plan is not None else None,
+            cache_key)
+        return key, tables
+
+    @classmethod
+    def count_mql_filters(cls, session, model_class, query=None,
+                          filters=None, whitelist=None,
+                          nested_conditions=None, stack_size_limit=None,
+                          convert_key_names_func=None, gettext=None,
+                          relation_strategy="exists", cost=None, cap=None,
+                          estimate=False, cache_key=None):
+        """Count the results of a filtered query.
+
+        Only primary keys are selected to be counted, and any ordering,
+        limit, or offset of ``query`` is removed. Primary keys are only
+        counted distinctly if ``query`` contains joins, which might
+        duplicate rows.
+
+        .. code-block:: python
+
+            total = MqlBuilder.count_mql_filters(
+                db_session, Album, filters=filters, cap=10000)
+            if total > 10000:
+                total_text = "10,000+"
+
+        When :attr:`count_cache` is set, exact counts are cached.
+
+        See :meth:`apply_mql_filters` for details on the other params.
+
+        :param session: A SQLAlchemy
+            :class:`~sqlalchemy.orm.session.Session`.
+        :param cap: If provided, stop counting after ``cap + 1`` rows,
+            so a result greater than ``cap`` means there are more than
+            ``cap`` results.
+        :type cap: int or None
+        :param bool estimate: If ``True``, use the database's estimate
+            of the number of results where available, which currently
+            means the row estimate from ``EXPLAIN`` on PostgreSQL.
+            Other databases fall back to counting, subject to ``cap``.
+            Estimates aren't cached.
+        :param cache_key: Optional hashable value added to the
+            :attr:`count_cache` key, e.g. to tell apart counts from
+            different databases.
+        :return: The number of results.
+        :rtype: int
+
+        """
+        stmt = cls.apply_mql_filters(
+            model_class=model_class,
+            query=query,
+            filters=filters,
+            whitelist=whitelist,
+            nested_conditions=nested_conditions,
+            stack_size_limit=stack_size_limit,
+            convert_key_names_func=convert_key_names_func,
+            gettext=gettext,
+            relation_strategy=relation_strategy,
+            cost=cost
+        )
+        if _is_empty_statement(stmt):
+            return 0
+        stmt = cls._get_count_select(model_class, query, stmt)
+        if estimate:
+            if session.get_bind().dialect.name == "postgresql":
+                return _estimate_postgresql_count(session.connection(), stmt)
+        count_stmt = cls._get_count_statement(stmt, cap)
+        if cls.count_cache is None or cap is not None:
+            return session.execute(count_stmt).scalar()
+        key = _get_count_cache_key(count_stmt, cache_key)
+        count = cls.count_cache.get(key)
+        if count is None:
+            count = session.execute(count_stmt).scalar()
+            cls.count_cache.set(key, count)
+        return count
+
+    @classmethod
+    async def count_mql_filters_async(cls, session, model_class, query=None,
+                                      filters=None, whitelist=None,
+                                      nested_conditions=None,
+                                      stack_size_limit=None,
+                                      convert_key_names_func=None,
+                                      gettext=None,
+                                      relation_strategy="exists",
+                                      cost=None, offload=False,
+                                      executor=None, cap=None,
+                                      estimate=False, cache_key=None):
+        """Async version of :meth:`count_mql_filters`.
+
+        See :meth:`apply_mql_filters_async` and
+        :meth:`count_mql_filters` for details on the params.
+
+        :param session: A SQLAlchemy ``AsyncSession``.
+        :return: The number of results.
+        :rtype: int
+
+        """
+        stmt = await cls.apply_mql_filters_async(
+            model_class=model_class,
+            query=query,
+            filters=filters,
+            whitelist=whitelist,
+            nested_conditions=nested_conditions,
+            stack_size_limit=stack_size_limit,
+            convert_key_names_func=convert_key_names_func,
+            gettext=gettext,
+            relation_strategy=relation_strategy,
+            cost=cost,
+            offload=offload,
+            executor=executor
+        )
+        if _is_empty_statement(stmt):
+            return 0
+        stmt = cls._get_count_select(model_class, query, stmt)
+        if estimate:
+            if session.get_bind().dialect.name == "postgresql":
+                connection = await session.connection()
+                return await connection.run_sync(
+                    _estimate_postgresql_count, stmt)
+        count_stmt = cls._get_count_statement(stmt, cap)
+        if cls.count_cache is None or cap is not None:
+            return await session.scalar(count_stmt)
+        key = _get_count_cache_key(count_stmt, cache_key)
+        count = cls.count_cache.get(key)
+        if count is None:
+            count = await session.scalar(count_stmt)
+            cls.count_cache.set(key, count)
+        return count
+
+    @classmethod
+    def _get_count_select(cls, model_class, query, stmt):
+        """Select only the primary keys of a filtered query's results.
+
+        :param model_class: SQLAlchemy model class being queried.
+        :param query: The select statement originally provided, if any.
+        :param stmt: The filtered select statement.
+        :return: An unordered select of the primary key columns of
+            ``model_class``, distinct if ``query`` contains joins.
+        :rtype: sqlalchemy.sql.selectable.Select
+
+        """
+        mapper = inspect(model_class).mapper
+        stmt = stmt.with_only_columns(*[
+            getattr(model_class, mapper.get_property_by_column(column).key)
+            for column in mapper.primary_key
+        ]).order_by(None).limit(None).offset(None)
+        if query is not None:
+            froms = query.get_final_froms()
+            if len(froms) > 1 or any(
+                    isinstance(from_, sqlalchemy.sql.expression.Join)
+                    for from_ in froms):
+                stmt = stmt.distinct()
+        return stmt
+
+    @classmethod
+    def _get_count_statement(cls, stmt, cap):
+        """Get a statement counting the rows of a select.
+
+        :param stmt: A select from :meth:`_get_count_select`.
+        :param cap: Optional max number of rows to count, beyond one
+            more to show there are more.
+        :type cap: int or None
+        :return: A select of the number of rows.
+        :rtype: sqlalchemy.sql.selectable.Select
+
+        """
+        if cap is not None:
+            stmt = stmt.limit(cap + 1)
+        return select(sqlalchemy.func.count()).select_from(stmt.subquery())
+
+    @classmethod
+    def paginate_mql_filters(cls, model_class, query=None, filters=None,
+                             sort=None, cursor=None, limit=None,
+                             whitelist=None, nested_conditions=None,
+                             stack_size_limit=None,
+                             convert_key_names_func=None, gettext=None,
+                             relation_strategy="exists", cost=None,
+                             projection=None, load_plan=None):
+        """Apply filters along with keyset pagination.
+
+        Rather than skipping rows using ``OFFSET``, which gets slower
+        the further into the results a page is, each page picks up
+        after the last row of the previous one. Rows are sorted by
+        ``sort``, followed by the primary key of ``model_class`` so
+        every row has a unique position, and only rows positioned after
+        ``cursor`` are selected.
+
+        .. code-block:: python
+
+            sort = {"name": 1}
+            stmt = MqlBuilder.paginate_mql_filters(
+                Track, filters=filters, sort=sort, cursor=cursor,
+                limit=50)
+            tracks = db_session.execute(stmt).scalars().all()
+            if tracks:
+                next_cursor = MqlBuilder.get_keyset_cursor(
+                    Track, tracks[-1], sort)
+
+        Sort columns are expected to be non nullable, as rows with a
+        ``NULL`` in a sort column can't be positioned after a cursor.
+
+        See :meth:`apply_mql_filters` for details on the other params.
+
+        :param sort: Columns to sort by, as a dict of field names to
+            ``1`` for ascending or ``-1`` for descending order, or a
+            list of ``(field_name, direction)`` pairs. Field names are
+            converted with ``convert_key_names_func`` and checked
+            against the ``whitelist`` in the same way as filters, and
+            must refer to columns of ``model_class``.
+        :type sort: dict, list, or None
+        :param cursor: An opaque cursor from :meth:`get_keyset_cursor`
+            for the last row of the previous page, or ``None`` for the
+            first page.
+        :type cursor: str or None
+        :param limit: Optional max number of rows per page.
+        :type limit: int or None
+        :raise MqlFieldError: If an invalid sort is given.
+        :raise MqlFieldPermissionError: If a sort field isn't
+            whitelisted.
+        :raise InvalidMqlException: If an invalid cursor is given.
+        :return: A filtered, sorted, and limited SQLAlchemy select
+            object of the provided `model_class`.
+        :rtype: sqlalchemy.sql.selectable.Select
+
+        """
+        keyset = cls._parse_sort(
+            model_class, sort, whitelist, convert_key_names_func, gettext)
+        query = cls.apply_mql_filters(
+            model_class=model_class,
+            query=query,
+            filters=filters,
+            whitelist=whitelist,
+            nested_conditions=nested_conditions,
+            stack_size_limit=stack_size_limit,
+            convert_key_names_func=convert_key_names_func,
+            gettext=gettext,
+            relation_strategy=relation_strategy,
+            cost=cost,
+            projection=projection,
+            load_plan=load_plan
+        )
+        if cursor is not None:
+            values = cls._decode_keyset_cursor(cursor, len(keyset), gettext)
+            query = query.where(
+                cls._generate_keyset_expression(keyset, values))
+        query = query.order_by(*[
+            attr.desc() if descending else attr.asc()
+            for attr, descending in keyset])
+        if limit is not None:
+            query = query.limit(limit)
+        return query
+
+    @classmethod
+    def get_keyset_cursor(cls, model_class, row, sort=None,
+                          convert_key_names_func=None):
+        """Get a cursor for paging past a row.
+
+        :param model_class: SQLAlchemy model class being queried.
+        :param row: A model instance, or a row including each sort
+            column, typically the last one from a page of results.
+        :param sort: The same sort given to
+            :meth:`paginate_mql_filters`.
+        :type sort: dict, list, or None
+        :param convert_key_names_func: The same key name conversion
+            function given to :meth:`paginate_mql_filters`.
+        :type convert_key_names_func: callable or None
+        :raise TypeError: If a sort column value can't be encoded.
+        :return: An opaque, URL safe cursor.
+        :rtype: str
+
+        """
+        keyset = cls._parse_sort(
+            model_class, sort, None, convert_key_names_func, None)
+        values = [
+            _encode_keyset_value(getattr(row, attr.key))
+            for attr, _descending in keyset]
+        return base64.urlsafe_b64encode(
+            json.dumps(values, separators=(",", ":")).encode("utf-8")
+        ).decode("ascii").rstrip("=")
+
+    @classmethod
+    def _parse_sort(cls, model_class, sort, whitelist,
+                    convert_key_names_func, gettext, unique=True):
+        """Get the attrs to sort by.
+
+        If ``unique``, primary key columns not in ``sort`` are added at
+        the end, in ascending order, so each row has a unique position,
+        as needed for keyset pagination.
+
+        :param model_class: SQLAlchemy model class being queried.
+        :param sort: A dict or list of pairs of field names and
+            directions.
+        :param whitelist: Whitelist to check sort fields against.
+        :param convert_key_names_func: Optional function to convert
+            sort field names.
+        :param gettext: Optional translation function for errors.
+        :param bool unique: Whether to add primary key columns.
+        :raise MqlFieldError: If an invalid sort is given.
+        :raise MqlFieldPermissionError: If a sort field isn't
+            whitelisted.
+        :return: A list of ``(attr, descending)`` tuples.
+        :rtype: list
+
+        """
+        _ = gettext or dummy_gettext
+        if sort is None:
+            sort = []
+        elif isinstance(sort, dict):
+            sort = list(sort.items())
+        if convert_key_names_func is None:
+            def convert_key_names_func(x): return x
+        is_whitelisted = cls._get_whitelist_checker(model_class, whitelist)
+        schema_index = cls.get_schema_index(model_class)
+        keyset = []
+        keys = set()
+        for item in sort:
+            try:
+                key, direction = item
+            except (TypeError, ValueError):
+                key, direction = item, None
+            if direction not in (1, -1) or isinstance(direction, bool):
+                raise MqlFieldError(
+                    data_key=key,
+                    op=None,
+                    filters=direction,
+                    code="invalid_sort",
+                    message=_("Sort direction must be 1 or -1.")
+                )
+            c_key = convert_key_names_func(key) if isinstance(
+                key, str) else None
+            try:
+                path_info = schema_index.resolve(c_key)
+            except (AttributeError, TypeError):
+                path_info = None
+            if (path_info is None or path_info.kind != "column" or
+                    len(path_info.attrs) != 2):
+                raise MqlFieldError(
+                    data_key=key,
+                    op=None,
+                    filters=direction,
+                    code="invalid_sort",
+                    message=_("Only columns can be sorted by.")
+                )
+            if not is_whitelisted(c_key):
+                raise MqlFieldPermissionError(
+                    data_key=key,
+                    op=None,
+                    filters=direction,
+                    code="invalid_whitelist_permission",
+                    message=_(
+                        "Attempt made to sort by a field without "
+                        "proper permission.")
+                )
+            attr = path_info.attrs[-1]
+            if attr.key not in keys:
+                keys.add(attr.key)
+                keyset.append((attr, direction == -1))
+        if not unique:
+            return keyset
+        mapper = inspect(model_class).mapper
+        for column in mapper.primary_key:
+            prop = mapper.get_property_by_column(column)
+            if prop.key not in keys:
+                keys.add(prop.key)
+                keyset.append((getattr(model_class, prop.key), False))
+        return keyset
+
+    @classmethod
+    def _decode_keyset_cursor(cls, cursor, size, gettext):
+        """Decode the sort column values from a cursor.
+
+        :param str cursor: A cursor from :meth:`get_keyset_cursor`.
+        :param int size: Expected number of values.
+        :param gettext: Optional translation function for errors.
+        :raise InvalidMqlException: If the cursor is invalid.
+        :return: A list of sort column values.
+        :rtype: list
+
+        """
+        _ = gettext or dummy_gettext
+        try:
+            values = json.loads(base64.urlsafe_b64decode(
+                cursor + "=" * (-len(cursor) % 4)))
+            if isinstance(values, list) and len(values) == size:
+                return [_decode_keyset_value(value) for value in values]
+        except (TypeError, ValueError, KeyError, decimal.InvalidOperation):
+            pass
+        raise InvalidMqlException(_("Invalid cursor."))
+
+    @classmethod
+    def _generate_keyset_expression(cls, keyset, values):
+        """Generate an expression for rows positioned after values.
+
+        :param list keyset: ``(attr, descending)`` tuples from
+            :meth:`_parse_sort`.
+        :param list values: Sort column values of the last row seen.
+        :return: A SQLAlchemy expression for filtering.
+
+        """
+        directions = set(descending for _attr, descending in keyset)
+        if cls.keyset_row_values and len(directions) == 1:
+            row = sqlalchemy.tuple_(*[attr for attr, _ in keyset])
+            row_values = sqlalchemy.tuple_(*[
+                sqlalchemy.literal(value, attr.type)
+                for (attr, _), value in zip(keyset, values)])
+            if directions.pop():
+                return row < row_values
+            return row > row_values
+        expressions = []
+        for i, ((attr, descending), value) in enumerate(
+                zip(keyset, values)):
+            expression = attr < value if descending else attr > value
+            expressions.append(sqlalchemy.and_(*[
+                keyset[j][0] == values[j] for j in range(i)
+            ] + [expression]))
+        return sqlalchemy.or_(*expressions)
+
+    @classmethod
+    def _get_whitelist_checker(cls, model_class, whitelist):
+        """Get a function checking whether a field is whitelisted.
+
+        :param model_class: SQLAlchemy model class being queried.
+        :param whitelist: A whitelist as accepted by
+            :meth:`parse_mql_filters`.
+        :return: A function taking a dot separated field name, and
+            returning ``True`` if it may be used.
+        :rtype: callable
+
+        """
+        if isinstance(whitelist, (list, tuple, set, frozenset)):
+            whitelist = MqlWhitelist(whitelist)
+        if isinstance(whitelist, MqlWhitelist):
+            def is_whitelisted(data_key):
+                """Uses the default, built in whitelist checker."""
+                return whitelist.is_whitelisted(model_class, data_key)
+        elif callable(whitelist):
+            def is_whitelisted(data_key):
+                """Uses the provided whitelist function."""
+                return whitelist(data_key)
+        else:
+            def is_whitelisted(data_key):
+                """All attributes will be queryable."""
+                if data_key:
+                    return True
+        return is_whitelisted
+
+    @classmethod
+    def parse_mql_filters(cls, model_class, filters=None, whitelist=None,
+                          nested_conditions=None, stack_size_limit=None,
+                          convert_key_names_func=None, gettext=None,
+                          cost=None, relations=None):
+        """Applies filters to a query and returns it.
+
+        Supported operators include:
+
+        * $and
+        * $or
+        * $not
+        * $nor
+        * $in
+        * $nin
+        * $gt
+        * $gte
+        * $lt
+        * $lte
+        * $ne
+        * $mod
+
+        Custom operators added for convenience:
+
+        * $eq - Explicit equality check.
+        * $like - Search a text field for the given value.
+
+        Like MongoDB, ``{"$alwaysTrue": 1}`` and ``{"$alwaysFalse": 1}``
+        may also be used to match everything or nothing, as produced by
+        :meth:`normalize_mql_filters`.
+
+        Filtering here works similarly to how MongoDB handles querying,
+        with SQLAlchemy relationships being treated like MongoDB treats
+        nested documents.
+
+        The ``whitelist`` and ``nested_conditions`` parameters can be
+        used for fine grain access control, with both serving distinct
+        purposes. ``whitelist`` can be used to apply rules regarding
+        which fields can generally be queried, while
+        ``nested_conditions`` can be used to apply rules regarding
+        what nested records can be accessed in a query.
+
+        As an example, say you want a user to be able to query an album
+        based on the playlists that album's tracks belong to. Your
+        ``whitelist`` would only need ``tracks.playlists.name`` to be
+        included. If the user isn't supposed to have access to playlists
+        with ``"Private"`` in their name, your ``nested_conditions``
+        could look like:
+
+        .. code-block:: python
+
+            def nested_conditions(key):
+                if key == "tracks.playlists":
+                    return not Playlist.name.contains("Private")
+
+        Now if the user provides
+        ``filters={"tracks.playlists.name": { "$like": "Private"}}``,
+        no resulting albums will be returned, even though the user does
+        have access to the ``tracks.playlists.name`` field.
+
+        :param model_class: SQLAlchemy model class you want to query.
+        :param dict filters: Dictionary of MongoDB style query filters.
+        :param whitelist: Used to determine whether it's permissible to
+            filter by a given field.
+            The field being checked will be a dot notation attr name
+            (e.g. for Album ``tracks.playlists.playlist_id``) that has
+            already been processed by ``convert_key_names_func`` when
+            applicable.
+            If a callable is provided, it should take in a dot separated
+            field name and return ``True`` if it is acceptable to query
+            that field, or ``False`` if not.
+            If a list of field names is provided, field names will be
+            checked against that list to determine whether or not it
+            is an allowed field to be queried. Tuples, sets, and a
+            precompiled :class:`MqlWhitelist` are also accepted.
+            If ``None`` is provided, all fields and relationships of a
+            model will be queryable.
+        :type whitelist: callable, list, MqlWhitelist, or None
+        :param nested_conditions: Provides SQL expressions, as would be
+            used directly by :meth:`~sqlalchemy.orm.query.Query.filter`,
+            for additional filtering on any nested relationships. Can be
+            a callable accepting a single param, or a dict, where the
+            param/key is the relationship being filtered will be
+            provided as a dot notation name (e.g. for Album
+            ``tracks.playlists``) that has already been processed by
+            ``convert_key_names_func`` when applicable. The value
+            returned can be a single item, list, or tuple.
+        :param nested_conditions: callable, dict, or None
+        :param convert_key_names_func: Optional function used to convert
+            a provided attribute name into a field name for a model.
+            Should take one parameter, which is a dot separated name,
+            and should return a converted string in the same dot
+            separated format. For example, say you want to be able to
+            query your model, which contains field names with
+            underscores, using lowerCamelCase instead. The provided
+            function should take a string such as ``"tracks.unitPrice"``
+            and convert it to ``"tracks.unit_price"``. For the sake of
+            raising more useful exceptions, the function should return
+            ``None`` if an invalid field name is provided, however this
+            is not necessary.
+        :type convert_key_names_func: callable
+        :param stack_size_limit: Optional parameter used to limit the
+            allowable complexity of the provided filters. Can be useful
+            in preventing malicious query attempts.
+        :type stack_size_limit: int or None
+        :param gettext: Supply a translation function to convert error
+            messages to the desired language. Note that no translations
+            are included by default, you must generate your own.
+        :type gettext: callable or None
+        :param cost: Optional :class:`MqlCost` used to estimate the
+            cost of the filters, and limit it to a budget. Its
+            ``cost`` is updated as the filters are parsed. Filters
+            parsed with a ``cost``, or with a callable ``whitelist`` or
+            ``nested_conditions``, don't use :attr:`plan_cache`.
+        :type cost: :class:`MqlCost` or None
+        :param relations: Optional set that the dot separated paths of
+            any relationships filtered on are added to, as converted
+            attr names, e.g. ``"tracks.playlists"``.
+        :type relations: set or None
+        :raise MqlTooComplex: If ``stack_size_limit`` or the budget of
+            ``cost`` is exceeded.
+
+        """
+        if cls.normalize_filters and filters is not None:
+            filters = cls.normalize_mql_filters(
+                model_class, filters, convert_key_names_func)
+        if (cls.plan_cache is not None and filters is not None and
+                cost is None and not callable(whitelist) and
+                not callable(nested_conditions)):
+            # Callable whitelists and nested conditions may give a
+            # different answer each call, e.g. based on the current
+            # user, so they're never baked into a cached plan.
+            return cls._parse_cached_mql_filters(
+                model_class=model_class,
+                filters=filters,
+                whitelist=whitelist,
+                nested_conditions=nested_conditions,
+                stack_size_limit=stack_size_limit,
+                convert_key_names_func=convert_key_names_func,
+                gettext=gettext,
+                relations=relations
+            )
+        return cls._parse_mql_filters(
+            model_class=model_class,
+            filters=filters,
+            whitelist=whitelist,
+            nested_conditions=nested_conditions,
+            stack_size_limit=stack_size_limit,
+            convert_key_names_func=convert_key_names_func,
+            gettext=gettext,
+            cost=cost,
+            relations=relations
+        )
+
+    @classmethod
+    def _parse_cached_mql_filters(cls, model_class, filters, whitelist=None,
+                                  nested_conditions=None,
+                                  stack_size_limit=None,
+                                  convert_key_names_func=None, gettext=None,
+                                  relations=None):
+        """Parse filters using a plan from :attr:`plan_cache`.
+
+        Filters are reduced to their shape, which along with the rest
+        of the provided params is used to look up a previously compiled
+        :class:`MqlFilterPlan`. On a cache miss, a new plan is compiled
+        and stored. Either way, only the values from ``filters`` need to
+        be converted and bound to the plan's expressions.
+
+        See :meth:`parse_mql_filters` for details on the parameters.
+
+        :return: A list of SQLAlchemy expressions, or ``None``.
+
+        """
+        values = []
+        shape, template = _split_filters(filters, values)
+        refs = (model_class, whitelist, nested_conditions,
+                convert_key_names_func, gettext)
+        # cls is part of the key, as a subclass sharing its parent's
+        # cache may build expressions differently.
+        key = (cls, shape, stack_size_limit) + tuple(
+            _freeze(ref) for ref in refs)
+        plan = cls.plan_cache.get(key)
+        if plan is None:
+            plan = cls.compile(
+                model_class=model_class,
+                filters_template=filters,
+                whitelist=whitelist,
+                nested_conditions=nested_conditions,
+                stack_size_limit=stack_size_limit,
+                convert_key_names_func=convert_key_names_func,
+                gettext=gettext
+            )
+            # refs are stored with the plan to keep any objects whose
+            # id is used in the key from being garbage collected.
+            cls.plan_cache.set(key, plan, refs)
+        if relations is not None:
+            relations.update(plan.relations)
+        return plan._build(values)
+
+    @classmethod
+    def _parse_mql_filters(cls, model_class, filters=None, whitelist=None,
+                           nested_conditions=None, stack_size_limit=None,
+                           convert_key_names_func=None, gettext=None,
+                           plan_nodes=False, relation_strategy="exists",
+                           joins=None, predicates=False, masks=False,
+                           errors=None, cost=None, relations=None,
+                           profile=None):
+        """Does the actual parsing work for :meth:`parse_mql_filters`.
+
+        See :meth:`parse_mql_filters` for details on most parameters.
+
+        :param bool plan_nodes: If ``True``, expressions that are
+            combined while parsing are instead returned as
+            :class:`_MqlPlanNode` objects. Used to compile a
+            :class:`MqlFilterPlan`.
+        :param str relation_strategy: How relationships are filtered,
+            see :meth:`apply_mql_filters`.
+        :param joins: List that relationships joined by the ``"join"``
+            strategy are appended to, as ``onclause`` args for
+            :meth:`~sqlalchemy.sql.expression.Select.join`. Must be
+            provided to use the ``"join"`` strategy.
+        :type joins: list or None
+        :param bool predicates: If ``True``, in memory predicates are
+            generated rather than SQLAlchemy expressions. Used by
+            :meth:`compile_predicate`.
+        :param bool masks: If ``True``, functions generating boolean
+            masks for columnar data are generated rather than SQLAlchemy
+            expressions. Used by :meth:`compile_vectorized`.
+        :param errors: If a list is provided, filters are only
+            validated, with no SQLAlchemy expressions built. Rather than
+            being raised, each :class:`MqlFieldError` found is appended
+            to the list, and parsing continues. Used by :meth:`validate`.
+        :type errors: list or None
+        :param cost: Optional :class:`MqlCost` that the cost of the
+            filters is added to.
+        :param relations: Optional set that relationship paths filtered
+            on are added to.
+        :type relations: set or None
+        :param profile: :class:`MqlProfile` to record timings and
+            counters in. Set when :attr:`profiler` is used.
+        :return: A list of SQLAlchemy expressions or plan nodes, or
+            ``None``.
+
+        """
+        if cls.profiler is not None and profile is None:
+            profile = MqlProfile(model_class)
+            return cls.profiler.run(profile, functools.partial(
+                _get_profiled_builder(cls)._parse_mql_filters,
+                model_class=model_class,
+                filters=filters,
+                whitelist=whitelist,
+                nested_conditions=nested_conditions,
+                stack_size_limit=stack_size_limit,
+                convert_key_names_func=convert_key_names_func,
+                gettext=gettext,
+                plan_nodes=plan_nodes,
+                relation_strategy=relation_strategy,
+                joins=joins,
+                predicates=predicates,
+                masks=masks,
+                errors=errors,
+                cost=cost,
+                relations=relations,
+                profile=profile
+            ))
+        if convert_key_names_func is None:
+            def convert_key_names_func(x): return x
+        is_whitelisted = cls._get_whitelist_checker(model_class, whitelist)
+        if isinstance(nested_conditions, dict):
+            def build_nested_conditions(data_key):
+                """Uses the built in nested_conditions getter."""
+                return nested_conditions.get(data_key)
+        elif callable(nested_conditions):
+            # Uses the provided required filters function.
+            build_nested_conditions = nested_conditions
+        else:
+            def build_nested_conditions(data_key):
+                """No filters will be built."""
+                return None
+        if predicates:
+            generate = cls._generate_predicate
+        elif masks:
+            generate = cls._generate_mask
+        elif errors is not None:
+            def generate(op, value, attr, target_type, full_data_key,
+                         gettext):
+                """Only checks the value can be used with the op."""
+                cls._convert_operand(
+                    op, value, target_type, full_data_key, gettext)
+        else:
+            generate = cls._generate_expressions
+
+        def fail(error):
+            """Raise an error, or record it if only validating."""
+            if errors is None:
+                raise error
+            errors.append(error)
+        if profile is not None:
+            convert_key_names_func = profile.wrap(
+                "key_conversion", convert_key_names_func, "key_conversions")
+            is_whitelisted = profile.wrap(
+                "whitelist", is_whitelisted, "whitelist_calls")
+            build_nested_conditions = profile.wrap(
+                "nested_conditions", build_nested_conditions)
+            generate = profile.wrap("build", generate, "comparisons")
+        if gettext is None:
+            gettext = dummy_gettext
+        _ = gettext
+        if cost is not None:
+            cost_model = cost.cost_model or cls.cost_model
+        if filters is not None:
+            schema_index = cls.get_schema_index(model_class)
+            if profile is not None:
+                schema_index = _MqlProfiledSchemaIndex(schema_index, profile)
+            if cls.frame_parser:
+                return cls._parse_frames(
+                    model_class=model_class,
+                    filters=filters,
+                    schema_index=schema_index,
+                    is_whitelisted=is_whitelisted,
+                    build_nested_conditions=build_nested_conditions,
+                    generate=generate,
+                    fail=fail,
+                    stack_size_limit=stack_size_limit,
+                    convert_key_names_func=convert_key_names_func,
+                    gettext=_,
+                    plan_nodes=plan_nodes,
+                    relation_strategy=relation_strategy,
+                    joins=joins,
+                    predicates=predicates,
+                    masks=masks,
+                    errors=errors,
+                    cost=cost,
+                    cost_model=cost_model if cost is not None else None,
+                    relations=relations,
+                    profile=profile)
+            # NOTE: Any variable with a c_ prefix is used to store
+            # converted key names, in accordance with convert_key_names
+            # e.g. attr_name_stack = ["someAttr", "otherAttr"]
+            # c_attr_name_stack = ["some_attr", "other_attr"]
+            if profile is not None:
+                query_stack = _MqlProfiledStack(profile)
+            else:
+                query_stack = list()
+            c_attr_name_stack = list()
+            attr_name_stack = list()
+            sub_query_name_stack = list()
+            c_sub_query_name_stack = list()
+            relation_type_stack = list()
+            # Aliased entities used by joined relationships, or None
+            # when attrs of the mapped class can be used as is.
+            entity_stack = list()
+            join_aliases = dict()
+            query_tree_stack = list()
+            query_tree_stack.append({
+                "op": sqlalchemy.and_,
+                "expressions": []
+            })
+            query_stack.append(filters)
+            relation_type_stack.append(model_class)
+            entity_stack.append(None)
+            attr_name_stack.append(model_class.__name__)
+            c_attr_name_stack.append(model_class.__name__)
+            sub_query_name_stack.append(model_class.__name__)
+            c_sub_query_name_stack.append(model_class.__name__)
+            while query_stack:
+                if stack_size_limit and len(query_stack) > stack_size_limit:
+                    raise MqlTooComplex(_("This query is too complex."))
+                item = query_stack.pop()
+                if isinstance(item, str):
+                    if item == "POP_attr_name_stack":
+                        attr_name_stack.pop()
+                        c_attr_name_stack.pop()
+                    elif item == "POP_sub_query_name_stack":
+                        sub_query_name_stack.pop()
+                        c_sub_query_name_stack.pop()
+                        relation_type_stack.pop()
+                        entity_stack.pop()
+                    elif item == "POP_query_tree_stack":
+                        query_tree = query_tree_stack.pop()
+                        query_tree["expressions"] = (
+                            query_tree["expressions"] or [True])
+                        parent_op = query_tree_stack[-1]["op"]
+                        if (query_tree["op"] == sqlalchemy.and_ or
+                                query_tree["op"] == sqlalchemy.or_) and (
+                                len(query_tree["expressions"]) == 1 or
+                                query_tree["op"] == parent_op or (
+                                    query_tree["op"] == sqlalchemy.and_ and
+                                    parent_op != sqlalchemy.or_ and
+                                    parent_op != sqlalchemy.not_)):
+                            # Redundant wrapper, e.g. an and_ inside of
+                            # an and_ or .any, so skip it.
+                            expressions = query_tree["expressions"]
+                        elif errors is not None:
+                            # only validating, there's nothing to build.
+                            expressions = []
+                        elif predicates:
+                            expressions = [_combine_predicates(
+                                query_tree["op"], query_tree["expressions"])]
+                        elif masks:
+                            expressions = [_combine_masks(
+                                query_tree["op"], query_tree["expressions"])]
+                        elif plan_nodes:
+                            expressions = [_MqlPlanNode(
+                                query_tree["op"], query_tree["expressions"])]
+                        elif (query_tree["op"] == sqlalchemy.and_ or
+                                query_tree["op"] == sqlalchemy.or_):
+                            expressions = [query_tree["op"](
+                                *query_tree["expressions"])]
+                        elif query_tree["op"] == sqlalchemy.not_:
+                            expressions = [sqlalchemy.not_(
+                                query_tree["expressions"][0])]
+                        else:
+                            # should be a .has or .any
+                            expressions = [query_tree["op"](
+                                sqlalchemy.and_(*query_tree["expressions"]))]
+                        query_tree_stack[-1]["expressions"].extend(expressions)
+                if isinstance(item, _MqlRelationFilters):
+                    # Sibling filters grouped on a shared relationship.
+                    attr_name_stack.append(item.attr_name)
+                    c_attr_name_stack.append(item.c_attr_name)
+                    query_stack.append("POP_attr_name_stack")
+                    query_stack.append({"$elemMatch": item.filters})
+                elif isinstance(item, dict):
+                    if len(item) > 1:
+                        query_tree_stack.append({
+                            "op": sqlalchemy.and_,
+                            "expressions": []
+                        })
+                        query_stack.append("POP_query_tree_stack")
+                        if (len(attr_name_stack) ==
+                                len(sub_query_name_stack)):
+                            for group_item in cls._group_relation_filters(
+                                    item, schema_index, attr_name_stack,
+                                    c_attr_name_stack, c_sub_query_name_stack,
+                                    convert_key_names_func):
+                                if isinstance(group_item, _MqlKeyFrame):
+                                    group_item = {
+                                        group_item.key: group_item.value}
+                                query_stack.append(group_item)
+                        else:
+                            for key in item:
+                                query_stack.append({key: item[key]})
                     elif len(item) == 1:
                         # Given an attr stack:
                         # ["Album", "tracks.playlists"]
@@ -522,11 +3745,41 @@ class MqlBuilder(object):
                                 attr_name_stack[1:], key)
                             c_full_attr_name = convert_key_names_func(
                                 full_attr_name)
+                            if c_full_attr_name is None and errors is not None:
+                                errors.append(cls._invalid_field_error(
+                                    full_attr_name, item[key], _))
+                                continue
                             split_c_attr_name = c_full_attr_name.split(".")
                             c_key = ".".join(
                                 split_c_attr_name[-len(key.split(".")):])
                         else:
                             c_key = None
+                        if (cost is not None and key.startswith("$") and
+                                key != "$elemMatch" and
+                                key not in _CONSTANT_OPS):
+                            # Added before anything for this op is built.
+                            cost.add(cost_model.op_cost(key, item[key]), _)
+                        if (key == "$or" or key == "$and" or
+                                key == "$nor") and not (
+                                    isinstance(item[key], list) and all(
+                                        isinstance(sub_item, dict)
+                                        for sub_item in item[key])):
+                            fail(MqlFieldError(
+                                data_key=".".join(attr_name_stack[1:]),
+                                op=key,
+                                filters=item[key],
+                                code="invalid_logical_op",
+                                message=_("$and, $or, and $nor values must "
+                                          "be a list of objects.")))
+                            continue
+                        elif key == "$not" and not isinstance(item[key], dict):
+                            fail(MqlFieldError(
+                                data_key=".".join(attr_name_stack[1:]),
+                                op=key,
+                                filters=item[key],
+                                code="invalid_logical_op",
+                                message=_("$not value must be an object.")))
+                            continue
                         if key == "$or" or key == "$and":
                             if key == "$or":
                                 op_func = sqlalchemy.or_
@@ -554,6 +3807,23 @@ class MqlBuilder(object):
                             query_stack.append("POP_query_tree_stack")
                             query_stack.append({"$or": item[key]})
                         elif key == "$elemMatch":
+                            # [1:] to chop model_class from start of
+                            # name stack
+                            class_attrs = schema_index.resolve(
+                                ".".join(c_attr_name_stack[1:])).attrs
+                            sub_class = class_attrs[-1]
+                            if not (hasattr(sub_class, "property") and
+                                    isinstance(sub_class.property,
+                                               RelationshipProperty)):
+                                fail(MqlFieldError(
+                                    data_key=".".join(attr_name_stack[1:]),
+                                    op=key,
+                                    filters=item[key],
+                                    code="invalid_elem_match",
+                                    message=_(
+                                        "$elemMatch not applied to subobject.")
+                                ))
+                                continue
                             attr_name = ".".join(attr_name_stack)
                             parent_sub_query_names = ".".join(
                                 sub_query_name_stack)
@@ -574,85 +3844,141 @@ class MqlBuilder(object):
                             query_stack.append("POP_sub_query_name_stack")
                             query_stack.append("POP_query_tree_stack")
                             query_stack.append(item[key])
-                            # [1:] to chop model_class from start of
-                            # name stack
-                            class_attrs = _get_class_attributes(
-                                model_class, ".".join(c_attr_name_stack[1:]))
-                            sub_class = class_attrs[-1]
+                            if entity_stack[-1] is not None:
+                                # The parent relationship was joined, so
+                                # use the joined alias.
+                                sub_class = getattr(
+                                    entity_stack[-1], sub_class.key)
                             relation_type_stack.append(sub_class)
-                            if (hasattr(sub_class, "property") and
-                                    isinstance(sub_class.property,
-                                               RelationshipProperty)):
-                                # If there are any necessary filters for
-                                # this resource type, make sure they are
-                                # applied. This allows for filter
-                                # scenarios like
-                                # ``filters = {"notifications.id": 5}``
-                                # to safely check only a certain user's
-                                # (as specified in required filters)
-                                # notifications.
-                                expressions = []
-                                required = build_nested_conditions(
-                                    ".".join(attr_name_stack[1:]))
-                                if required is not None:
-                                    if isinstance(required, tuple):
-                                        required = list(required)
-                                    elif not isinstance(required, list):
-                                        required = [required]
-                                    expressions = required
-                                if not sub_class.property.uselist:
-                                    query_tree_stack.append({
-                                        "op": sub_class.has,
-                                        "expressions": expressions
-                                    })
-                                else:
-                                    query_tree_stack.append({
-                                        "op": sub_class.any,
-                                        "expressions": expressions
-                                    })
-                            else:
+                            entity_stack.append(None)
+                            # If there are any necessary filters for
+                            # this resource type, make sure they are
+                            # applied. This allows for filter scenarios
+                            # like ``filters = {"notifications.id": 5}``
+                            # to safely check only a certain user's
+                            # (as specified in required filters)
+                            # notifications.
+                            expressions = []
+                            required = build_nested_conditions(
+                                ".".join(attr_name_stack[1:]))
+                            if required is not None:
+                                if isinstance(required, tuple):
+                                    required = list(required)
+                                elif not isinstance(required, list):
+                                    required = [required]
+                                expressions = required
+                            if masks:
                                 raise MqlFieldError(
                                     data_key=".".join(attr_name_stack[1:]),
                                     op=key,
                                     filters=item[key],
-                                    code="invalid_elem_match",
+                                    code="invalid_relation_filter",
                                     message=_(
-                                        "$elemMatch not applied to subobject.")
+                                        "Relationships can't be filtered "
+                                        "using columnar data.")
                                 )
+                            op = None
+                            if predicates:
+                                op = functools.partial(
+                                    _relation_predicate, sub_class.key,
+                                    sub_class.property.uselist)
+                            elif (relation_strategy == "join" and
+                                    joins is not None and
+                                    required is None and
+                                    sub_class.property.direction is
+                                    MANYTOONE and
+                                    all(query_tree["op"] is sqlalchemy.and_
+                                        for query_tree in query_tree_stack)):
+                                # Only joined when every filter in this
+                                # relationship must be met.
+                                join_path = ".".join(
+                                    c_sub_query_name_stack[1:])
+                                entity = join_aliases.get(join_path)
+                                if entity is None:
+                                    entity = aliased(
+                                        sub_class.property.mapper.class_)
+                                    join_aliases[join_path] = entity
+                                    joins.append(sub_class.of_type(entity))
+                                entity_stack[-1] = entity
+                                op = sqlalchemy.and_
+                            elif relation_strategy == "semi_join_in":
+                                op = cls._get_semi_join_op(sub_class)
+                            if op is None:
+                                if not sub_class.property.uselist:
+                                    op = sub_class.has
+                                else:
+                                    op = sub_class.any
+                            if cost is not None:
+                                cost.add(cost_model.relation_cost(
+                                    sub_class.property), _)
+                            if relations is not None:
+                                relations.add(".".join(
+                                    name for name in c_sub_query_name_stack[1:]
+                                    if not name[:1].isdigit()))
+                            if (profile is not None and
+                                    op is not sqlalchemy.and_):
+                                op = profile.wrap("build", op, "sub_queries")
+                            query_tree_stack.append({
+                                "op": op,
+                                "expressions": expressions
+                            })
+                        elif key in _CONSTANT_OPS:
+                            if errors is not None:
+                                continue
+                            matches = key == "$alwaysTrue"
+                            if predicates:
+                                expression = (
+                                    _true_predicate if matches
+                                    else _false_predicate)
+                            elif masks:
+                                expression = (
+                                    _true_mask if matches else _false_mask)
+                            elif matches:
+                                expression = sqlalchemy.true()
+                            else:
+                                expression = sqlalchemy.false()
+                            query_tree_stack[-1]["expressions"].append(
+                                expression)
                         elif key.startswith("$"):
-                            class_attrs = _get_class_attributes(
-                                model_class,
+                            path_info = schema_index.resolve(
                                 ".".join(c_attr_name_stack[1:]))
-                            if (class_attrs and
-                                    hasattr(class_attrs[-1], "property") and
-                                    isinstance(class_attrs[-1].property,
-                                               ColumnProperty)):
-                                attr = class_attrs[-1]
+                            if path_info.kind == "column":
+                                attr = path_info.attrs[-1]
                                 if key == "$exists":
                                     target_type = Boolean
                                 else:
-                                    target_type = type(
-                                        attr.property.columns[0].type)
+                                    target_type = path_info.column_type
                             elif key == "$exists":
                                 target_type = Boolean
-                                attr = class_attrs[-1]
+                                attr = path_info.attrs[-1]
                             else:
-                                raise MqlFieldError(
+                                fail(MqlFieldError(
                                     data_key=".".join(attr_name_stack[1:]),
                                     filters=item[key],
                                     op=key,
                                     message=_("Relationships can't be "
                                               "checked for equality."),
                                     code="invalid_relation_comp"
+                                ))
+                                continue
+                            if entity_stack[-1] is not None:
+                                # Within a joined relationship.
+                                attr = getattr(entity_stack[-1], attr.key)
+                            try:
+                                expression = generate(
+                                    op=key,
+                                    value=item[key],
+                                    attr=attr,
+                                    target_type=target_type,
+                                    full_data_key=".".join(
+                                        attr_name_stack[1:]),
+                                    gettext=_
                                 )
-                            expression = cls._generate_expressions(
-                                op=key,
-                                value=item[key],
-                                attr=attr,
-                                target_type=target_type,
-                                full_data_key=".".join(attr_name_stack[1:]),
-                                gettext=_
-                            )
+                            except MqlFieldError as error:
+                                if errors is None:
+                                    raise
+                                errors.append(error)
+                                continue
                             query_tree_stack[-1]["expressions"].append(
                                 expression)
                         elif is_whitelisted(_get_full_attr_name(
@@ -662,7 +3988,7 @@ class MqlBuilder(object):
                                 # nested attr queries aren't allowed.
                                 # this type of search implies an
                                 # equality check on an object.
-                                raise MqlFieldError(
+                                fail(MqlFieldError(
                                     data_key=".".join(attr_name_stack[1:]),
                                     op="$eq",
                                     filters=item,
@@ -670,7 +3996,8 @@ class MqlBuilder(object):
                                     message=_(
                                         "Attempts at comparing an "
                                         "attribute to an object aren't "
-                                        "valid."))
+                                        "valid.")))
+                                continue
                             # Next couple blocks of code help us find
                             # the first new relationship property
                             # in our attr hierarchy.
@@ -681,37 +4008,28 @@ class MqlBuilder(object):
                                 c_attr_name_stack, c_key)
                             full_attr_name = _get_full_attr_name(
                                 attr_name_stack, key)
-                            class_attrs = _get_class_attributes(
-                                model_class, _get_full_attr_name(
-                                    c_attr_name_stack[1:], c_key))
                             c_split_full_attr = c_full_attr_name.split('.')
                             split_full_attr = full_attr_name.split('.')
-                            relation_indexes = []
-                            for i, class_attr in enumerate(class_attrs):
-                                if (hasattr(class_attr, "property") and
-                                        isinstance(class_attr.property,
-                                                   RelationshipProperty)):
-                                    if (i == len(class_attrs) - 1 or not
-                                            split_full_attr[i+1][0].isdigit()):
-                                        relation_indexes.append(i)
+                            try:
+                                relation_indexes = schema_index.resolve(
+                                    _get_full_attr_name(
+                                        c_attr_name_stack[1:], c_key)
+                                ).relation_indexes
+                            except AttributeError:
+                                if errors is None:
+                                    raise
+                                errors.append(cls._invalid_field_error(
+                                    _get_full_attr_name(
+                                        attr_name_stack[1:], key),
+                                    item[key], _))
+                                continue
                             # find the properties that are relationships
                             # that already have subqueries in our
                             # attr hierarchy.
                             # psq stands for parent_sub_query
-                            psq_attr_name = ".".join(c_sub_query_name_stack)
-                            psq_class_attrs = _get_class_attributes(
-                                model_class, ".".join(
-                                    c_sub_query_name_stack[1:]))
-                            psq_split_attr_name = psq_attr_name.split('.')
-                            psq_relation_indexes = []
-                            for i, class_attr in enumerate(psq_class_attrs):
-                                if (hasattr(class_attr, "property") and
-                                        isinstance(class_attr.property,
-                                                   RelationshipProperty)):
-                                    if (i == len(psq_class_attrs) - 1 or not
-                                            psq_split_attr_name[
-                                                i+1][0].isdigit()):
-                                        psq_relation_indexes.append(i)
+                            psq_relation_indexes = schema_index.resolve(
+                                ".".join(c_sub_query_name_stack[1:])
+                            ).relation_indexes
                             if (len(psq_relation_indexes) ==
                                     len(relation_indexes)):
                                 # There is no new relationship query
@@ -782,7 +4100,7 @@ class MqlBuilder(object):
                                             # NOTE - what's the op here?
                                             # None for now, not sure if
                                             # that's the right exception
-                                            raise MqlFieldError(
+                                            fail(MqlFieldError(
                                                 data_key=".".join(
                                                     attr_name_stack[1:]),
                                                 op=None,
@@ -791,7 +4109,7 @@ class MqlBuilder(object):
                                                 message=_(
                                                     "Fields can't be compared "
                                                     "to empty objects.")
-                                            )
+                                            ))
                                         else:
                                             # NOTE - may also want to
                                             # check for invalid
@@ -831,7 +4149,7 @@ class MqlBuilder(object):
                                         # there is no sub_attr, so we're
                                         # trying to equality check a
                                         # relation.
-                                        raise MqlFieldError(
+                                        fail(MqlFieldError(
                                             data_key=".".join(
                                                 attr_name_stack[1:]),
                                             op=None,
@@ -841,7 +4159,7 @@ class MqlBuilder(object):
                                                 "Relationships can't be "
                                                 "compared to primitive "
                                                 "values.")
-                                        )
+                                        ))
                                     else:
                                         # must have a sub_attr, so turn
                                         # into an elemMatch for that
@@ -849,7 +4167,7 @@ class MqlBuilder(object):
                                         query_stack.append({"$elemMatch": {
                                             sub_attr_name: item[key]}})
                         else:
-                            raise MqlFieldPermissionError(
+                            fail(MqlFieldPermissionError(
                                 data_key=_get_full_attr_name(
                                     attr_name_stack[1:], key),
                                 op=None,
@@ -858,74 +4176,2254 @@ class MqlBuilder(object):
                                 message=_(
                                     "Attempt made to query a field without "
                                     "proper permission.")
-                            )
+                            ))
             if query_tree_stack[-1]["expressions"]:
                 return query_tree_stack[-1]["expressions"]
 
-    @classmethod
-    def convert_to_alchemy_type(cls, value, alchemy_type):
-        """Convert a given value to a sqlalchemy friendly type.
+    @classmethod
+    def _parse_frames(cls, model_class, filters, schema_index,
+                      is_whitelisted, build_nested_conditions, generate,
+                      fail, stack_size_limit, convert_key_names_func,
+                      gettext, plan_nodes, relation_strategy, joins,
+                      predicates, masks, errors, cost, cost_model,
+                      relations, profile):
+        """Parse filters using typed frames, see :attr:`frame_parser`.
+
+        Called by :meth:`_parse_mql_filters` once its callables are set
+        up, and gives the same results and errors. Exactly one frame is
+        pushed wherever the default parser pushes an item, so
+        ``stack_size_limit`` applies the same way. Rather than marker
+        strings and parallel name stacks, the current position is a
+        :class:`_MqlParseState`, put back when its
+        :class:`_MqlRestoreFrame` is popped, and keys are pushed as
+        :class:`_MqlKeyFrame` objects rather than new single key dicts.
+
+        :param schema_index: :class:`MqlSchemaIndex` for
+            ``model_class``.
+        :param callable is_whitelisted: Checks a converted data key is
+            allowed to be queried.
+        :param callable build_nested_conditions: Gets required filters
+            for a relationship's data key.
+        :param callable generate: Builds the expression for an op.
+        :param callable fail: Raises an error, or records it if only
+            validating.
+        :param cost_model: :class:`MqlCostModel` used with ``cost``.
+        :return: A list of SQLAlchemy expressions or plan nodes, or
+            ``None``.
+
+        """
+        _ = gettext
+        if profile is not None:
+            query_stack = _MqlProfiledStack(profile)
+        else:
+            query_stack = list()
+        push = query_stack.append
+        pop = query_stack.pop
+        state = _MqlParseState.for_model(model_class)
+        join_aliases = dict()
+        query_tree_stack = [_MqlTreeFrame(sqlalchemy.and_, [])]
+        push(filters)
+        while query_stack:
+            if stack_size_limit and len(query_stack) > stack_size_limit:
+                raise MqlTooComplex(_("This query is too complex."))
+            item = pop()
+            item_type = type(item)
+            if item_type is _MqlKeyFrame:
+                key = item.key
+                value = item.value
+            elif item_type is _MqlRestoreFrame:
+                state = item.state
+                continue
+            elif item_type is _MqlTreeFrame:
+                query_tree_stack.pop()
+                op = item.op
+                expressions = item.expressions or [True]
+                parent_op = query_tree_stack[-1].op
+                if (op == sqlalchemy.and_ or op == sqlalchemy.or_) and (
+                        len(expressions) == 1 or op == parent_op or (
+                            op == sqlalchemy.and_ and
+                            parent_op != sqlalchemy.or_ and
+                            parent_op != sqlalchemy.not_)):
+                    # Redundant wrapper, e.g. an and_ inside of an and_
+                    # or .any, so skip it.
+                    query_tree_stack[-1].expressions.extend(expressions)
+                    continue
+                elif errors is not None:
+                    # only validating, there's nothing to build.
+                    continue
+                elif predicates:
+                    expression = _combine_predicates(op, expressions)
+                elif masks:
+                    expression = _combine_masks(op, expressions)
+                elif plan_nodes:
+                    expression = _MqlPlanNode(op, expressions)
+                elif op == sqlalchemy.and_ or op == sqlalchemy.or_:
+                    expression = op(*expressions)
+                elif op == sqlalchemy.not_:
+                    expression = sqlalchemy.not_(expressions[0])
+                else:
+                    # should be a .has or .any
+                    expression = op(sqlalchemy.and_(*expressions))
+                query_tree_stack[-1].expressions.append(expression)
+                continue
+            elif item_type is _MqlRelationFilters:
+                # Sibling filters grouped on a shared relationship.
+                push(_MqlRestoreFrame(state))
+                state = state.push_attr(item.attr_name, item.c_attr_name)
+                push(_MqlKeyFrame("$elemMatch", item.filters))
+                continue
+            elif isinstance(item, dict):
+                if len(item) > 1:
+                    tree = _MqlTreeFrame(sqlalchemy.and_, [])
+                    query_tree_stack.append(tree)
+                    push(tree)
+                    if len(state.attr_names) == len(state.sub_query_names):
+                        query_stack.extend(cls._group_relation_filters(
+                            item, schema_index, state.attr_names,
+                            state.c_attr_names, state.c_sub_query_names,
+                            convert_key_names_func))
+                    else:
+                        for key, value in item.items():
+                            push(_MqlKeyFrame(key, value))
+                    continue
+                elif not item:
+                    continue
+                [(key, value)] = item.items()
+            else:
+                # e.g. a value given for $elemMatch that isn't an
+                # object, which has nothing to parse.
+                continue
+            if not key.startswith("$"):
+                # Convert the key name using the full data key, then
+                # chop off the names already in the attr names.
+                full_attr_name = state.get_data_key(key)
+                c_full_attr_name = convert_key_names_func(full_attr_name)
+                if c_full_attr_name is None and errors is not None:
+                    errors.append(cls._invalid_field_error(
+                        full_attr_name, value, _))
+                    continue
+                split_c_attr_name = c_full_attr_name.split(".")
+                c_key = ".".join(split_c_attr_name[-len(key.split(".")):])
+                c_data_key = state.get_data_key(c_key, converted=True)
+                if not is_whitelisted(c_data_key):
+                    fail(MqlFieldPermissionError(
+                        data_key=full_attr_name,
+                        op=None,
+                        filters=value,
+                        code="invalid_whitelist_permission",
+                        message=_(
+                            "Attempt made to query a field without "
+                            "proper permission.")
+                    ))
+                    continue
+                if len(state.attr_names) > len(state.sub_query_names):
+                    # nested attr queries aren't allowed. this type of
+                    # search implies an equality check on an object.
+                    fail(MqlFieldError(
+                        data_key=state.data_key,
+                        op="$eq",
+                        filters=item if item_type is not _MqlKeyFrame
+                        else {key: value},
+                        code="invalid_attr_comp",
+                        message=_(
+                            "Attempts at comparing an attribute to an "
+                            "object aren't valid.")))
+                    continue
+                # find the properties that are relationship properties
+                # in our attr hierarchy.
+                try:
+                    relation_indexes = schema_index.resolve(
+                        c_data_key).relation_indexes
+                except AttributeError:
+                    if errors is None:
+                        raise
+                    errors.append(cls._invalid_field_error(
+                        full_attr_name, value, _))
+                    continue
+                # find the properties that are relationships that
+                # already have subqueries in our attr hierarchy.
+                psq_relation_indexes = schema_index.resolve(
+                    state.c_sub_query_key).relation_indexes
+                if len(psq_relation_indexes) == len(relation_indexes):
+                    # There is no new relationship query
+                    push(_MqlRestoreFrame(state))
+                    state = state.push_attr(key, c_key)
+                    if isinstance(value, dict):
+                        push(value)
+                    else:
+                        push(_MqlKeyFrame("$eq", value))
+                    continue
+                elif len(relation_indexes) < len(psq_relation_indexes):
+                    continue
+                # Parse out the next relation sub query, e.g. for a
+                # full attr name of cls.prop1.Relation1.prop2.Relation2.p2
+                # and sub query names of (cls, prop1.Relation1), the
+                # result is prop2.Relation2, with p2 left over.
+                split_full_attr = (
+                    state.attr_names[0] + "." + full_attr_name).split(".")
+                c_split_full_attr = (
+                    state.c_attr_names[0] + "." + c_data_key).split(".")
+                new_relation_index = relation_indexes[
+                    len(psq_relation_indexes)]
+                prior_relation_index = 0
+                if len(psq_relation_indexes) > 0:
+                    prior_relation_index = psq_relation_indexes[-1]
+                push(_MqlRestoreFrame(state))
+                state = state.push_attr(
+                    ".".join(split_full_attr[
+                        prior_relation_index + 1:new_relation_index + 1]),
+                    ".".join(c_split_full_attr[
+                        prior_relation_index + 1:new_relation_index + 1]))
+                sub_attr_name = ".".join(
+                    split_full_attr[new_relation_index + 1:])
+                if (new_relation_index == relation_indexes[-1] and
+                        isinstance(value, dict)):
+                    if sub_attr_name != "":
+                        # querying a single attribute of this relation.
+                        push(_MqlKeyFrame(
+                            "$elemMatch", {sub_attr_name: value}))
+                    elif not len(value.keys()) > 0:
+                        # dictionary has no keys, invalid query.
+                        fail(MqlFieldError(
+                            data_key=state.data_key,
+                            op=None,
+                            filters=value,
+                            code="invalid_empty_comp",
+                            message=_(
+                                "Fields can't be compared to empty "
+                                "objects.")
+                        ))
+                    else:
+                        tree = _MqlTreeFrame(sqlalchemy.and_, [])
+                        query_tree_stack.append(tree)
+                        push(tree)
+                        for sub_key, sub_value in value.items():
+                            if sub_key == "$elemMatch":
+                                push(_MqlKeyFrame(sub_key, sub_value))
+                            elif sub_key == "$exists":
+                                push(value)
+                            else:
+                                # implicit elemMatch
+                                push(_MqlKeyFrame(
+                                    "$elemMatch", {sub_key: sub_value}))
+                elif (new_relation_index == relation_indexes[-1] and
+                        sub_attr_name == ""):
+                    # value is not a dict and there is no sub attr, so
+                    # we're trying to equality check a relation.
+                    fail(MqlFieldError(
+                        data_key=state.data_key,
+                        op=None,
+                        filters=value,
+                        code="invalid_relation_comp",
+                        message=_(
+                            "Relationships can't be compared to primitive "
+                            "values.")
+                    ))
+                else:
+                    # must have a sub attr, so turn into an elemMatch
+                    # for that sub attr.
+                    push(_MqlKeyFrame("$elemMatch", {sub_attr_name: value}))
+                continue
+            if (cost is not None and key != "$elemMatch" and
+                    key not in _CONSTANT_OPS):
+                # Added before anything for this op is built.
+                cost.add(cost_model.op_cost(key, value), _)
+            if key == "$or" or key == "$and" or key == "$nor":
+                if not (isinstance(value, list) and all(
+                        isinstance(sub_item, dict) for sub_item in value)):
+                    fail(MqlFieldError(
+                        data_key=state.data_key,
+                        op=key,
+                        filters=value,
+                        code="invalid_logical_op",
+                        message=_("$and, $or, and $nor values must be a "
+                                  "list of objects.")))
+                    continue
+                if key == "$nor":
+                    tree = _MqlTreeFrame(sqlalchemy.not_, [])
+                    query_tree_stack.append(tree)
+                    push(tree)
+                    push(_MqlKeyFrame("$or", value))
+                else:
+                    tree = _MqlTreeFrame(
+                        sqlalchemy.or_ if key == "$or" else sqlalchemy.and_,
+                        [])
+                    query_tree_stack.append(tree)
+                    push(tree)
+                    query_stack.extend(value)
+            elif key == "$not":
+                if not isinstance(value, dict):
+                    fail(MqlFieldError(
+                        data_key=state.data_key,
+                        op=key,
+                        filters=value,
+                        code="invalid_logical_op",
+                        message=_("$not value must be an object.")))
+                    continue
+                tree = _MqlTreeFrame(sqlalchemy.not_, [])
+                query_tree_stack.append(tree)
+                push(tree)
+                push(value)
+            elif key == "$elemMatch":
+                sub_class = schema_index.resolve(state.c_data_key).attrs[-1]
+                if not (hasattr(sub_class, "property") and
+                        isinstance(sub_class.property,
+                                   RelationshipProperty)):
+                    fail(MqlFieldError(
+                        data_key=state.data_key,
+                        op=key,
+                        filters=value,
+                        code="invalid_elem_match",
+                        message=_("$elemMatch not applied to subobject.")
+                    ))
+                    continue
+                push(_MqlRestoreFrame(state))
+                tree = _MqlTreeFrame(None, [])
+                push(tree)
+                push(value)
+                if state.entity is not None:
+                    # The parent relationship was joined, so use the
+                    # joined alias.
+                    sub_class = getattr(state.entity, sub_class.key)
+                state = state.push_sub_query()
+                # If there are any necessary filters for this resource
+                # type, make sure they are applied.
+                required = build_nested_conditions(state.data_key)
+                if required is not None:
+                    if isinstance(required, tuple):
+                        required = list(required)
+                    elif not isinstance(required, list):
+                        required = [required]
+                    tree.expressions = required
+                if masks:
+                    raise MqlFieldError(
+                        data_key=state.data_key,
+                        op=key,
+                        filters=value,
+                        code="invalid_relation_filter",
+                        message=_("Relationships can't be filtered using "
+                                  "columnar data.")
+                    )
+                op = None
+                if predicates:
+                    op = functools.partial(
+                        _relation_predicate, sub_class.key,
+                        sub_class.property.uselist)
+                elif (relation_strategy == "join" and
+                        joins is not None and
+                        required is None and
+                        sub_class.property.direction is MANYTOONE and
+                        all(query_tree.op is sqlalchemy.and_
+                            for query_tree in query_tree_stack)):
+                    # Only joined when every filter in this relationship
+                    # must be met.
+                    join_path = state.c_sub_query_key
+                    entity = join_aliases.get(join_path)
+                    if entity is None:
+                        entity = aliased(sub_class.property.mapper.class_)
+                        join_aliases[join_path] = entity
+                        joins.append(sub_class.of_type(entity))
+                    state.entity = entity
+                    op = sqlalchemy.and_
+                elif relation_strategy == "semi_join_in":
+                    op = cls._get_semi_join_op(sub_class)
+                if op is None:
+                    if not sub_class.property.uselist:
+                        op = sub_class.has
+                    else:
+                        op = sub_class.any
+                if cost is not None:
+                    cost.add(cost_model.relation_cost(sub_class.property), _)
+                if relations is not None:
+                    relations.add(".".join(
+                        name for name in state.c_sub_query_names[1:]
+                        if not name[:1].isdigit()))
+                if profile is not None and op is not sqlalchemy.and_:
+                    op = profile.wrap("build", op, "sub_queries")
+                tree.op = op
+                query_tree_stack.append(tree)
+            elif key in _CONSTANT_OPS:
+                if errors is not None:
+                    continue
+                matches = key == "$alwaysTrue"
+                if predicates:
+                    expression = (
+                        _true_predicate if matches else _false_predicate)
+                elif masks:
+                    expression = _true_mask if matches else _false_mask
+                elif matches:
+                    expression = sqlalchemy.true()
+                else:
+                    expression = sqlalchemy.false()
+                query_tree_stack[-1].expressions.append(expression)
+            else:
+                path_info = schema_index.resolve(state.c_data_key)
+                if path_info.kind == "column":
+                    attr = path_info.attrs[-1]
+                    if key == "$exists":
+                        target_type = Boolean
+                    else:
+                        target_type = path_info.column_type
+                elif key == "$exists":
+                    target_type = Boolean
+                    attr = path_info.attrs[-1]
+                else:
+                    fail(MqlFieldError(
+                        data_key=state.data_key,
+                        filters=value,
+                        op=key,
+                        message=_("Relationships can't be checked for "
+                                  "equality."),
+                        code="invalid_relation_comp"
+                    ))
+                    continue
+                if state.entity is not None:
+                    # Within a joined relationship.
+                    attr = getattr(state.entity, attr.key)
+                try:
+                    expression = generate(
+                        op=key,
+                        value=value,
+                        attr=attr,
+                        target_type=target_type,
+                        full_data_key=state.data_key,
+                        gettext=_
+                    )
+                except MqlFieldError as error:
+                    if errors is None:
+                        raise
+                    errors.append(error)
+                    continue
+                query_tree_stack[-1].expressions.append(expression)
+        if query_tree_stack[-1].expressions:
+            return query_tree_stack[-1].expressions
+
+    @classmethod
+    def _get_semi_join_op(cls, relation):
+        """Get a query tree op that filters a relationship using ``IN``.
+
+        :param relation: Relationship attribute of a model class.
+        :return: A callable taking the criterion for the related
+            records, or ``None`` if the relationship has a secondary
+            table, more than one foreign key column, or an aliased
+            parent.
+
+        """
+        prop = relation.property
+        if (relation.parent.is_aliased_class or
+                prop.secondary is not None or
+                len(prop.local_remote_pairs) != 1):
+            return None
+        local, remote = prop.local_remote_pairs[0]
+        return functools.partial(cls._generate_semi_join, local, remote)
+
+    @staticmethod
+    def _generate_semi_join(local, remote, criterion):
+        """Generate a ``local IN (SELECT remote WHERE criterion)``.
+
+        Nulls are excluded on both sides, so that negating the
+        expression matches what negating ``.any()`` or ``.has()`` would.
+
+        :param local: Column of the parent model's table.
+        :param remote: Column of the related model's table.
+        :param criterion: Filters for the related records.
+        :return: A SQLAlchemy expression.
+
+        """
+        sub_query = select(remote).where(criterion)
+        if remote.nullable:
+            sub_query = sub_query.where(remote.isnot(None))
+        expression = local.in_(sub_query.correlate(None))
+        if local.nullable:
+            expression = sqlalchemy.and_(local.isnot(None), expression)
+        return expression
+
+    @classmethod
+    def _group_relation_filters(cls, filters, schema_index, attr_name_stack,
+                                c_attr_name_stack, c_sub_query_name_stack,
+                                convert_key_names_func):
+        """Group sibling filters that start with the same relationship.
+
+        Filters on a many to one relationship are always grouped, and
+        filters on other relationships are grouped if
+        :attr:`merge_relation_filters` is ``True``. Each group ends up
+        as a single ``.has`` or ``.any`` sub query. Filters that can't
+        be grouped, including any with invalid names, are left as is
+        for the parser to handle.
+
+        :param dict filters: Filters with multiple sibling keys.
+        :param schema_index: :class:`MqlSchemaIndex` for the model
+            class being queried.
+        :param list attr_name_stack: Attr names of the current position
+            in the filters, preceded by the model class name.
+        :param list c_attr_name_stack: Converted ``attr_name_stack``.
+        :param list c_sub_query_name_stack: Converted names of the
+            relationships that already have sub queries.
+        :param callable convert_key_names_func: Converts a provided
+            attr name into a field name for the model.
+        :return: :class:`_MqlKeyFrame` and :class:`_MqlRelationFilters`
+            objects to be parsed, in the same order as ``filters``.
+        :rtype: list
+
+        """
+        psq_relation_count = len(schema_index.resolve(
+            ".".join(c_sub_query_name_stack[1:])).relation_indexes)
+        items = []
+        groups = {}
+        for key, value in filters.items():
+            split_key = key.split(".")
+            group_key = None
+            if not key.startswith("$") and not any(
+                    part[:1].isdigit() for part in split_key):
+                c_full_attr_name = convert_key_names_func(
+                    _get_full_attr_name(attr_name_stack[1:], key))
+                c_split_key = (c_full_attr_name or "").split(".")[
+                    -len(split_key):]
+                try:
+                    path_info = schema_index.resolve(_get_full_attr_name(
+                        c_attr_name_stack[1:], ".".join(c_split_key)))
+                except AttributeError:
+                    path_info = None
+                if (path_info is not None and
+                        len(path_info.relation_indexes) >
+                        psq_relation_count):
+                    relation_index = path_info.relation_indexes[
+                        psq_relation_count]
+                    # position of the relationship within the key
+                    split_index = relation_index - (
+                        len(path_info.attrs) - len(split_key))
+                    relation = path_info.attrs[relation_index]
+                    if (0 <= split_index < len(split_key) - 1 and (
+                            cls.merge_relation_filters or
+                            not relation.property.uselist)):
+                        group_key = (
+                            ".".join(split_key[:split_index + 1]),
+                            ".".join(c_split_key[:split_index + 1]))
+                        sub_key = ".".join(split_key[split_index + 1:])
+            if group_key is None:
+                items.append(_MqlKeyFrame(key, value))
+            elif group_key in groups:
+                groups[group_key].filters[sub_key] = value
+            else:
+                groups[group_key] = _MqlRelationFilters(
+                    group_key[0], group_key[1], {sub_key: value},
+                    _MqlKeyFrame(key, value))
+                items.append(groups[group_key])
+        return [
+            item.original if (isinstance(item, _MqlRelationFilters) and
+                              len(item.filters) == 1) else item
+            for item in items]
+
+    @classmethod
+    async def apply_mql_filters_async(cls, model_class, query=None,
+                                      filters=None, whitelist=None,
+                                      nested_conditions=None,
+                                      stack_size_limit=None,
+                                      convert_key_names_func=None,
+                                      gettext=None, relation_strategy="exists",
+                                      cost=None, offload=False, executor=None,
+                                      sort=None, projection=None,
+                                      load_plan=None, relations=None):
+        """Async version of :meth:`apply_mql_filters`.
+
+        For use with asyncio, e.g. along with SQLAlchemy's
+        ``AsyncSession``. ``whitelist``, ``nested_conditions``, and
+        ``convert_key_names_func`` may be async callables, which are
+        awaited on the running event loop.
+
+        Parsing itself isn't async. When any async callables are
+        provided, or if ``offload`` is ``True``, filters are parsed in
+        a worker thread so the event loop isn't blocked, e.g. by huge
+        filters or a slow whitelist function. Otherwise they're parsed
+        directly.
+
+        .. code-block:: python
+
+            async def whitelist(key):
+                return await permissions.can_filter(user, key)
+
+            stmt = await MqlBuilder.apply_mql_filters_async(
+                Album, filters=filters, whitelist=whitelist)
+            albums = (await session.scalars(stmt)).all()
+
+        See :meth:`apply_mql_filters` for details on the other params.
+
+        :param bool offload: If ``True``, always parse in a worker
+            thread.
+        :param executor: Optional :class:`~concurrent.futures.Executor`
+            to parse in, defaults to the event loop's default executor.
+        :return: A filtered SQLAlchemy select object of the provided
+            `model_class`.
+        :rtype: sqlalchemy.sql.selectable.Select
+
+        """
+        return await cls._run_async(
+            cls.apply_mql_filters, offload, executor,
+            model_class=model_class,
+            query=query,
+            filters=filters,
+            whitelist=whitelist,
+            nested_conditions=nested_conditions,
+            stack_size_limit=stack_size_limit,
+            convert_key_names_func=convert_key_names_func,
+            gettext=gettext,
+            relation_strategy=relation_strategy,
+            cost=cost,
+            sort=sort,
+            projection=projection,
+            load_plan=load_plan,
+            relations=relations
+        )
+
+    @classmethod
+    async def parse_mql_filters_async(cls, model_class, filters=None,
+                                      whitelist=None, nested_conditions=None,
+                                      stack_size_limit=None,
+                                      convert_key_names_func=None,
+                                      gettext=None, cost=None, offload=False,
+                                      executor=None):
+        """Async version of :meth:`parse_mql_filters`.
+
+        See :meth:`apply_mql_filters_async` for details on how async
+        callables, ``offload``, and ``executor`` are handled.
+
+        :return: A list of SQLAlchemy expressions, or ``None``.
+
+        """
+        return await cls._run_async(
+            cls.parse_mql_filters, offload, executor,
+            model_class=model_class,
+            filters=filters,
+            whitelist=whitelist,
+            nested_conditions=nested_conditions,
+            stack_size_limit=stack_size_limit,
+            convert_key_names_func=convert_key_names_func,
+            gettext=gettext,
+            cost=cost
+        )
+
+    @classmethod
+    async def execute_mql_filters_async(cls, session, model_class,
+                                        query=None, filters=None,
+                                        whitelist=None, nested_conditions=None,
+                                        stack_size_limit=None,
+                                        convert_key_names_func=None,
+                                        gettext=None,
+                                        relation_strategy="exists",
+                                        cost=None, offload=False,
+                                        executor=None, sort=None,
+                                        projection=None, load_plan=None,
+                                        cache_key=None):
+        """Filter and execute a query using an async session.
+
+        .. code-block:: python
+
+            async with AsyncSession(engine) as session:
+                result = await MqlBuilder.execute_mql_filters_async(
+                    session, Album, filters={"artist.name": "AC/DC"})
+                albums = result.all()
+
+        See :meth:`apply_mql_filters_async` for details on the params,
+        and :meth:`execute_mql_filters` for how :attr:`result_cache` is
+        used.
+
+        :param session: A SQLAlchemy ``AsyncSession``, or anything else
+            with an async ``scalars`` method. Must be an ``AsyncSession``
+            if :attr:`result_cache` is set.
+        :param cache_key: Optional hashable value added to the
+            :attr:`result_cache` key.
+        :return: The result of the filtered query, with the first
+            entity selected for each row, e.g. instances of
+            ``model_class``.
+        :rtype: :class:`~sqlalchemy.engine.ScalarResult`
+
+        """
+        result_cache = cls.result_cache
+        relations = set() if result_cache is not None else None
+        if result_cache is not None and filters is not None:
+            filters = cls.canonicalize_mql_filters(filters)
+        stmt = await cls.apply_mql_filters_async(
+            model_class=model_class,
+            query=query,
+            filters=filters,
+            whitelist=whitelist,
+            nested_conditions=nested_conditions,
+            stack_size_limit=stack_size_limit,
+            convert_key_names_func=convert_key_names_func,
+            gettext=gettext,
+            relation_strategy=relation_strategy,
+            cost=cost,
+            offload=offload,
+            executor=executor,
+            sort=sort,
+            projection=projection,
+            load_plan=load_plan,
+            relations=relations
+        )
+        if _is_empty_statement(stmt):
+            return _get_empty_result()
+        if result_cache is None:
+            return await session.scalars(stmt)
+        for key in projection or ():
+            if convert_key_names_func is not None:
+                key = convert_key_names_func(key)
+                if isawaitable(key):
+                    key = await key
+            relations.add(key)
+        key, tables = cls._get_result_cache_key(
+            model_class, stmt, filters, relations, projection, load_plan,
+            cache_key)
+        frozen_result = result_cache.get(key, tables)
+        if frozen_result is not None:
+            result = await session.run_sync(
+                lambda sync_session: merge_frozen_result(
+                    sync_session, stmt, frozen_result, load=False)())
+            return result.scalars()
+        versions = result_cache.get_versions(tables)
+        frozen_result = (await session.execute(stmt)).freeze()
+        result_cache.set(key, tables, frozen_result, versions)
+        return frozen_result().scalars()
+
+    @classmethod
+    def stream_mql_filters(cls, session, model_class, query=None,
+                           filters=None, whitelist=None,
+                           nested_conditions=None, stack_size_limit=None,
+                           convert_key_names_func=None, gettext=None,
+                           relation_strategy="exists", cost=None,
+                           chunk_size=1000, columns=None, sort=None,
+                           projection=None, load_plan=None):
+        """Filter a query and yield its results in chunks.
+
+        The query is run with the ``yield_per`` execution option, which
+        uses a server side cursor where the database driver supports
+        one, so only around ``chunk_size`` results are held in memory
+        at a time. Useful for exporting large numbers of rows.
+
+        .. code-block:: python
+
+            for chunk in MqlBuilder.stream_mql_filters(
+                    session, Invoice, filters={"total": {"$gt": 10}},
+                    chunk_size=500):
+                write_rows(chunk)
+
+        Filters are parsed and applied when this is called, so any
+        errors are raised then, rather than once iteration starts.
+
+        Note that ``yield_per`` can't be used along with eager loading
+        of collections, and loaded instances stay in the session until
+        they're garbage collected.
+
+        See :meth:`apply_mql_filters` for details on the other params.
+
+        :param session: A SQLAlchemy
+            :class:`~sqlalchemy.orm.session.Session`.
+        :param int chunk_size: Max number of results in each chunk.
+        :param columns: Optional list of column attribute names of
+            ``model_class`` to select. If provided, plain rows of those
+            columns are yielded rather than model instances. These
+            aren't checked against the ``whitelist``.
+        :type columns: list or None
+        :raise ValueError: If an unknown column name is given.
+        :return: A generator of lists, each containing up to
+            ``chunk_size`` model instances, or rows if ``columns`` is
+            provided.
+
+        """
+        stmt = cls.apply_mql_filters(
+            model_class=model_class,
+            query=query,
+            filters=filters,
+            whitelist=whitelist,
+            nested_conditions=nested_conditions,
+            stack_size_limit=stack_size_limit,
+            convert_key_names_func=convert_key_names_func,
+            gettext=gettext,
+            relation_strategy=relation_strategy,
+            cost=cost,
+            sort=sort,
+            projection=projection,
+            load_plan=load_plan
+        )
+        if columns is not None:
+            stmt = cls._select_columns(model_class, stmt, columns)
+        return _stream_partitions(session, stmt, chunk_size, columns)
+
+    @classmethod
+    async def stream_mql_filters_async(cls, session, model_class,
+                                       query=None, filters=None,
+                                       whitelist=None, nested_conditions=None,
+                                       stack_size_limit=None,
+                                       convert_key_names_func=None,
+                                       gettext=None,
+                                       relation_strategy="exists",
+                                       cost=None, offload=False,
+                                       executor=None, chunk_size=1000,
+                                       columns=None, sort=None,
+                                       projection=None, load_plan=None):
+        """Async version of :meth:`stream_mql_filters`.
+
+        Uses ``AsyncSession.stream``, so results are fetched from a
+        server side cursor as they're iterated over.
+
+        .. code-block:: python
+
+            async for chunk in await MqlBuilder.stream_mql_filters_async(
+                    session, Invoice, filters={"total": {"$gt": 10}}):
+                await write_rows(chunk)
+
+        Filters are parsed and applied when this is awaited, with the
+        async generator of results returned.
+
+        See :meth:`apply_mql_filters_async` and
+        :meth:`stream_mql_filters` for details on the params.
+
+        :param session: A SQLAlchemy ``AsyncSession``.
+        :return: An async generator of lists, each containing up to
+            ``chunk_size`` model instances, or rows if ``columns`` is
+            provided.
+
+        """
+        stmt = await cls.apply_mql_filters_async(
+            model_class=model_class,
+            query=query,
+            filters=filters,
+            whitelist=whitelist,
+            nested_conditions=nested_conditions,
+            stack_size_limit=stack_size_limit,
+            convert_key_names_func=convert_key_names_func,
+            gettext=gettext,
+            relation_strategy=relation_strategy,
+            cost=cost,
+            offload=offload,
+            executor=executor,
+            sort=sort,
+            projection=projection,
+            load_plan=load_plan
+        )
+        if columns is not None:
+            stmt = cls._select_columns(model_class, stmt, columns)
+        return _stream_partitions_async(session, stmt, chunk_size, columns)
+
+    @classmethod
+    def _select_columns(cls, model_class, stmt, columns):
+        """Select only the given columns of a model in a statement.
+
+        :param model_class: SQLAlchemy model class being queried.
+        :param stmt: A select statement of ``model_class``.
+        :param list columns: Column attribute names to select.
+        :raise ValueError: If an unknown column name is given.
+        :return: The select statement with only ``columns`` selected.
+
+        """
+        column_attrs = inspect(model_class).mapper.column_attrs
+        attrs = []
+        for name in columns:
+            if name not in column_attrs:
+                raise ValueError("Unknown column: %s" % name)
+            attrs.append(getattr(model_class, name))
+        return stmt.with_only_columns(*attrs)
+
+    @classmethod
+    async def _run_async(cls, func, offload, executor, **kwargs):
+        """Call a sync parse function from a coroutine.
+
+        Async callables in ``kwargs`` are replaced with
+        :class:`_MqlAwaitedCallable` wrappers, and if there are any,
+        or if ``offload`` is ``True``, ``func`` is run in ``executor``.
+
+        :param callable func: The parse function to call.
+        :param bool offload: If ``True``, always run in ``executor``.
+        :param executor: Optional executor to run ``func`` in.
+        :return: The result of ``func``.
+
+        """
+        loop = asyncio.get_running_loop()
+        for name in ("whitelist", "nested_conditions",
+                     "convert_key_names_func"):
+            if _is_async_callable(kwargs[name]):
+                kwargs[name] = _MqlAwaitedCallable(kwargs[name], loop)
+                offload = True
+        if not offload:
+            return func(**kwargs)
+        # copy the context so any context variables are kept.
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(
+            executor, functools.partial(context.run, func, **kwargs))
+
+    @classmethod
+    def canonicalize_mql_filters(cls, filters):
+        """Rewrite filters in a canonical form.
+
+        Filters that only differ in ways that don't change their
+        results are rewritten the same way, e.g. for use as a cache key:
+
+        * Keys are sorted, as are the items of ``$or``, ``$nor``,
+          ``$in``, and ``$nin`` lists, with duplicates removed.
+        * A single explicit ``$eq`` becomes an implicit one, and
+          ``"null"`` becomes ``None`` for equality, range, ``$in``, and
+          ``$nin`` comparisons.
+        * Nested ``$and`` lists are flattened, along with ``$or`` lists
+          containing a single item. Unless
+          :attr:`merge_relation_filters` is set, where sibling filters
+          are grouped differently, ``$and`` lists are also merged into
+          the filters they're found in, e.g.
+          ``{"$and": [{"a": 1}, {"b": 2}]}`` becomes
+          ``{"a": 1, "b": 2}``.
+
+        Filters that aren't valid are left as is, to fail as usual when
+        parsed.
+
+        :param dict filters: Dictionary of MongoDB style query filters.
+        :return: New, canonicalized filters.
+        :rtype: dict
+
+        """
+        if not isinstance(filters, dict):
+            return filters
+        conjuncts = []
+        for key, value in filters.items():
+            if not isinstance(key, str):
+                conjuncts.append({key: value})
+            elif key == "$and" and _is_filters_list(value):
+                items = []
+                for item in value:
+                    items.extend(_split_conjuncts(
+                        cls.canonicalize_mql_filters(item)))
+                if cls.merge_relation_filters:
+                    conjuncts.append({"$and": _sort_unique(items)})
+                else:
+                    conjuncts.extend(items)
+            elif (key == "$or" or key == "$nor") and _is_filters_list(value):
+                items = _sort_unique([
+                    cls.canonicalize_mql_filters(item) for item in value])
+                if key == "$or" and len(items) == 1 and (
+                        not cls.merge_relation_filters):
+                    conjuncts.extend(_split_conjuncts(items[0]))
+                else:
+                    conjuncts.append({key: items})
+            elif key == "$not" and isinstance(value, dict):
+                conjuncts.append(
+                    {key: cls.canonicalize_mql_filters(value)})
+            elif key.startswith("$"):
+                conjuncts.append({key: value})
+            else:
+                conjuncts.append({key: cls._canonicalize_field(value)})
+        if cls.merge_relation_filters:
+            merged = {}
+            for conjunct in conjuncts:
+                merged.update(conjunct)
+            return {key: merged[key] for key in sorted(merged, key=str)}
+        return _join_conjuncts(_sort_unique(conjuncts))
+
+    @classmethod
+    def _canonicalize_field(cls, value, implicit_eq=True):
+        """Canonicalize the value of a field in a set of filters.
+
+        :param value: A comparison value, or dict of operators.
+        :param bool implicit_eq: Whether a single ``$eq`` may be made
+            implicit. Not allowed within ``$not``.
+        :return: The canonicalized value.
+
+        """
+        if isinstance(value, str) and value.lower() == "null":
+            return None
+        if not isinstance(value, dict):
+            return value
+        if (implicit_eq and len(value) == 1 and "$eq" in value and
+                not isinstance(value["$eq"], dict)):
+            return cls._canonicalize_field(value["$eq"])
+        result = {}
+        for key in sorted(value, key=str):
+            sub_value = value[key]
+            if key == "$elemMatch":
+                sub_value = cls.canonicalize_mql_filters(sub_value)
+            elif key == "$not":
+                sub_value = cls._canonicalize_field(sub_value, False)
+            elif (key == "$in" or key == "$nin") and isinstance(
+                    sub_value, list):
+                sub_value = _sort_unique([
+                    None if isinstance(item, str) and item.lower() == "null"
+                    else item for item in sub_value])
+            elif isinstance(key, str) and not key.startswith("$"):
+                sub_value = cls._canonicalize_field(sub_value)
+            elif ((key in ("$eq", "$ne") or key in _RANGE_OPS) and
+                    isinstance(sub_value, str) and
+                    sub_value.lower() == "null"):
+                # only where convert_to_alchemy_type treats it as None,
+                # e.g. $like "null" still matches the string.
+                sub_value = None
+            result[key] = sub_value
+        return result
+
+    @classmethod
+    def hash_mql_filters(cls, filters):
+        """Get a stable hash of filters.
+
+        Equivalent filters, as rewritten by
+        :meth:`canonicalize_mql_filters`, have the same hash, which
+        doesn't change between processes.
+
+        :param dict filters: Dictionary of MongoDB style query filters.
+        :return: A hex encoded SHA-256 hash.
+        :rtype: str
+
+        """
+        return hashlib.sha256(_dump_canonical(
+            cls.canonicalize_mql_filters(filters)).encode("utf-8")
+        ).hexdigest()
+
+    @classmethod
+    def normalize_mql_filters(cls, model_class, filters,
+                              convert_key_names_func=None):
+        """Simplify filters, removing redundant parts.
+
+        The normalized filters match the same records, but generally
+        produce smaller SQL:
+
+        * Nested ``$and`` and ``$or`` lists are flattened, along with
+          those holding a single item, and ``$not`` of a ``$not``.
+        * An ``$or`` of equality checks on the same column becomes a
+          single ``$in``, and ``$in`` and ``$nin`` lists have
+          duplicates removed.
+        * Range bounds on numeric columns, e.g. ``$gt`` and ``$lte``,
+          are merged, keeping the tightest of each.
+        * Branches that match nothing, such as an ``$in`` with an empty
+          list or contradictory bounds, or that match everything, are
+          folded away. Filters that can't match anything at all become
+          ``{"$alwaysFalse": 1}``, and those that match everything
+          become ``{}``.
+
+        Folding follows SQL's three valued logic, so within a ``$not``
+        or ``$nor``, branches that are false or unknown, e.g. bounds
+        compared to ``NULL``, aren't treated as false.
+
+        Anything unknown or invalid is left as is, to fail as usual
+        when parsed. Fields that are only used in folded branches can't
+        affect the results, and aren't checked against a whitelist.
+
+        Set :attr:`normalize_filters` to normalize filters whenever
+        they're parsed.
+
+        :param model_class: SQLAlchemy model class the filters are for,
+            used to find which fields are numeric columns.
+        :param dict filters: Dictionary of MongoDB style query filters.
+        :param convert_key_names_func: Optional function used to convert
+            field names, see :meth:`parse_mql_filters`.
+        :return: New, normalized filters.
+        :rtype: dict
+
+        """
+        if convert_key_names_func is None:
+            def convert_key_names_func(x): return x
+        return cls._normalize_filters(
+            filters, cls.get_schema_index(model_class),
+            convert_key_names_func, "", False)
+
+    @classmethod
+    def get_mql_filters_constant(cls, model_class, filters,
+                                 convert_key_names_func=None):
+        """Check if filters are known to match everything or nothing.
+
+        Uses :meth:`normalize_mql_filters`, so finds filters that can't
+        match anything such as ``{"track_id": {"$in": []}}``,
+        ``{"milliseconds": {"$gt": 5, "$lt": 3}}``, or
+        ``{"name": "x", "$not": {"name": "x"}}``. Not every such filter
+        is found, and as filters aren't validated, invalid filters
+        may be reported as matching nothing.
+
+        .. code-block:: python
+
+            if MqlBuilder.get_mql_filters_constant(Track, filters) is False:
+                tracks = []
+
+        :param model_class: SQLAlchemy model class the filters are for.
+        :param dict filters: Dictionary of MongoDB style query filters.
+        :param convert_key_names_func: Optional function used to convert
+            field names, see :meth:`parse_mql_filters`.
+        :return: ``True`` if the filters match everything, ``False`` if
+            they match nothing, or ``None`` if it's not known.
+        :rtype: bool or None
+
+        """
+        if filters is None:
+            return None
+        filters = cls.normalize_mql_filters(
+            model_class, filters, convert_key_names_func)
+        if _is_always_false(filters):
+            return False
+        elif not filters:
+            return True
+        return None
+
+    @classmethod
+    def _normalize_filters(cls, filters, schema_index,
+                           convert_key_names_func, prefix, negated):
+        """Normalize filters, see :meth:`normalize_mql_filters`.
+
+        :param filters: Dictionary of MongoDB style query filters.
+        :param schema_index: :class:`MqlSchemaIndex` of the model class.
+        :param callable convert_key_names_func: Converts field names.
+        :param str prefix: Dot separated name of the relationship the
+            filters are nested in, followed by a ``"."``, if any.
+        :param bool negated: Whether the filters are within a ``$not``
+            or ``$nor``, where an unknown result isn't the same as
+            ``False``.
+        :return: The normalized filters, ``{}`` if they match
+            everything, or ``{"$alwaysFalse": 1}`` if they can't
+            match anything.
+
+        """
+        if not isinstance(filters, dict):
+            return filters
+        merge = cls.merge_relation_filters
+        # single key filters, and with merge_relation_filters, filters
+        # that must stay separate from their siblings.
+        conjuncts = []
+        groups = []
+
+        def add_group(group):
+            if not merge:
+                conjuncts.extend(_split_conjuncts(group))
+            elif list(group) == ["$and"] and _is_filters_list(group["$and"]):
+                groups.extend(group["$and"])
+            else:
+                groups.append(group)
+
+        for key, value in filters.items():
+            if not isinstance(key, str):
+                conjuncts.append({key: value})
+            elif key == "$and" and _is_filters_list(value):
+                for item in value:
+                    item = cls._normalize_filters(
+                        item, schema_index, convert_key_names_func, prefix,
+                        negated)
+                    if _is_always_false(item):
+                        return {"$alwaysFalse": 1}
+                    elif item:
+                        add_group(item)
+            elif ((key == "$or" or key == "$nor") and
+                    _is_filters_list(value) and any(value)):
+                items = []
+                matches_all = False
+                # empty filters are skipped by the parser, rather than
+                # matching everything.
+                for item in value:
+                    if not item:
+                        continue
+                    item = cls._normalize_filters(
+                        item, schema_index, convert_key_names_func, prefix,
+                        negated if key == "$or" else not negated)
+                    if not item:
+                        matches_all = True
+                        break
+                    elif _is_always_false(item):
+                        continue
+                    elif key == "$or" and list(item) == ["$or"]:
+                        items.extend(item["$or"])
+                    else:
+                        items.append(item)
+                if key == "$nor":
+                    if matches_all:
+                        return {"$alwaysFalse": 1}
+                    elif items:
+                        conjuncts.append({key: _unique(items)})
+                elif matches_all:
+                    continue
+                else:
+                    items = _unique(cls._merge_equality_checks(
+                        items, schema_index, convert_key_names_func, prefix))
+                    if not items:
+                        return {"$alwaysFalse": 1}
+                    elif len(items) == 1:
+                        add_group(items[0])
+                    else:
+                        conjuncts.append({key: items})
+            elif key == "$not" and isinstance(value, dict):
+                item = cls._normalize_filters(
+                    value, schema_index, convert_key_names_func, prefix,
+                    not negated)
+                if not item:
+                    return {"$alwaysFalse": 1}
+                elif _is_always_false(item):
+                    continue
+                elif list(item) == ["$not"] and isinstance(
+                        item["$not"], dict):
+                    add_group(item["$not"])
+                else:
+                    conjuncts.append({key: item})
+            elif key == "$alwaysFalse":
+                return {"$alwaysFalse": 1}
+            elif key == "$alwaysTrue":
+                continue
+            elif key.startswith("$"):
+                conjuncts.append({key: value})
+            else:
+                constant, value = cls._normalize_field(
+                    key, value, schema_index, convert_key_names_func, prefix,
+                    negated)
+                if constant is False:
+                    return {"$alwaysFalse": 1}
+                elif constant is None:
+                    conjuncts.append({key: value})
+        if not merge:
+            conjuncts = cls._merge_range_conjuncts(
+                _unique(conjuncts), schema_index, convert_key_names_func,
+                prefix, negated)
+            if conjuncts is None:
+                return {"$alwaysFalse": 1}
+        if not negated and _has_negated_sibling(conjuncts, groups, merge):
+            # e.g. {"a": 1, "$not": {"a": 1}}, which is false or unknown.
+            return {"$alwaysFalse": 1}
+        if not merge:
+            keys = [key for conjunct in conjuncts for key in conjunct]
+            if len(set(keys)) != len(keys):
+                return {"$and": conjuncts}
+        result = {}
+        for conjunct in conjuncts:
+            result.update(conjunct)
+        groups = _unique(groups)
+        if groups and not result and len(groups) == 1:
+            return groups[0]
+        elif groups:
+            result["$and"] = groups
+        return result
+
+    @classmethod
+    def _normalize_field(cls, key, value, schema_index,
+                         convert_key_names_func, prefix, negated):
+        """Normalize the value of a field in a set of filters.
+
+        See :meth:`_normalize_filters` for details on the params.
+
+        :param str key: The field name.
+        :param value: A comparison value, or dict of operators.
+        :return: A tuple of ``True`` or ``False`` if the field matches
+            everything or nothing, otherwise ``None``, and the
+            normalized value.
+        :rtype: tuple
+
+        """
+        if not (isinstance(value, dict) and value and all(
+                isinstance(op, str) and op.startswith("$") for op in value)):
+            return None, value
+        path_info = cls._get_normalize_path_info(
+            schema_index, convert_key_names_func, prefix + key)
+        return cls._normalize_ops(
+            list(value.items()), path_info, schema_index,
+            convert_key_names_func, prefix + key + ".", negated)
+
+    @classmethod
+    def _normalize_ops(cls, pairs, path_info, schema_index,
+                       convert_key_names_func, prefix, negated):
+        """Normalize the operators used on a field.
+
+        :param list pairs: ``(op, value)`` tuples for the field.
+        :param path_info: :class:`MqlPathInfo` for the field, or
+            ``None`` if it couldn't be resolved.
+        :param str prefix: The field name followed by a ``"."``, used
+            for any ``$elemMatch``.
+        :return: See :meth:`_normalize_field`.
+        :rtype: tuple
+
+        """
+        if (len(pairs) == 1 and pairs[0][0] == "$not" and
+                isinstance(pairs[0][1], dict) and
+                list(pairs[0][1]) == ["$not"] and
+                isinstance(pairs[0][1]["$not"], dict) and pairs[0][1]["$not"]):
+            # double negation.
+            return cls._normalize_ops(
+                list(pairs[0][1]["$not"].items()), path_info, schema_index,
+                convert_key_names_func, prefix, negated)
+        ops = []
+        bounds = {True: None, False: None}
+        bounds_index = None
+        for op, value in pairs:
+            number = cls._get_normalize_number(value, path_info)
+            if op in _RANGE_OPS and number is not None:
+                is_lower, strict = _RANGE_OPS[op]
+                bound = bounds[is_lower]
+                if bound is None or (
+                        (number > bound[0]) == is_lower and
+                        number != bound[0]) or (
+                        number == bound[0] and strict):
+                    # the converted value is compared, the given one
+                    # is kept in the filters.
+                    bounds[is_lower] = (number, strict, value)
+                if bounds_index is None:
+                    bounds_index = len(ops)
+                continue
+            elif op == "$in" and isinstance(value, list):
+                value = _unique(value)
+                if not value:
+                    # an empty IN is always false, even for NULL.
+                    return False, None
+            elif op == "$nin" and isinstance(value, list):
+                value = _unique(value)
+                if not value:
+                    continue
+            elif op == "$not" and isinstance(value, dict) and value and all(
+                    isinstance(sub_op, str) and sub_op.startswith("$")
+                    for sub_op in value):
+                constant, value = cls._normalize_ops(
+                    list(value.items()), path_info, schema_index,
+                    convert_key_names_func, prefix, not negated)
+                if constant is False:
+                    continue
+                elif constant is True:
+                    return False, None
+            elif op == "$elemMatch" and isinstance(value, dict):
+                # EXISTS is never unknown, so the sub query isn't
+                # negated even if this is.
+                value = cls._normalize_filters(
+                    value, schema_index, convert_key_names_func, prefix,
+                    False)
+                if _is_always_false(value):
+                    return False, None
+            elif op == "$alwaysFalse":
+                return False, None
+            elif op == "$alwaysTrue":
+                continue
+            ops.append((op, value))
+        lower, upper = bounds[True], bounds[False]
+        if not negated:
+            # Only unknown or false, rather than always false, for NULL.
+            if lower is not None and upper is not None and (
+                    lower[0] > upper[0] or (
+                        lower[0] == upper[0] and (lower[1] or upper[1]))):
+                return False, None
+            if _has_excluded_values(dict(ops)):
+                return False, None
+            for op, value in ops:
+                number = cls._get_normalize_number(value, path_info)
+                if op == "$eq" and number is not None and (
+                        (lower is not None and (
+                            number < lower[0] or
+                            (number == lower[0] and lower[1]))) or
+                        (upper is not None and (
+                            number > upper[0] or
+                            (number == upper[0] and upper[1])))):
+                    return False, None
+        if bounds_index is not None:
+            range_ops = []
+            if lower is not None:
+                range_ops.append(("$gt" if lower[1] else "$gte", lower[2]))
+            if upper is not None:
+                range_ops.append(("$lt" if upper[1] else "$lte", upper[2]))
+            ops[bounds_index:bounds_index] = range_ops
+        if not ops:
+            return True, None
+        return None, dict(ops)
+
+    @classmethod
+    def _get_normalize_number(cls, value, path_info):
+        """Get a value compared against a numeric column as in SQL.
+
+        The value is converted for the column's type, so e.g. a float
+        compared against an integer column is truncated, as it is when
+        the filters are parsed.
+
+        :param value: A value the field is compared against.
+        :param path_info: :class:`MqlPathInfo` for the field, or
+            ``None`` if it couldn't be resolved.
+        :return: The converted value, or ``None`` if the field isn't a
+            numeric column or the value isn't a number.
+
+        """
+        if not (path_info is not None and path_info.kind == "column" and
+                issubclass(path_info.column_type,
+                           tuple(cls.int_types + cls.float_types)) and
+                _is_number(value)):
+            return None
+        try:
+            value = cls.convert_to_alchemy_type(value, path_info.column_type)
+        except (TypeError, ValueError, OverflowError):
+            return None
+        return value if _is_number(value) else None
+
+    @classmethod
+    def _merge_range_conjuncts(cls, conjuncts, schema_index,
+                               convert_key_names_func, prefix, negated):
+        """Merge range bounds given separately for the same column.
+
+        E.g. ``[{"a": {"$gt": 1}}, {"a": {"$lt": 5}}]`` becomes
+        ``[{"a": {"$gt": 1, "$lt": 5}}]``. Only columns of the model
+        being filtered are merged, as separate filters on a related
+        collection may match different related records.
+
+        :param list conjuncts: Single key filters.
+        :return: The merged list of filters, or ``None`` if they can't
+            match anything.
+
+        """
+        merged = []
+        positions = {}
+        for conjunct in conjuncts:
+            [(key, value)] = conjunct.items()
+            if (isinstance(key, str) and not key.startswith("$") and
+                    "." not in key and isinstance(value, dict) and value and
+                    all(op in _RANGE_OPS for op in value)):
+                if key in positions:
+                    path_info = cls._get_normalize_path_info(
+                        schema_index, convert_key_names_func, prefix + key)
+                    index = positions[key]
+                    if not (path_info is not None and
+                            path_info.kind == "column" and issubclass(
+                                path_info.column_type,
+                                tuple(cls.int_types + cls.float_types))):
+                        merged.append(conjunct)
+                        continue
+                    existing = merged[index][key]
+                    if set(existing) & set(value) and not all(
+                            cls._get_normalize_number(item, path_info)
+                            is not None for item in
+                            list(existing.values()) + list(value.values())):
+                        # a repeated op can only be merged by keeping
+                        # the tighter of two numeric bounds.
+                        merged.append(conjunct)
+                        continue
+                    constant, ops = cls._normalize_ops(
+                        list(existing.items()) +
+                        list(value.items()), path_info, schema_index,
+                        convert_key_names_func, prefix + key + ".", negated)
+                    if constant is False:
+                        return None
+                    if (constant is None and
+                            all(op in _RANGE_OPS for op in ops) and
+                            len(ops) <= 2):
+                        merged[index] = {key: ops}
+                        continue
+                else:
+                    positions[key] = len(merged)
+            merged.append(conjunct)
+        return merged
+
+    @classmethod
+    def _merge_equality_checks(cls, items, schema_index,
+                               convert_key_names_func, prefix):
+        """Merge ``$or`` items checking the same column for equality.
+
+        E.g. ``[{"a": 1}, {"a": {"$in": [2, 3]}}]`` becomes
+        ``[{"a": {"$in": [1, 2, 3]}}]``.
+
+        :param list items: Normalized ``$or`` items.
+        :return: The merged list of items.
+        :rtype: list
+
+        """
+        values = {}
+        for item in items:
+            key, item_values = _get_equality_values(item)
+            if key is not None:
+                values.setdefault(key, []).append(item_values)
+        for key in list(values):
+            path_info = cls._get_normalize_path_info(
+                schema_index, convert_key_names_func, prefix + key)
+            if (len(values[key]) == 1 or path_info is None or
+                    path_info.kind != "column"):
+                del values[key]
+        merged = []
+        for item in items:
+            key, item_values = _get_equality_values(item)
+            if key not in values:
+                merged.append(item)
+            elif values[key] is not None:
+                merged.append({key: {"$in": _unique([
+                    value for sub_values in values[key]
+                    for value in sub_values])}})
+                # only added at the position of the first item.
+                values[key] = None
+        return merged
+
+    @classmethod
+    def _get_normalize_path_info(cls, schema_index, convert_key_names_func,
+                                 full_attr_name):
+        """Resolve a field name while normalizing filters.
+
+        :return: A :class:`MqlPathInfo`, or ``None`` if the field is
+            invalid, to be reported when the filters are parsed.
+
+        """
+        c_full_attr_name = convert_key_names_func(full_attr_name)
+        if c_full_attr_name is None:
+            return None
+        try:
+            return schema_index.resolve(c_full_attr_name)
+        except AttributeError:
+            return None
+
+    @classmethod
+    def validate(cls, model_class, filters, whitelist=None,
+                 stack_size_limit=None, convert_key_names_func=None,
+                 gettext=None, cost=None):
+        """Check filters for errors without building any SQL.
+
+        A cheap way to reject bad or overly expensive filters before
+        doing any other work. Filters are checked for the same errors
+        :meth:`parse_mql_filters` would raise, including invalid
+        structure, operators, whitelist permissions, and values that
+        can't be converted to the type of their field. Rather than
+        stopping at the first error, every error found is returned.
+
+        .. code-block:: python
+
+            errors = MqlBuilder.validate(
+                Album, filters, whitelist=whitelist,
+                cost=MqlCost(max_cost=100))
+            if errors:
+                return {"errors": [error.message for error in errors]}
+
+        Fields that don't exist are reported with an ``"invalid_field"``
+        code, rather than raising an :class:`AttributeError`.
+
+        See :meth:`parse_mql_filters` for details on the parameters.
+
+        :param model_class: SQLAlchemy model class the filters are for.
+        :param dict filters: Dictionary of MongoDB style query filters.
+        :param whitelist: Used to determine whether it's permissible to
+            filter by a given field.
+        :type whitelist: callable, list, MqlWhitelist, or None
+        :param stack_size_limit: Optional parameter used to limit the
+            allowable complexity of the provided filters.
+        :type stack_size_limit: int or None
+        :param convert_key_names_func: Optional function used to convert
+            a provided attribute name into a field name for a model.
+        :type convert_key_names_func: callable
+        :param gettext: Supply a translation function to convert error
+            messages to the desired language.
+        :type gettext: callable or None
+        :param cost: Optional :class:`MqlCost` used to estimate the
+            cost of the filters, and limit it to a budget.
+        :type cost: :class:`MqlCost` or None
+        :return: A list of :class:`InvalidMqlException`, empty if the
+            filters are valid. A :class:`MqlTooComplex` ends the
+            checking, and is always last.
+        :rtype: list
+
+        """
+        errors = []
+        try:
+            cls._parse_mql_filters(
+                model_class=model_class,
+                filters=filters,
+                whitelist=whitelist,
+                stack_size_limit=stack_size_limit,
+                convert_key_names_func=convert_key_names_func,
+                gettext=gettext,
+                errors=errors,
+                cost=cost
+            )
+        except MqlTooComplex as exc:
+            errors.append(exc)
+        return errors
+
+    @classmethod
+    def _invalid_field_error(cls, data_key, filters, gettext):
+        """Get the error for a field that doesn't exist.
+
+        :param str data_key: Dot separated name of the field, as
+            provided by the user.
+        :param filters: The filters applied to the field.
+        :param callable gettext: Used for translating error messages.
+        :return: A new :class:`MqlFieldError`.
+
+        """
+        _ = gettext
+        return MqlFieldError(
+            data_key=data_key,
+            op=None,
+            filters=filters,
+            code="invalid_field",
+            message=_("Invalid field.")
+        )
+
+    @classmethod
+    def compile(cls, model_class, filters_template=None, whitelist=None,
+                nested_conditions=None, stack_size_limit=None,
+                convert_key_names_func=None, gettext=None):
+        """Parse filters once into a reusable :class:`MqlFilterPlan`.
+
+        Useful when the same structure of filters is used over and over
+        with different values. All of the whitelist checks, attribute
+        and relationship resolution, and expression building are done
+        up front, with values in ``filters_template`` replaced by bound
+        parameters. Binding new values to the plan only requires
+        converting them to the proper types, and since the generated SQL
+        stays the same, SQLAlchemy's compiled statement cache is reused.
+
+        .. code-block:: python
+
+            plan = MqlBuilder.compile(
+                Album, {"tracks.playlists.playlist_id": 0})
+            stmt = plan.apply(
+                filters={"tracks.playlists.playlist_id": 18})
+
+        Note that ``nested_conditions`` are evaluated only once, when
+        the plan is compiled.
+
+        See :meth:`parse_mql_filters` for details on the parameters.
+
+        :param model_class: SQLAlchemy model class you want to query.
+        :param dict filters_template: Dictionary of MongoDB style query
+            filters. The values used are unimportant, other than
+            ``null`` values, lists, and ``$exists`` values, which
+            determine the structure of the generated expressions.
+        :param whitelist: Used to determine whether it's permissible to
+            filter by a given field.
+        :type whitelist: callable, list, MqlWhitelist, or None
+        :param nested_conditions: Provides SQL expressions for
+            additional filtering on any nested relationships.
+        :type nested_conditions: callable, dict, or None
+        :param stack_size_limit: Optional parameter used to limit the
+            allowable complexity of the provided filters.
+        :type stack_size_limit: int or None
+        :param convert_key_names_func: Optional function used to convert
+            a provided attribute name into a field name for a model.
+        :type convert_key_names_func: callable
+        :param gettext: Supply a translation function to convert error
+            messages to the desired language.
+        :type gettext: callable or None
+        :return: A compiled filter plan.
+        :rtype: :class:`MqlFilterPlan`
+
+        """
+        slots = []
+        values = []
+        relations = set()
+        shape, template = _split_filters(filters_template, values, slots)
+        try:
+            nodes = cls._parse_mql_filters(
+                model_class=model_class,
+                filters=template,
+                whitelist=whitelist,
+                nested_conditions=nested_conditions,
+                stack_size_limit=stack_size_limit,
+                convert_key_names_func=convert_key_names_func,
+                gettext=gettext,
+                plan_nodes=True,
+                relations=relations
+            )
+        except MqlFieldError as error:
+            # Report the provided values, not the slots standing in for
+            # them.
+            error.filter = _fill_slots(error.filter, values)
+            raise
+        return MqlFilterPlan(model_class, shape, nodes, slots, relations)
+
+    @classmethod
+    def compile_predicate(cls, model_class, filters=None, whitelist=None,
+                          stack_size_limit=None, convert_key_names_func=None,
+                          gettext=None):
+        """Compile filters into a function that checks in memory objects.
+
+        Useful for applying the same filters used to query the database
+        to objects that have already been loaded, such as cached query
+        results. The filters are parsed once, and the returned function
+        can then check any number of objects without generating SQL.
+
+        .. code-block:: python
+
+            predicate = MqlBuilder.compile_predicate(
+                Album, {"tracks.playlists.playlist_id": 18})
+            albums = [album for album in albums if predicate(album)]
+
+        Objects may be instances of ``model_class`` or dicts, with
+        relationships given as nested dicts or lists of dicts. Filters
+        are evaluated as the database would, with comparisons to
+        missing or ``None`` values never matching. ``$like`` is case
+        insensitive, as it is by default with SQLite and MySQL.
+
+        See :meth:`parse_mql_filters` for details on the parameters.
+        ``nested_conditions`` aren't supported, as they're SQL
+        expressions.
+
+        :param model_class: SQLAlchemy model class the filters are for.
+        :param dict filters: Dictionary of MongoDB style query filters.
+        :param whitelist: Used to determine whether it's permissible to
+            filter by a given field.
+        :type whitelist: callable, list, MqlWhitelist, or None
+        :param stack_size_limit: Optional parameter used to limit the
+            allowable complexity of the provided filters.
+        :type stack_size_limit: int or None
+        :param convert_key_names_func: Optional function used to convert
+            a provided attribute name into a field name for a model.
+        :type convert_key_names_func: callable
+        :param gettext: Supply a translation function to convert error
+            messages to the desired language.
+        :type gettext: callable or None
+        :return: A callable taking a model instance or dict, returning
+            ``True`` if it matches the filters, otherwise ``False``.
+
+        """
+        predicates = cls._parse_mql_filters(
+            model_class=model_class,
+            filters=filters,
+            whitelist=whitelist,
+            stack_size_limit=stack_size_limit,
+            convert_key_names_func=convert_key_names_func,
+            gettext=gettext,
+            predicates=True
+        )
+        predicate = _combine_predicates(sqlalchemy.and_, predicates or [True])
+
+        def matches(obj):
+            return predicate(obj) is True
+        return matches
+
+    @classmethod
+    def compile_vectorized(cls, model_class, filters=None, whitelist=None,
+                           stack_size_limit=None,
+                           convert_key_names_func=None, gettext=None):
+        """Compile filters into a function that filters columnar data.
+
+        The columnar equivalent of :meth:`compile_predicate`, for data
+        held as a dict of columns rather than as model instances. Each
+        filter is evaluated against a whole column at a time using
+        NumPy, with ``$and``, ``$or``, and ``$not`` combining the
+        resulting boolean masks.
+
+        .. code-block:: python
+
+            vectorized = MqlBuilder.compile_vectorized(
+                Track, {"milliseconds": {"$gt": 300000}})
+            mask = vectorized({
+                "track_id": numpy.array([1, 2, 3]),
+                "milliseconds": numpy.array([343719, 342562, 230619])})
+
+        Columns are keyed by attr name and may be NumPy arrays or
+        lists. Each column used is converted to ``target_type`` once
+        per call if needed, with ``None``, ``NaN``, and ``NaT`` values
+        treated as nulls. Only columns of ``model_class`` may be
+        filtered, not relationships.
+
+        NumPy is an optional dependency, installed with
+        ``pip install mqlalchemy[numpy]``.
+
+        See :meth:`compile_predicate` for details on the parameters.
+
+        :raise ImportError: If NumPy isn't installed.
+        :raise MqlFieldError: If a relationship is filtered.
+        :return: A callable taking a dict of columns and returning a
+            boolean NumPy array, ``True`` for rows matching the filters.
+
+        """
+        if numpy is None:    # pragma: no cover
+            raise ImportError(
+                "NumPy is required for vectorized filters, install it "
+                "using: pip install mqlalchemy[numpy]")
+        masks = cls._parse_mql_filters(
+            model_class=model_class,
+            filters=filters,
+            whitelist=whitelist,
+            stack_size_limit=stack_size_limit,
+            convert_key_names_func=convert_key_names_func,
+            gettext=gettext,
+            masks=True
+        )
+        mask = _combine_masks(sqlalchemy.and_, masks or [True])
+
+        def vectorized(columns):
+            return mask(_MqlColumnBatch(columns))[0]
+        return vectorized
+
+    @classmethod
+    def convert_to_alchemy_type(cls, value, alchemy_type):
+        """Convert a given value to a sqlalchemy friendly type.
+
+        As a simple example, if given the string ``"5"`` as ``value``,
+        for an ``alchemy_type`` of ``INT``, this will return the int
+        ``5``.
+
+        :param value: User supplied value for a filter.
+        :param alchemy_type: Target SQLAlchemy data type class to
+            convert ``value`` to play nicely with.
+        :raise TypeError:
+        :return: A version of ``value`` that can be used in a SQLAlchemy
+            expression involving an attr of the ``alchemy_type``.
+
+        """
+        if value is None or (
+                isinstance(value, str) and value.lower() == "null"):
+            return None
+        try:
+            converter = cls._converters[alchemy_type]
+        except (KeyError, TypeError):
+            converter = cls._get_converter(alchemy_type)
+        return converter(value)
+
+    @classmethod
+    def convert_list_to_alchemy_type(cls, values, alchemy_type):
+        """Convert a list of values to a sqlalchemy friendly type.
+
+        Used for ``$in`` and ``$nin`` values. If every value is already
+        of the Python type that ``alchemy_type`` converts to, the values
+        are returned without converting each one individually, unless
+        any is a ``"null"`` string.
+
+        :param list values: User supplied values for a filter.
+        :param alchemy_type: Target SQLAlchemy data type class to
+            convert ``values`` to play nicely with.
+        :raise TypeError:
+        :return: A new list of converted values.
+        :rtype: list
+
+        """
+        if (getattr(cls.convert_to_alchemy_type, "__func__", None) is not
+                MqlBuilder.convert_to_alchemy_type.__func__):
+            # respect any custom conversions.
+            return [cls.convert_to_alchemy_type(value, alchemy_type)
+                    for value in values]
+        converter = cls._get_converter(alchemy_type)
+        python_type = _converter_python_types.get(converter)
+        if python_type is not None and all(
+                type(value) is python_type for value in values) and not (
+                    python_type is str and
+                    any(value.lower() == "null" for value in values)):
+            # "null" strings still need converting to None.
+            return list(values)
+        return [
+            None if value is None or (
+                isinstance(value, str) and value.lower() == "null")
+            else converter(value)
+            for value in values]
+
+    @classmethod
+    def _get_converter(cls, alchemy_type):
+        """Get the function used to convert values for an alchemy type.
+
+        The converter is chosen using the first class in the MRO of
+        ``alchemy_type`` found in one of the ``*_types`` lists, and is
+        cached on the class after the first lookup.
+
+        :param alchemy_type: Target SQLAlchemy data type class.
+        :raise TypeError: If no converter exists for ``alchemy_type``.
+        :return: A function taking a single, non null value.
+        :rtype: callable
+
+        """
+        converters = cls._converters
+        if alchemy_type in converters:
+            return converters[alchemy_type]
+        type_converters = (
+            (cls.int_types, _convert_int),
+            (cls.text_types, _convert_text),
+            (cls.bool_types, _convert_bool),
+            (cls.date_types, _convert_date),
+            (cls.datetime_types, _convert_datetime),
+            (cls.float_types, _convert_float),
+            (cls.time_types, _convert_time)
+        )
+        for base in getattr(alchemy_type, "__mro__", (alchemy_type, )):
+            for types, converter in type_converters:
+                if base in types:
+                    converters[alchemy_type] = converter
+                    return converter
+        raise TypeError("Unable to convert value to alchemy type.")
+
+
+def _convert_int(value):
+    """Convert a non null value for an integer type."""
+    if not isinstance(value, int):
+        return int(value)
+    return value
+
+
+def _convert_text(value):
+    """Convert a non null value for a text type."""
+    return str(value)
+
 
-        As a simple example, if given the string ``"5"`` as ``value``,
-        for an ``alchemy_type`` of ``INT``, this will return the int
-        ``5``.
+def _convert_bool(value):
+    """Convert a non null value for a boolean type."""
+    if not isinstance(value, bool):
+        if (str(value).lower() == "false" or
+                value == "0" or
+                value == 0 or
+                value is False):
+            return False
+        else:
+            return True
+    return value
 
-        :param value: User supplied value for a filter.
-        :param alchemy_type: Target SQLAlchemy data type class to
-            convert ``value`` to play nicely with.
-        :raise TypeError:
-        :return: A version of ``value`` that can be used in a SQLAlchemy
-            expression involving an attr of the ``alchemy_type``.
 
-        """
-        if value is None or str(value).lower() == "null":
-            return None
-        elif alchemy_type in cls.int_types:
-            if not isinstance(value, int):
-                return int(value)
-            else:
-                return value
-        elif alchemy_type in cls.text_types:
-            return str(value)
-        elif alchemy_type in cls.bool_types:
-            if not isinstance(value, bool):
-                if (str(value).lower() == "false" or
-                        value == "0" or
-                        value == 0 or
-                        value is False):
+def _convert_date(value):
+    """Convert a non null value for a date type."""
+    if not isinstance(value, datetime.date):
+        return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+    return value
+
+
+def _convert_datetime(value):
+    """Convert a non null value for a datetime type."""
+    if not isinstance(value, datetime.datetime):
+        return datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+    return value
+
+
+def _convert_float(value):
+    """Convert a non null value for a float type."""
+    if not isinstance(value, float):
+        return float(value)
+    return value
+
+
+def _convert_time(value):
+    """Convert a non null value for a time type."""
+    if not isinstance(value, datetime.time):
+        return datetime.datetime.strptime(value, '%H:%M:%S').time()
+    return value
+
+
+# Python type returned by each converter, where values of exactly that
+# type can be used as is.
+_converter_python_types = {
+    _convert_int: int,
+    _convert_text: str,
+    _convert_bool: bool,
+    _convert_date: datetime.date,
+    _convert_datetime: datetime.datetime,
+    _convert_float: float,
+    _convert_time: datetime.time
+}
+
+
+def _combine_predicates(op, predicates):
+    """Combine in memory predicates using a query tree op.
+
+    Uses SQL's three valued logic, where ``None`` is unknown.
+
+    :param op: ``sqlalchemy.and_``, ``sqlalchemy.or_``,
+        ``sqlalchemy.not_``, or a callable taking a single predicate,
+        such as one wrapping :func:`_relation_predicate`.
+    :param list predicates: Predicates, or ``True`` for an empty filter.
+    :return: A single predicate.
+
+    """
+    predicates = [
+        predicate if callable(predicate) else _true_predicate
+        for predicate in predicates]
+    if op is sqlalchemy.or_:
+        def predicate(obj):
+            result = False
+            for sub_predicate in predicates:
+                value = sub_predicate(obj)
+                if value:
+                    return True
+                elif value is None:
+                    result = None
+            return result
+        return predicate
+    elif op is sqlalchemy.not_:
+        sub_predicate = predicates[0]
+
+        def predicate(obj):
+            value = sub_predicate(obj)
+            return None if value is None else not value
+        return predicate
+    if len(predicates) == 1:
+        predicate = predicates[0]
+    else:
+        def predicate(obj):
+            result = True
+            for sub_predicate in predicates:
+                value = sub_predicate(obj)
+                if value is False:
                     return False
+                elif value is None:
+                    result = None
+            return result
+    if op is sqlalchemy.and_:
+        return predicate
+    return op(predicate)
+
+
+def _compile_like(value):
+    """Compile a regex matching text like ``"%" + value + "%"`` would.
+
+    :param str value: A ``$like`` value, where ``%`` and ``_`` are
+        wildcards.
+    :return: A compiled, case insensitive regex to search text with.
+
+    """
+    return re.compile("".join(
+        ".*" if char == "%" else "." if char == "_" else re.escape(char)
+        for char in value), re.IGNORECASE | re.DOTALL)
+
+
+def _true_predicate(obj):
+    """Predicate for an empty filter, which matches everything."""
+    return True
+
+
+def _false_predicate(obj):
+    """Predicate for ``$alwaysFalse``, which matches nothing."""
+    return False
+
+
+def _relation_predicate(key, uselist, predicate):
+    """Wrap a predicate to check an object's related objects.
+
+    :param str key: Name of the relationship attribute.
+    :param bool uselist: Whether the relationship is a collection.
+    :param callable predicate: Predicate for the related objects.
+    :return: A predicate that matches if any related object matches,
+        like ``.any()`` or ``.has()`` would.
+
+    """
+    if uselist:
+        def relation_predicate(obj):
+            related = (obj.get(key) if type(obj) is dict
+                       else getattr(obj, key, None))
+            if related:
+                for related_obj in related:
+                    if predicate(related_obj) is True:
+                        return True
+            return False
+    else:
+        def relation_predicate(obj):
+            related = (obj.get(key) if type(obj) is dict
+                       else getattr(obj, key, None))
+            return related is not None and predicate(related) is True
+    return relation_predicate
+
+
+class _MqlColumnBatch(object):
+
+    """Columnar data being filtered by a vectorized filter."""
+
+    __slots__ = ("columns", "size", "_prepared")
+
+    def __init__(self, columns):
+        """Initializes a new batch.
+
+        :param dict columns: NumPy arrays or lists, keyed by attr name.
+
+        """
+        self.columns = columns
+        self.size = len(next(iter(columns.values()))) if columns else 0
+        self._prepared = {}
+
+    def get(self, key, convert, python_type):
+        """Get a column as a NumPy array along with its nulls.
+
+        :param str key: Attr name of the column.
+        :param convert: Callable used to convert values that aren't
+            already ``python_type``, or ``None`` to skip conversion.
+        :param python_type: Python type the column's values should be.
+        :raise KeyError: If the column isn't in the batch.
+        :return: A tuple of the column values and a boolean array that
+            is ``True`` for nulls. Each column is prepared only once.
+
+        """
+        try:
+            return self._prepared[key, convert is None]
+        except KeyError:
+            pass
+        values = numpy.asarray(self.columns[key])
+        if values.dtype.kind == "O":
+            nulls = numpy.equal(values, None)
+        elif values.dtype.kind == "f":
+            nulls = numpy.isnan(values)
+        elif values.dtype.kind in "mM":
+            nulls = numpy.isnat(values)
+        else:
+            nulls = numpy.zeros(len(values), dtype=bool)
+        if (convert is not None and python_type is not None and
+                values.dtype.kind in "OUS"):
+            present = values[~nulls]
+            if any(type(value) is not python_type for value in present):
+                converted = numpy.empty(len(values), dtype=object)
+                try:
+                    converted[~nulls] = [convert(value) for value in present]
+                except (TypeError, ValueError):
+                    pass
                 else:
-                    return True
-            else:
-                return value
-        elif alchemy_type in cls.date_types:
-            if not isinstance(value, datetime.date):
-                return datetime.datetime.strptime(value, '%Y-%m-%d').date()
-            else:
-                return value
-        elif alchemy_type in cls.datetime_types:
-            if not isinstance(value, datetime.datetime):
-                return datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
-            else:
-                return value
-        elif alchemy_type in cls.float_types:
-            if not isinstance(value, float):
-                return float(value)
-            else:
-                return value
-        elif alchemy_type in cls.time_types:
-            if not isinstance(value, datetime.time):
-                return datetime.datetime.strptime(value, '%H:%M:%S').time()
+                    values = converted
+                    if not nulls.any():
+                        # let NumPy pick a native dtype where possible
+                        values = numpy.asarray(converted.tolist())
+        self._prepared[key, convert is None] = values, nulls
+        return values, nulls
+
+    def apply(self, values, nulls, match):
+        """Apply a vectorized match to the non null values of a column.
+
+        :param values: NumPy array of column values.
+        :param nulls: Boolean NumPy array that is ``True`` for nulls.
+        :param callable match: Takes an array of non null values and
+            returns a boolean array.
+        :return: A ``(true, false)`` tuple of boolean arrays.
+
+        """
+        if nulls.any():
+            present = ~nulls
+            true = numpy.zeros(self.size, dtype=bool)
+            true[present] = match(values[present])
+            return true, present & ~true
+        true = numpy.asarray(match(values), dtype=bool)
+        return true, ~true
+
+    def unknown(self):
+        """Get masks for a result that is unknown for every row."""
+        return (numpy.zeros(self.size, dtype=bool),
+                numpy.zeros(self.size, dtype=bool))
+
+
+def _combine_masks(op, masks):
+    """Combine vectorized filters using a query tree op.
+
+    Each filter returns a ``(true, false)`` tuple of boolean arrays,
+    which allows for SQL's three valued logic.
+
+    :param op: ``sqlalchemy.and_``, ``sqlalchemy.or_``, or
+        ``sqlalchemy.not_``.
+    :param list masks: Vectorized filters, or ``True`` for an empty
+        filter.
+    :return: A single vectorized filter.
+
+    """
+    masks = [mask if callable(mask) else _true_mask for mask in masks]
+    if op is sqlalchemy.not_:
+        sub_mask = masks[0]
+
+        def mask(batch):
+            true, false = sub_mask(batch)
+            return false, true
+        return mask
+    elif len(masks) == 1:
+        return masks[0]
+    is_or = op is sqlalchemy.or_
+
+    def mask(batch):
+        true, false = masks[0](batch)
+        for sub_mask in masks[1:]:
+            sub_true, sub_false = sub_mask(batch)
+            if is_or:
+                true, false = true | sub_true, false & sub_false
             else:
-                return value
-        raise TypeError("Unable to convert value to alchemy type.")
+                true, false = true & sub_true, false | sub_false
+        return true, false
+    return mask
+
+
+def _true_mask(batch):
+    """Vectorized filter for an empty filter, which matches all rows."""
+    return (numpy.ones(batch.size, dtype=bool),
+            numpy.zeros(batch.size, dtype=bool))
+
+
+def _false_mask(batch):
+    """Vectorized filter for ``$alwaysFalse``, which matches no rows."""
+    return (numpy.zeros(batch.size, dtype=bool),
+            numpy.ones(batch.size, dtype=bool))
+
+
+class _MqlProfiledBuilder(object):
+
+    """Mixin timing value conversions for the active :class:`MqlProfile`.
+
+    Combined with a builder class by :func:`_get_profiled_builder`.
+    Conversions are delegated to the original builder class, so any
+    custom conversions it defines are still used.
+
+    """
+
+    # The builder class being profiled.
+    _profiled_base = None
+
+    @classmethod
+    def convert_to_alchemy_type(cls, value, alchemy_type):
+        convert = cls._profiled_base.convert_to_alchemy_type
+        profile = _active_profile.get(None)
+        if profile is None:
+            # e.g. binding values to a plan compiled while profiling.
+            return convert(value, alchemy_type)
+        profile.counters["values_converted"] += 1
+        return profile.time("type_conversion", convert, value, alchemy_type)
+
+    @classmethod
+    def convert_list_to_alchemy_type(cls, values, alchemy_type):
+        convert = cls._profiled_base.convert_list_to_alchemy_type
+        profile = _active_profile.get(None)
+        if profile is None:
+            return convert(values, alchemy_type)
+        profile.counters["values_converted"] += len(values)
+        return profile.time("type_conversion", convert, values, alchemy_type)
+
+
+def _get_profiled_builder(builder):
+    """Get a subclass of a builder class that times value conversions.
+
+    :param builder: :class:`MqlBuilder` or a subclass of it.
+    :return: A subclass of ``builder``, created once and then reused.
+
+    """
+    if getattr(builder, "_profiled_base", None) is not None:
+        # already profiled
+        return builder
+    profiled = builder.__dict__.get("_profiled_builder")
+    if profiled is None:
+        profiled = type(builder.__name__, (_MqlProfiledBuilder, builder), {
+            "__module__": builder.__module__,
+            "__doc__": builder.__doc__,
+            "_profiled_base": builder
+        })
+        # share the converter cache with the original builder.
+        profiled._converters = builder._converters
+        builder._profiled_builder = profiled
+    return profiled
+
+
+class _MqlProfiledSchemaIndex(object):
+
+    """Wraps a :class:`MqlSchemaIndex`, timing and counting lookups."""
+
+    def __init__(self, schema_index, profile):
+        """Initializes a new wrapper.
+
+        :param schema_index: The :class:`MqlSchemaIndex` to wrap.
+        :param profile: :class:`MqlProfile` to record lookups in.
+
+        """
+        self.resolve = profile.wrap(
+            "resolve", schema_index.resolve, "resolves")
+
+
+class _MqlProfiledStack(list):
+
+    """Parse stack that counts nodes visited and its max size."""
+
+    def __init__(self, profile):
+        """Initializes a new, empty stack.
+
+        :param profile: :class:`MqlProfile` to record counts in.
+
+        """
+        super(_MqlProfiledStack, self).__init__()
+        self.counters = profile.counters
+
+    def append(self, item):
+        super(_MqlProfiledStack, self).append(item)
+        if len(self) > self.counters["max_stack_depth"]:
+            self.counters["max_stack_depth"] = len(self)
+
+    def extend(self, items):
+        super(_MqlProfiledStack, self).extend(items)
+        if len(self) > self.counters["max_stack_depth"]:
+            self.counters["max_stack_depth"] = len(self)
+
+    def pop(self, *args):
+        item = super(_MqlProfiledStack, self).pop(*args)
+        if not isinstance(item, (str, _MqlStackMarker)):
+            # strings are markers for popping the other stacks.
+            self.counters["nodes_visited"] += 1
+        return item
 
 
 def _get_full_attr_name(attr_name_stack, short_attr_name=None):
     """Join the attr_name_stack to get a full attribute name.
 
-    :param attr_name_stack: List of attribute names sitting on our
-        processing stack while building MQL queries.
+    :param attr_name_stack: List or tuple of attribute names sitting on
+        our processing stack while building MQL queries.
     :param short_attr_name: The trailing attr_name to be appended to the
         end of our full dot separated attr name.
     :return: A dot separated data key.
@@ -933,7 +6431,492 @@ def _get_full_attr_name(attr_name_stack, short_attr_name=None):
 
     """
     return ".".join(
-        attr_name_stack + [short_attr_name] if short_attr_name else [])
+        tuple(attr_name_stack) + (short_attr_name, ) if short_attr_name
+        else ())
+
+
+def _split_filters(filters, values, slots=None, key=None):
+    """Split filters into a structural key and their bindable values.
+
+    The structural key, or shape, of a set of filters includes all of
+    the keys and operators used, but leaves out any values that can
+    be replaced by bound parameters. Values that change the structure
+    of the resulting expressions, such as ``null`` values and
+    ``$exists`` values, are kept as part of the shape.
+
+    :param filters: Dictionary of MongoDB style query filters, or a
+        value nested somewhere within them.
+    :param values: List that any bindable values will be appended to.
+        May be ``None`` if the values aren't needed.
+    :type values: list or None
+    :param slots: If provided, a template of the filters will also be
+        built, with each bindable value replaced by a
+        :class:`_MqlBindSlot`, which is also appended to this list.
+    :type slots: list or None
+    :param key: The key ``filters`` was found under, if any.
+    :type key: str or None
+    :return: A tuple of the hashable shape and, if ``slots`` was
+        provided, the filters template.
+    :rtype: tuple
+
+    """
+    if isinstance(filters, dict):
+        shapes = []
+        template = {} if slots is not None else None
+        for sub_key, sub_value in filters.items():
+            sub_shape, sub_template = _split_filters(
+                sub_value, values, slots, sub_key)
+            shapes.append((sub_key, sub_shape))
+            if template is not None:
+                template[sub_key] = sub_template
+        return tuple(shapes), template
+    if key == "$and" or key == "$or" or key == "$nor":
+        if isinstance(filters, list):
+            shapes = []
+            template = [] if slots is not None else None
+            for sub_value in filters:
+                sub_shape, sub_template = _split_filters(
+                    sub_value, values, slots)
+                shapes.append(sub_shape)
+                if template is not None:
+                    template.append(sub_template)
+            return ("list", tuple(shapes)), template
+        return ("literal", repr(filters)), filters
+    if (filters is None or key == "$exists" or key in _CONSTANT_OPS or
+            (isinstance(filters, str) and filters.lower() == "null")):
+        return ("literal", repr(filters)), filters
+    if values is not None:
+        values.append(filters)
+    template = None
+    if slots is not None:
+        template = _MqlBindSlot(len(slots))
+        slots.append(template)
+    if isinstance(filters, list):
+        return "list", template
+    return "value", template
+
+
+def _fill_slots(template, values):
+    """Replace any :class:`_MqlBindSlot` in a filters template.
+
+    :param template: Filters, or a value within them, from
+        :func:`_split_filters`.
+    :param list values: Values collected by :func:`_split_filters`,
+        in the same order as the slots.
+    :return: ``template``, with each slot replaced by its value.
+
+    """
+    if isinstance(template, _MqlBindSlot):
+        return values[template.index]
+    elif isinstance(template, dict):
+        return {key: _fill_slots(value, values)
+                for key, value in template.items()}
+    elif isinstance(template, list):
+        return [_fill_slots(value, values) for value in template]
+    return template
+
+
+def _dump_canonical(value):
+    """Dump a value as JSON with sorted keys, for comparing and hashing.
+
+    Values JSON can't represent are included as their type and repr.
+
+    """
+    return json.dumps(
+        value, sort_keys=True, separators=(",", ":"),
+        default=lambda obj: {"$type": type(obj).__name__, "$repr": repr(obj)})
+
+
+def _sort_unique(items):
+    """Sort a list of JSON like values, removing duplicates."""
+    unique = {}
+    for item in items:
+        try:
+            unique.setdefault(_dump_canonical(item), item)
+        except TypeError:
+            # e.g. a dict with keys that can't be sorted.
+            unique.setdefault(repr(item), item)
+    return [unique[key] for key in sorted(unique)]
+
+
+def _is_filters_list(value):
+    """Check if a value is a list of filter dicts, e.g. for ``$and``."""
+    return isinstance(value, list) and all(
+        isinstance(item, dict) for item in value)
+
+
+def _split_conjuncts(filters):
+    """Split canonical filters into a list of single key dicts.
+
+    Only valid when sibling keys are independent of each other, i.e.
+    :attr:`MqlBuilder.merge_relation_filters` isn't set.
+
+    """
+    if isinstance(filters, dict) and list(filters) == ["$and"] and (
+            _is_filters_list(filters["$and"])):
+        return list(filters["$and"])
+    return [{key: value} for key, value in filters.items()]
+
+
+def _join_conjuncts(conjuncts):
+    """Join single key dicts into one dict, or an ``$and`` if needed."""
+    keys = [key for conjunct in conjuncts for key in conjunct]
+    if len(set(keys)) == len(keys):
+        result = {}
+        for conjunct in conjuncts:
+            result.update(conjunct)
+        return {key: result[key] for key in sorted(result, key=str)}
+    return {"$and": conjuncts}
+
+
+def _is_always_false(filters):
+    """Check if normalized filters can't match anything."""
+    return isinstance(filters, dict) and list(filters) == ["$alwaysFalse"]
+
+
+def _has_negated_sibling(conjuncts, groups, merge=False):
+    """Check if filters contain a ``$not`` of filters also required.
+
+    :param list conjuncts: Single key filters that are all required.
+    :param list groups: Other filters that are all required.
+    :param bool merge: If ``True``, as with ``merge_relation_filters``,
+        separate groups on a relationship are separate sub queries,
+        while the filters in a ``$not`` are combined into one. A
+        ``$not`` is then only contradicted by a single required
+        conjunct or group as a whole.
+    :return: ``True`` if a ``$not`` is found whose filters are all
+        among the other required filters.
+    :rtype: bool
+
+    """
+    required = set()
+    for item in conjuncts:
+        required.add(_dump_canonical(item))
+    for item in groups:
+        if merge:
+            required.add(_dump_canonical(item))
+        else:
+            required.update(
+                _dump_canonical(conjunct)
+                for conjunct in _split_conjuncts(item))
+    for item in conjuncts + groups:
+        if not (isinstance(item, dict) and list(item) == ["$not"] and
+                isinstance(item["$not"], dict) and item["$not"]):
+            continue
+        if merge:
+            if _dump_canonical(item["$not"]) in required:
+                return True
+        elif all(_dump_canonical(conjunct) in required
+                 for conjunct in _split_conjuncts(item["$not"])):
+            return True
+    return False
+
+
+def _has_excluded_values(ops):
+    """Check if a field's ops exclude every value they'd match.
+
+    E.g. ``{"$eq": 1, "$ne": 1}`` or ``{"$in": [1], "$nin": [1]}``.
+
+    :param dict ops: Operators used on a single field.
+    :rtype: bool
+
+    """
+    excluded = set()
+    if "$ne" in ops:
+        excluded.add(_dump_canonical(ops["$ne"]))
+    if isinstance(ops.get("$nin"), list):
+        excluded.update(_dump_canonical(value) for value in ops["$nin"])
+    if not excluded:
+        return False
+    if "$eq" in ops and _dump_canonical(ops["$eq"]) in excluded:
+        return True
+    return isinstance(ops.get("$in"), list) and all(
+        _dump_canonical(value) in excluded for value in ops["$in"])
+
+
+def _is_number(value):
+    """Check if a value is an int or float, but not a bool or NaN."""
+    return (isinstance(value, (int, float)) and
+            not isinstance(value, bool) and value == value)
+
+
+def _unique(items):
+    """Remove duplicates from a list of JSON like values, keeping order."""
+    seen = set()
+    result = []
+    for item in items:
+        try:
+            key = _dump_canonical(item)
+        except TypeError:
+            # e.g. a dict with keys that can't be sorted.
+            key = repr(item)
+        if key not in seen:
+            seen.add(key)
+            result.append(item)
+    return result
+
+
+def _get_equality_values(filters):
+    """Get the values a single field is checked for equality with.
+
+    :param filters: An item of an ``$or`` list.
+    :return: A tuple of the field name and list of values, if the
+        filters are a single equality or ``$in`` check of non null
+        values, otherwise ``(None, None)``.
+
+    """
+    if not (isinstance(filters, dict) and len(filters) == 1):
+        return None, None
+    [(key, value)] = filters.items()
+    if not isinstance(key, str) or key.startswith("$"):
+        return None, None
+    if isinstance(value, dict) and list(value) == ["$eq"]:
+        values = [value["$eq"]]
+    elif isinstance(value, dict) and list(value) == ["$in"]:
+        values = value["$in"]
+    elif not isinstance(value, dict):
+        values = [value]
+    else:
+        return None, None
+    if not isinstance(values, list) or not all(
+            isinstance(item, _json_types) and not (
+                isinstance(item, str) and item.lower() == "null")
+            for item in values):
+        return None, None
+    return key, values
+
+
+def _get_constant(filters, expressions):
+    """Check if parsed filters are known to match everything or nothing.
+
+    :param filters: The filters that were parsed.
+    :param expressions: The resulting expressions, if any.
+    :return: ``True``, ``False``, or ``None`` if not known.
+
+    """
+    if filters is None:
+        return None
+    elif not expressions:
+        return True
+    elif any(isinstance(expression, False_) for expression in expressions):
+        return False
+    elif all(isinstance(expression, True_) for expression in expressions):
+        return True
+    return None
+
+
+def _is_empty_statement(stmt):
+    """Check if a filtered select is known to return no rows."""
+    return stmt.get_execution_options().get("mqlalchemy_constant") is False
+
+
+def _get_empty_result():
+    """Get an empty result, as returned for filters matching nothing."""
+    return IteratorResult(SimpleResultMetaData(["entity"]), iter(())).scalars()
+
+
+def _stream_partitions(session, stmt, chunk_size, columns):
+    """Yield chunks of results of a filtered select.
+
+    :param session: A SQLAlchemy :class:`~sqlalchemy.orm.session.Session`.
+    :param stmt: A filtered select statement.
+    :param int chunk_size: Max number of results in each chunk.
+    :param columns: Column names selected, or ``None`` for instances.
+    :return: A generator of lists of results.
+
+    """
+    if _is_empty_statement(stmt):
+        return
+    result = session.execute(
+        stmt, execution_options={"yield_per": chunk_size})
+    if columns is None:
+        result = result.scalars()
+    try:
+        for partition in result.partitions():
+            yield partition
+    finally:
+        result.close()
+
+
+async def _stream_partitions_async(session, stmt, chunk_size, columns):
+    """Async version of :func:`_stream_partitions`."""
+    if _is_empty_statement(stmt):
+        return
+    result = await session.stream(
+        stmt, execution_options={"yield_per": chunk_size})
+    if columns is None:
+        result = result.scalars()
+    try:
+        async for partition in result.partitions():
+            yield partition
+    finally:
+        await result.close()
+
+
+def _get_count_cache_key(count_stmt, cache_key):
+    """Get the :class:`MqlCountCache` key for a count statement.
+
+    :param count_stmt: A count select statement.
+    :param cache_key: Optional hashable value to add to the key.
+    :return: A hashable key, made up of the statement's SQL along with
+        the type and value of each of its bound parameters.
+    :rtype: tuple
+
+    """
+    compiled = count_stmt.compile()
+    params = tuple(sorted(
+        (name, _freeze_value(value))
+        for name, value in compiled.params.items()))
+    return str(compiled), params, cache_key
+
+
+def _freeze_value(value):
+    """Convert a bound value into something hashable, including its type.
+
+    Unlike :func:`_freeze`, values that are equal but of different
+    types, such as ``1`` and ``True``, are kept distinct.
+
+    """
+    if isinstance(value, (list, tuple)):
+        return ("list", tuple(_freeze_value(item) for item in value))
+    return (type(value).__name__, repr(value))
+
+
+class _MqlExplain(Executable, ClauseElement):
+
+    """An ``EXPLAIN (FORMAT JSON)`` of a select, for PostgreSQL."""
+
+    inherit_cache = False
+
+    def __init__(self, stmt):
+        self.stmt = stmt
+
+
+@compiles(_MqlExplain, "postgresql")
+def _compile_explain(element, compiler, **kwargs):
+    """Compile an :class:`_MqlExplain` for PostgreSQL."""
+    return "EXPLAIN (FORMAT JSON) " + compiler.process(element.stmt, **kwargs)
+
+
+def _estimate_postgresql_count(connection, stmt):
+    """Get PostgreSQL's estimate of the rows a select will return.
+
+    :param connection: A SQLAlchemy connection to a PostgreSQL database.
+    :param stmt: A select statement.
+    :return: The planner's row estimate from ``EXPLAIN``.
+    :rtype: int
+
+    """
+    plan = connection.execute(_MqlExplain(stmt)).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+
+def _new_projection_node():
+    """Create an empty node for a tree of projected fields."""
+    return {"columns": [], "all": False, "load": False, "relations": {}}
+
+
+def _encode_keyset_value(value):
+    """Encode a sort column value for a keyset cursor as JSON.
+
+    Values that JSON can't represent exactly are tagged with their type.
+
+    """
+    if value is None or type(value) in _json_types:
+        return value
+    elif isinstance(value, datetime.datetime):
+        return {"datetime": value.isoformat()}
+    elif isinstance(value, datetime.date):
+        return {"date": value.isoformat()}
+    elif isinstance(value, datetime.time):
+        return {"time": value.isoformat()}
+    elif isinstance(value, decimal.Decimal):
+        return {"decimal": str(value)}
+    raise TypeError("Unable to encode value for a cursor.")
+
+
+def _decode_keyset_value(value):
+    """Decode a sort column value from :func:`_encode_keyset_value`."""
+    if value is None or type(value) in _json_types:
+        return value
+    elif type(value) is dict and len(value) == 1:
+        (tag, text), = value.items()
+        if tag == "datetime":
+            return datetime.datetime.fromisoformat(text)
+        elif tag == "date":
+            return datetime.date.fromisoformat(text)
+        elif tag == "time":
+            return datetime.time.fromisoformat(text)
+        elif tag == "decimal":
+            return decimal.Decimal(text)
+    raise ValueError("Unable to decode value from a cursor.")
+
+
+def _is_async_callable(obj):
+    """Check if an object is an async function or async callable."""
+    return iscoroutinefunction(obj) or (
+        callable(obj) and not isroutine(obj) and
+        iscoroutinefunction(getattr(obj, "__call__", None)))
+
+
+class _MqlAwaitedCallable(object):
+
+    """Calls an async callable from a worker thread.
+
+    Used so that async ``whitelist``, ``nested_conditions``, and
+    ``convert_key_names_func`` callables can be used by the sync parser,
+    when it runs in a worker thread. Each call is awaited on the event
+    loop, blocking the worker thread until it's done.
+
+    """
+
+    __slots__ = ("func", "loop")
+
+    def __init__(self, func, loop):
+        """Initializes a new wrapper.
+
+        :param callable func: The async callable to wrap.
+        :param loop: The running event loop to await calls on.
+
+        """
+        self.func = func
+        self.loop = loop
+
+    def __call__(self, *args, **kwargs):
+        result = self.func(*args, **kwargs)
+        if isawaitable(result):
+            result = asyncio.run_coroutine_threadsafe(
+                _await(result), self.loop).result()
+        return result
+
+
+async def _await(awaitable):
+    """Await any awaitable, wrapping it in a coroutine."""
+    return await awaitable
+
+
+def _freeze(obj):
+    """Convert a param into something usable as part of a cache key.
+
+    :param obj: Any object.
+    :return: A hashable representation of ``obj``. Lists, tuples, and
+        dicts are converted by value, strings, numbers, and ``None``
+        are returned as is, and anything else is represented by its id.
+
+    """
+    if isinstance(obj, _MqlAwaitedCallable):
+        # keyed the same as the async callable it wraps.
+        obj = obj.func
+    if obj is None or isinstance(obj, (str, int, float)):
+        return obj
+    if isinstance(obj, (list, tuple)):
+        return ("list", tuple(_freeze(item) for item in obj))
+    if isinstance(obj, dict):
+        return ("dict", tuple(sorted(
+            (_freeze(key), _freeze(value)) for key, value in obj.items())))
+    return ("id", id(obj))
 
 
 def _is_whitelisted(model_class, attr_name, whitelist):
@@ -955,7 +6938,7 @@ def _is_whitelisted(model_class, attr_name, whitelist):
 
     """
     try:
-        _get_class_attributes(model_class, attr_name)
+        MqlBuilder.get_schema_index(model_class).resolve(attr_name)
     except AttributeError:
         # model_class doesn't contain this attr_name,
         # therefor it can't be queried.
@@ -1014,6 +6997,12 @@ def _get_class_attributes(model_class, attr_name):
     return class_attrs
 
 
+# MqlSchemaIndex objects shared by all MqlBuilder classes.
+_schema_indexes = weakref.WeakKeyDictionary()
+
+# The :class:`MqlProfile` for the filters currently being parsed.
+_active_profile = contextvars.ContextVar("mqlalchemy_active_profile")
+
 # done as a convenience to keep compatibility with older versions
 convert_to_alchemy_type = MqlBuilder.convert_to_alchemy_type
 
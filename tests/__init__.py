@@ -11,7 +11,7 @@
 from __future__ import unicode_literals
 import unittest
 import os
-from sqlalchemy import create_engine, select
+from sqlalchemy import create_engine, event, inspect, select
 from sqlalchemy.orm import sessionmaker, configure_mappers
 from sqlalchemy.types import (
     String, Integer, Boolean,
@@ -21,8 +21,23 @@ from tests.models import (
     Album, Artist, Customer, Employee, Genre, Invoice, InvoiceLine,
     MediaType, Playlist, Track)
 from mqlalchemy import (
-    apply_mql_filters, convert_to_alchemy_type, InvalidMqlException)
+    apply_mql_filters, convert_to_alchemy_type, InvalidMqlException,
+    MqlBuilder, MqlCost, MqlCostModel, MqlCountCache, MqlFieldError,
+    MqlFieldPermissionError, MqlLoadPlan, MqlPlanCache, MqlProfiler,
+    MqlResultCache, MqlSchemaIndex, MqlTooComplex, MqlWhitelist)
+import asyncio
 import datetime
+import random
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    import aiosqlite
+    import greenlet
+    from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+except ImportError:
+    aiosqlite = None
 
 # Makes sure backref relationship attrs are attached to models
 # e.g. Album.tracks doesn't work without either this or accessing
@@ -165,6 +180,135 @@ class MQLAlchemyTests(unittest.TestCase):
             (result[0].playlist_id == 1 and result[1].playlist_id == 8) or
             (result[0].playlist_id == 8 and result[1].playlist_id == 1))
 
+    def test_merge_relation_filters(self):
+        """Test sibling relation filters can match the same element."""
+        class MergingMqlBuilder(MqlBuilder):
+            merge_relation_filters = True
+        filters = {
+            "tracks.track_id": 1,
+            "tracks.milliseconds": 205662
+        }
+        stmt = apply_mql_filters(model_class=Album, filters=filters)
+        result = self.db_session.execute(stmt).scalars().all()
+        self.assertTrue(len(result) == 1 and result[0].album_id == 1)
+        stmt = MergingMqlBuilder.apply_mql_filters(
+            model_class=Album, filters=filters)
+        self.assertTrue(str(stmt).count("EXISTS") == 1)
+        result = self.db_session.execute(stmt).scalars().all()
+        self.assertTrue(len(result) == 0)
+        stmt = MergingMqlBuilder.apply_mql_filters(
+            model_class=Album,
+            filters={
+                "tracks.track_id": 6,
+                "tracks.milliseconds": 205662
+            },
+            whitelist=["tracks.track_id", "tracks.milliseconds"]
+        )
+        result = self.db_session.execute(stmt).scalars().all()
+        self.assertTrue(len(result) == 1 and result[0].album_id == 1)
+
+    def test_many_to_one_filters_merged(self):
+        """Test sibling many to one relation filters are combined."""
+        stmt = apply_mql_filters(
+            model_class=Track,
+            filters={
+                "album.title": "For Those About To Rock We Salute You",
+                "album.artist.name": "AC/DC",
+                "track_id": 1
+            }
+        )
+        self.assertTrue(str(stmt).count("EXISTS") == 2)
+        result = self.db_session.execute(stmt).scalars().all()
+        self.assertTrue(len(result) == 1 and result[0].track_id == 1)
+
+    def test_nested_and_collapsed(self):
+        """Test that redundant nested and/or wrappers are removed."""
+        expressions = MqlBuilder.parse_mql_filters(
+            model_class=Track,
+            filters={
+                "$and": [
+                    {"$and": [{"track_id": 1}, {"bytes": 11170334}]},
+                    {"$or": [{"$or": [{"name": "a"}, {"name": "b"}]}]}
+                ]
+            }
+        )
+        self.assertTrue(len(expressions) == 3)
+        self.assertTrue(len(expressions[0].clauses) == 2)
+
+    def test_relation_strategies(self):
+        """Test each relation strategy gives the same results."""
+        filters_list = [
+            {"album.artist.name": "AC/DC", "album.title": {"$like": "Rock"}},
+            {"$or": [{"album.album_id": 1}, {"track_id": 7}]},
+            {"$nor": [{"album.artist.name": {"$ne": "AC/DC"}}]},
+            {"album.tracks.track_id": 6, "playlists.playlist_id": 1},
+            {"genre.name": "Rock", "media_type.media_type_id": {"$ne": 1}}
+        ]
+        for filters in filters_list:
+            results = []
+            for relation_strategy in ("exists", "join", "semi_join_in"):
+                stmt = apply_mql_filters(
+                    model_class=Track,
+                    filters=filters,
+                    relation_strategy=relation_strategy)
+                results.append(sorted(
+                    track.track_id for track in
+                    self.db_session.execute(stmt).scalars().all()))
+            self.assertTrue(results[0])
+            self.assertTrue(results[0] == results[1] == results[2])
+
+    def test_relation_strategy_self_referential(self):
+        """Test relation strategies with a self referential relation."""
+        filters = {
+            "manager.first_name": "Andrew",
+            "$nor": [{"subordinates.first_name": "Jane"}]
+        }
+        results = []
+        for relation_strategy in ("exists", "join", "semi_join_in"):
+            stmt = apply_mql_filters(
+                model_class=Employee,
+                filters=filters,
+                relation_strategy=relation_strategy)
+            results.append(sorted(
+                employee.employee_id for employee in
+                self.db_session.execute(stmt).scalars().all()))
+        self.assertTrue(results[0] == [6])
+        self.assertTrue(results[0] == results[1] == results[2])
+
+    def test_join_relation_strategy(self):
+        """Test the join strategy reuses joins and keeps conditions."""
+        stmt = apply_mql_filters(
+            model_class=Track,
+            filters={
+                "$and": [
+                    {"album.title": {"$like": "Rock"}},
+                    {"album.artist.name": "AC/DC"}
+                ]
+            },
+            relation_strategy="join"
+        )
+        self.assertTrue(str(stmt).count("JOIN") == 2)
+        self.assertTrue("EXISTS" not in str(stmt))
+        stmt = apply_mql_filters(
+            model_class=Track,
+            filters={"album.title": {"$like": "Rock"}},
+            nested_conditions={"album": Album.album_id == 1},
+            relation_strategy="join"
+        )
+        self.assertTrue("JOIN" not in str(stmt))
+        result = self.db_session.execute(stmt).scalars().all()
+        self.assertTrue(len(result) == 10)
+
+    def test_unknown_relation_strategy(self):
+        """Test an unknown relation strategy fails."""
+        self.assertRaises(
+            ValueError,
+            apply_mql_filters,
+            model_class=Track,
+            filters={"album.title": "x"},
+            relation_strategy="unknown"
+        )
+
     def test_list_relation_eq_fail(self):
         """Make sure we can't check a relation for equality."""
         self.assertRaises(
@@ -561,6 +705,110 @@ class MQLAlchemyTests(unittest.TestCase):
             }
         )
 
+    def test_large_in_json_each(self):
+        """Test large $in and $nin lists using json_each."""
+        class LargeInMqlBuilder(MqlBuilder):
+            large_in_threshold = 1
+        stmt = LargeInMqlBuilder.apply_mql_filters(
+            model_class=Playlist,
+            filters={
+                "playlist_id": {
+                    "$in": [1, 2]
+                }
+            }
+        )
+        self.assertTrue("json_each" in str(stmt))
+        result = self.db_session.execute(stmt).scalars().all()
+        self.assertTrue(
+            sorted(playlist.playlist_id for playlist in result) == [1, 2])
+        stmt = LargeInMqlBuilder.apply_mql_filters(
+            model_class=Playlist,
+            filters={
+                "playlist_id": {
+                    "$nin": list(range(2, 19))
+                }
+            }
+        )
+        result = self.db_session.execute(stmt).scalars().all()
+        self.assertTrue(len(result) == 1 and
+                        result[0].playlist_id == 1)
+
+    def test_large_in_json_each_dates(self):
+        """Test large $in lists of dates fall back to a regular IN."""
+        class LargeInMqlBuilder(MqlBuilder):
+            large_in_threshold = 0
+        stmt = LargeInMqlBuilder.apply_mql_filters(
+            model_class=Employee,
+            filters={
+                "hire_date": {
+                    "$in": ["2002-08-14 00:00:00"]
+                }
+            }
+        )
+        self.assertTrue("json_each" not in str(stmt))
+        self.assertTrue("IN (" in str(stmt))
+
+    def test_large_in_array(self):
+        """Test large $in lists using an array parameter."""
+        from sqlalchemy.dialects import postgresql
+
+        class LargeInMqlBuilder(MqlBuilder):
+            large_in_threshold = 0
+            large_in_strategy = "array"
+        stmt = LargeInMqlBuilder.apply_mql_filters(
+            model_class=Playlist,
+            filters={
+                "playlist_id": {
+                    "$in": [1, 2]
+                }
+            }
+        )
+        self.assertTrue(
+            "= ANY (" in str(stmt.compile(dialect=postgresql.dialect())))
+
+    def test_large_in_plan_cache(self):
+        """Test large $in lists use their strategy with a plan cache."""
+        class LargeInMqlBuilder(MqlBuilder):
+            large_in_threshold = 2
+            plan_cache = MqlPlanCache()
+        for playlist_ids, large in (([1, 2], False), ([1, 2, 3], True),
+                                    ([1], False)):
+            stmt = LargeInMqlBuilder.apply_mql_filters(
+                model_class=Playlist,
+                filters={"playlist_id": {"$in": playlist_ids}})
+            self.assertTrue(("json_each" in str(stmt)) == large)
+            result = self.db_session.execute(stmt).scalars().all()
+            self.assertTrue(
+                sorted(playlist.playlist_id for playlist in result) ==
+                playlist_ids)
+
+        # values bound at execution time always use an expanding IN.
+        plan = LargeInMqlBuilder.compile(
+            Playlist, {"playlist_id": {"$in": [1]}})
+        filters = {"playlist_id": {"$in": [1, 2, 3]}}
+        stmt = plan.apply()
+        self.assertTrue("json_each" not in str(stmt))
+        result = self.db_session.execute(
+            stmt, plan.get_params(filters)).scalars().all()
+        self.assertTrue(len(result) == 3)
+        self.assertTrue("json_each" in str(plan.apply(filters=filters)))
+
+    def test_large_in_unknown_strategy(self):
+        """Test an unknown large $in strategy fails."""
+        class LargeInMqlBuilder(MqlBuilder):
+            large_in_threshold = 0
+            large_in_strategy = "unknown"
+        self.assertRaises(
+            ValueError,
+            LargeInMqlBuilder.apply_mql_filters,
+            model_class=Playlist,
+            filters={
+                "playlist_id": {
+                    "$in": [1, 2]
+                }
+            }
+        )
+
     def test_like(self):
         """Test that the new $like operator works."""
         stmt = apply_mql_filters(
@@ -624,6 +872,17 @@ class MQLAlchemyTests(unittest.TestCase):
             filters={"tracks": {}}
         )
 
+    def test_logical_op_fail(self):
+        """Test that logical operators with bad values fail."""
+        for filters in ({"$or": {"track_id": 5}}, {"$and": ["track_id"]},
+                        {"$nor": 5}, {"$not": [{"track_id": 5}]}):
+            self.assertRaises(
+                InvalidMqlException,
+                apply_mql_filters,
+                model_class=Track,
+                filters=filters
+            )
+
     def test_whitelist(self):
         """Test that whitelisting works as expected."""
         self.assertRaises(
@@ -652,6 +911,40 @@ class MQLAlchemyTests(unittest.TestCase):
             (result[0].playlist_id == 1 and result[1].playlist_id == 8) or
             (result[0].playlist_id == 8 and result[1].playlist_id == 1))
 
+    def test_compiled_whitelist(self):
+        """Test that a precompiled whitelist works as expected."""
+        whitelist = MqlWhitelist(["tracks.track_id", "bad_attr_name"])
+        self.assertTrue(whitelist.is_whitelisted(Playlist, "tracks.track_id"))
+        self.assertTrue(
+            whitelist.is_whitelisted(Playlist, "tracks.0.track_id"))
+        self.assertFalse(whitelist.is_whitelisted(Playlist, "bad_attr_name"))
+        self.assertFalse(whitelist.is_whitelisted(Playlist, "playlist_id"))
+        stmt = apply_mql_filters(
+            model_class=Playlist,
+            filters={"tracks.track_id": 7},
+            whitelist=whitelist
+        )
+        result = self.db_session.execute(stmt).scalars().all()
+        self.assertTrue(len(result) == 2)
+        self.assertRaises(
+            InvalidMqlException,
+            apply_mql_filters,
+            model_class=Playlist,
+            filters={"playlist_id": 7},
+            whitelist=whitelist
+        )
+
+    def test_tuple_whitelist(self):
+        """Test that a tuple or set whitelist is enforced."""
+        for whitelist in (("playlist_id", ), {"playlist_id"}):
+            self.assertRaises(
+                InvalidMqlException,
+                apply_mql_filters,
+                model_class=Playlist,
+                filters={"tracks.track_id": 7},
+                whitelist=whitelist
+            )
+
     def test_custom_whitelist_func(self):
         """Test that providing a whitelist function works."""
         def whitelist(attr_name):
@@ -734,6 +1027,61 @@ class MQLAlchemyTests(unittest.TestCase):
         self.assertTrue(convert_to_alchemy_type("null", String) is None)
         self.assertTrue(convert_to_alchemy_type(None, String) is None)
 
+    def test_convert_type_subclass(self):
+        """Test converting to a subclass of a known type."""
+        class CustomInteger(Integer):
+            pass
+
+        self.assertTrue(convert_to_alchemy_type("1", CustomInteger) == 1)
+
+    def test_convert_overridden_types(self):
+        """Test subclasses may override the types used to convert."""
+        class CustomMqlBuilder(MqlBuilder):
+            int_types = []
+            text_types = MqlBuilder.text_types + [Integer]
+
+        self.assertTrue(MqlBuilder.convert_to_alchemy_type(1, Integer) == 1)
+        self.assertTrue(
+            CustomMqlBuilder.convert_to_alchemy_type(1, Integer) == "1")
+        self.assertTrue(
+            CustomMqlBuilder.convert_list_to_alchemy_type(
+                [1, 2], Integer) == ["1", "2"])
+
+    def test_convert_list(self):
+        """Test converting a list of values."""
+        values = [1, 2, 3]
+        converted = MqlBuilder.convert_list_to_alchemy_type(values, Integer)
+        self.assertTrue(converted == values and converted is not values)
+        self.assertTrue(
+            MqlBuilder.convert_list_to_alchemy_type(
+                ["1", None, "null", True], Integer) == [1, None, None, True])
+        self.assertRaises(
+            ValueError,
+            MqlBuilder.convert_list_to_alchemy_type,
+            [1, "test"],
+            Integer)
+
+    def test_convert_list_null_string(self):
+        """Test "null" strings in a list of strings are converted."""
+        self.assertTrue(
+            MqlBuilder.convert_list_to_alchemy_type(
+                ["null", "x"], String) == [None, "x"])
+        stmt = MqlBuilder.apply_mql_filters(
+            Track, filters={"composer": {"$nin": ["null"]}})
+        result = self.db_session.execute(stmt).scalars().all()
+        self.assertTrue(len(result) == 0)
+
+    def test_convert_list_custom_convert(self):
+        """Test converting a list respects custom conversions."""
+        class CustomMqlBuilder(MqlBuilder):
+            @classmethod
+            def convert_to_alchemy_type(cls, value, alchemy_type):
+                return value * 2
+
+        self.assertTrue(
+            CustomMqlBuilder.convert_list_to_alchemy_type(
+                [1, 2], Integer) == [2, 4])
+
     def test_convert_fail(self):
         """Test that convert_to_alchemy_type properly fails."""
         self.assertRaises(
@@ -749,6 +1097,40 @@ class MQLAlchemyTests(unittest.TestCase):
             "tracks.0.track_id")
         self.assertTrue(len(class_attrs) == 4)
 
+    def test_schema_index_resolve(self):
+        """Test resolving paths using the schema index."""
+        schema_index = MqlBuilder.get_schema_index(Album)
+        self.assertTrue(MqlBuilder.get_schema_index(Album) is schema_index)
+        path_info = schema_index.resolve("tracks.playlists.playlist_id")
+        self.assertTrue(path_info.kind == "column")
+        self.assertTrue(path_info.column_type is Integer)
+        self.assertTrue(path_info.relation_indexes == [1, 2])
+        self.assertTrue(
+            schema_index.resolve("tracks.playlists.playlist_id") is
+            path_info)
+        path_info = schema_index.resolve("tracks.0.playlists")
+        self.assertTrue(path_info.kind == "relationship")
+        self.assertTrue(path_info.path == "tracks.playlists")
+        self.assertTrue(path_info.target is Playlist)
+        self.assertTrue(path_info.uselist)
+        self.assertTrue(path_info.relation_indexes == [3])
+        path_info = schema_index.resolve("artist")
+        self.assertTrue(path_info.direction.name == "MANYTOONE")
+        self.assertTrue(schema_index.resolve("").kind == "model")
+        self.assertRaises(
+            AttributeError,
+            schema_index.resolve,
+            "tracks.bad_attr_name")
+
+    def test_schema_index_warm_up(self):
+        """Test eagerly building the schema index."""
+        self.assertTrue(MqlBuilder.warm_up([Playlist], max_depth=1) > 0)
+        schema_index = MqlSchemaIndex(Playlist)
+        count = schema_index.warm_up(max_depth=1)
+        self.assertTrue(count == len(schema_index))
+        self.assertTrue("tracks.album" in schema_index._paths)
+        self.assertFalse("tracks.album.title" in schema_index._paths)
+
     def test_stack_size_limit(self):
         """Make sure that limiting the stack size works as expected."""
         stmt = apply_mql_filters(
@@ -868,6 +1250,1365 @@ class MQLAlchemyTests(unittest.TestCase):
         result = self.db_session.execute(stmt).scalars().all()
         self.assertTrue(len(result) == 0)
 
+    def test_compile_plan(self):
+        """Test a compiled plan can be reused with new values."""
+        plan = MqlBuilder.compile(
+            model_class=Album,
+            filters_template={"tracks.playlists.playlist_id": 0}
+        )
+        stmt = plan.apply(filters={"tracks.playlists.playlist_id": 18})
+        result = self.db_session.execute(stmt).scalars().all()
+        self.assertTrue(len(result) == 1)
+        self.assertTrue(result[0].album_id == 48)
+        stmt = plan.apply(filters={"tracks.playlists.playlist_id": 999})
+        result = self.db_session.execute(stmt).scalars().all()
+        self.assertTrue(len(result) == 0)
+
+    def test_compile_plan_execution_params(self):
+        """Test binding a compiled plan's values at execution time."""
+        plan = MqlBuilder.compile(
+            model_class=Playlist,
+            filters_template={
+                "playlist_id": {"$in": [], "$mod": [1, 0]},
+                "name": {"$like": ""}
+            }
+        )
+        stmt = plan.apply(select(Playlist))
+        params = plan.get_params({
+            "playlist_id": {"$in": ["1", 2, 3, 4], "$mod": [2, 0]},
+            "name": {"$like": "o"}
+        })
+        result = self.db_session.execute(stmt, params).scalars().all()
+        self.assertTrue(len(result) == 2)
+        self.assertTrue(
+            (result[0].playlist_id == 2 and result[1].playlist_id == 4) or
+            (result[0].playlist_id == 4 and result[1].playlist_id == 2))
+
+    def test_compile_plan_structure_mismatch(self):
+        """Test a compiled plan rejects filters of a new structure."""
+        plan = MqlBuilder.compile(
+            model_class=Album,
+            filters_template={"album_id": 1}
+        )
+        self.assertTrue(plan.matches({"album_id": "7"}))
+        self.assertFalse(plan.matches({"album_id": None}))
+        self.assertFalse(plan.matches({"title": "Test"}))
+        self.assertRaises(
+            InvalidMqlException,
+            plan.get_params,
+            {"album_id": {"$gt": 5}}
+        )
+
+    def test_compile_plan_conversion_fail(self):
+        """Test a compiled plan fails to bind unconvertible values."""
+        plan = MqlBuilder.compile(
+            model_class=Playlist,
+            filters_template={"playlist_id": {"$in": [1]}}
+        )
+        with self.assertRaises(MqlFieldError) as context:
+            plan.get_params({"playlist_id": {"$in": ["test"]}})
+        self.assertTrue(context.exception.code == "data_conversion_error")
+        with self.assertRaises(MqlFieldError) as context:
+            plan.get_params({"playlist_id": {"$in": [[1]]}})
+        self.assertTrue(context.exception.code == "data_conversion_error")
+        self.assertRaises(
+            InvalidMqlException,
+            MqlBuilder.compile,
+            model_class=Playlist,
+            filters_template={"playlist_id": {"$bad": 1}}
+        )
+
+    def test_compile_predicate(self):
+        """Test a compiled predicate matches the same rows as SQL."""
+        filters_list = [
+            {"composer": {"$ne": "AC/DC"}},
+            {"composer": {"$nin": ["AC/DC", None]}},
+            {"name": {"$like": "r_ck%you"}},
+            {"bytes": {"$mod": [7, 3]}},
+            {"$or": [{"genre.name": "Jazz"}, {"unit_price": {"$gt": 0.99}}]},
+            {"album.artist.name": "AC/DC", "milliseconds": {"$gt": 300000}}
+        ]
+        tracks = self.db_session.execute(select(Track)).scalars().all()
+        for filters in filters_list:
+            stmt = apply_mql_filters(model_class=Track, filters=filters)
+            expected = set(self.db_session.execute(stmt).scalars().all())
+            predicate = MqlBuilder.compile_predicate(Track, filters)
+            self.assertTrue(
+                set(track for track in tracks if predicate(track)) ==
+                expected)
+
+    def test_compile_predicate_dicts(self):
+        """Test a compiled predicate on plain dicts."""
+        predicate = MqlBuilder.compile_predicate(
+            Album,
+            {"tracks.milliseconds": {"$gt": "1000"},
+             "$not": {"title": {"$in": ["Bad"]}}}
+        )
+        self.assertTrue(predicate(
+            {"title": "Good", "tracks": [{"milliseconds": 10},
+                                         {"milliseconds": 2000}]}))
+        self.assertFalse(predicate(
+            {"title": "Bad", "tracks": [{"milliseconds": 2000}]}))
+        self.assertFalse(predicate({"title": "Good", "tracks": []}))
+        # comparisons with null are unknown, even when negated
+        self.assertFalse(predicate(
+            {"title": None, "tracks": [{"milliseconds": 2000}]}))
+        predicate = MqlBuilder.compile_predicate(
+            Employee, {"manager": {"$exists": False}})
+        self.assertTrue(predicate({"manager": None}))
+        self.assertFalse(predicate({"manager": {"employee_id": 1}}))
+
+    def test_compile_predicate_fail(self):
+        """Test compiling a predicate fails for invalid filters."""
+        self.assertRaises(
+            InvalidMqlException,
+            MqlBuilder.compile_predicate,
+            model_class=Track,
+            filters={"track_id": {"$bad": 1}}
+        )
+        self.assertRaises(
+            MqlFieldPermissionError,
+            MqlBuilder.compile_predicate,
+            model_class=Track,
+            filters={"album.title": "x"},
+            whitelist=["track_id"]
+        )
+
+    @unittest.skipIf(numpy is None, "NumPy isn't installed.")
+    def test_compile_vectorized(self):
+        """Test vectorized filters match the same rows as predicates."""
+        tracks = self.db_session.execute(select(Track)).scalars().all()
+        columns = {
+            key: [getattr(track, key) for track in tracks]
+            for key in ("track_id", "name", "composer", "bytes",
+                        "unit_price")}
+        filters_list = [
+            {"composer": {"$ne": "AC/DC"}},
+            {"composer": {"$nin": ["AC/DC", None]}},
+            {"$not": {"composer": {"$like": "john"}}},
+            {"name": {"$like": "r_ck%you"}},
+            {"bytes": {"$mod": [7, 3]}},
+            {"$or": [{"track_id": {"$in": [1, "2"]}},
+                     {"unit_price": {"$gt": 0.99}}]}
+        ]
+        for filters in filters_list:
+            predicate = MqlBuilder.compile_predicate(Track, filters)
+            expected = [predicate(track) for track in tracks]
+            vectorized = MqlBuilder.compile_vectorized(Track, filters)
+            self.assertTrue(list(vectorized(columns)) == expected)
+            self.assertTrue(list(vectorized({
+                key: numpy.asarray(column)
+                for key, column in columns.items()})) == expected)
+
+    @unittest.skipIf(numpy is None, "NumPy isn't installed.")
+    def test_compile_vectorized_relation_fail(self):
+        """Test vectorized filters fail for relationships."""
+        with self.assertRaises(MqlFieldError) as context:
+            MqlBuilder.compile_vectorized(Track, {"album.title": "x"})
+        self.assertTrue(
+            context.exception.code == "invalid_relation_filter")
+
+    def test_plan_cache(self):
+        """Test filters with a known shape reuse a cached plan."""
+        class CachedMqlBuilder(MqlBuilder):
+            plan_cache = MqlPlanCache(maxsize=2)
+
+        for playlist_id, album_ids in ((18, [1, 48]), ("18", ["48", 2])):
+            stmt = CachedMqlBuilder.apply_mql_filters(
+                model_class=Album,
+                filters={"tracks.playlists.playlist_id": playlist_id,
+                         "album_id": {"$in": album_ids}}
+            )
+            result = self.db_session.execute(stmt).scalars().all()
+            self.assertTrue(len(result) == 1)
+            self.assertTrue(result[0].album_id == 48)
+        cache = CachedMqlBuilder.plan_cache
+        self.assertTrue(cache.misses == 1 and cache.hits == 1)
+        CachedMqlBuilder.parse_mql_filters(Album, {"album_id": None})
+        CachedMqlBuilder.parse_mql_filters(Album, {"album_id": 5})
+        self.assertTrue(cache.misses == 3 and cache.evictions == 1)
+        self.assertTrue(len(cache) == 2)
+        cache.clear()
+        self.assertTrue(len(cache) == 0 and cache.misses == 0)
+
+    def test_plan_cache_isolation(self):
+        """Test cached plans aren't shared between different params."""
+        class CachedMqlBuilder(MqlBuilder):
+            plan_cache = MqlPlanCache()
+
+        CachedMqlBuilder.parse_mql_filters(
+            model_class=Playlist,
+            filters={"tracks.track_id": 7},
+            whitelist=["tracks.track_id"]
+        )
+        self.assertRaises(
+            InvalidMqlException,
+            CachedMqlBuilder.parse_mql_filters,
+            model_class=Playlist,
+            filters={"tracks.track_id": 7},
+            whitelist=["playlist_id"]
+        )
+        stmt = CachedMqlBuilder.apply_mql_filters(
+            model_class=Playlist,
+            filters={"tracks.track_id": 166},
+            nested_conditions={
+                "tracks": Track.album.has(Album.album_id != 18)}
+        )
+        result = self.db_session.execute(stmt).scalars().all()
+        self.assertTrue(len(result) == 0)
+        self.assertRaises(
+            InvalidMqlException,
+            CachedMqlBuilder.parse_mql_filters,
+            model_class=Playlist,
+            filters={"tracks.track_id": 7},
+            whitelist=["tracks.track_id"],
+            convert_key_names_func=lambda txt: txt.upper()
+        )
+        self.assertTrue(len(CachedMqlBuilder.plan_cache) == 2)
+
+    def test_plan_cache_subclass_isolation(self):
+        """Test subclasses sharing a plan cache don't share plans."""
+        class CachedMqlBuilder(MqlBuilder):
+            plan_cache = MqlPlanCache()
+
+        class MergedMqlBuilder(CachedMqlBuilder):
+            merge_relation_filters = True
+        filters = {"tracks.name": "Fast As a Shark", "tracks.bytes": 1}
+        stmt = CachedMqlBuilder.apply_mql_filters(Album, filters=filters)
+        self.assertTrue(str(stmt).count("EXISTS") == 2)
+        stmt = MergedMqlBuilder.apply_mql_filters(Album, filters=filters)
+        self.assertTrue(str(stmt).count("EXISTS") == 1)
+        self.assertTrue(len(CachedMqlBuilder.plan_cache) == 2)
+
+    def test_plan_cache_errors(self):
+        """Test errors with a plan cache report the provided values."""
+        class CachedMqlBuilder(MqlBuilder):
+            plan_cache = MqlPlanCache()
+        for filters in ({"name": {"$mod": [2, 1]}},
+                        {"name": {"$bogus": 1}},
+                        {"name": {"first": "x"}}):
+            errors = []
+            for builder in (MqlBuilder, CachedMqlBuilder):
+                try:
+                    builder.parse_mql_filters(Track, filters)
+                except MqlFieldError as exc:
+                    errors.append(
+                        (exc.data_key, exc.op, exc.code, exc.filter))
+            self.assertTrue(len(errors) == 2)
+            self.assertTrue(errors[0] == errors[1])
+
+    def test_plan_cache_callable_whitelist(self):
+        """Test callable whitelists are checked on every call."""
+        class CachedMqlBuilder(MqlBuilder):
+            plan_cache = MqlPlanCache()
+        user = {"admin": True}
+
+        def whitelist(attr_name):
+            return user["admin"] or attr_name != "unit_price"
+        stmt = CachedMqlBuilder.apply_mql_filters(
+            Track, filters={"unit_price": 1.99}, whitelist=whitelist)
+        result = self.db_session.execute(stmt).scalars().all()
+        self.assertTrue(len(result) == 213)
+        user["admin"] = False
+        self.assertRaises(
+            MqlFieldPermissionError,
+            CachedMqlBuilder.apply_mql_filters,
+            Track, filters={"unit_price": 1.99}, whitelist=whitelist)
+        self.assertTrue(len(CachedMqlBuilder.plan_cache) == 0)
+
+    def test_profiler(self):
+        """Test parsing records timings and counters when profiled."""
+        profiles = []
+
+        class ProfiledMqlBuilder(MqlBuilder):
+            profiler = MqlProfiler(callback=profiles.append)
+
+        stmt = ProfiledMqlBuilder.apply_mql_filters(
+            model_class=Album,
+            filters={"tracks.playlists.playlist_id": "18",
+                     "album_id": {"$in": [1, 48]},
+                     "artist.name": {"$like": "Miles"}},
+            whitelist=["tracks.playlists.playlist_id", "album_id",
+                       "artist.name"]
+        )
+        result = self.db_session.execute(stmt).scalars().all()
+        self.assertTrue(len(result) == 1)
+        self.assertTrue(result[0].album_id == 48)
+        self.assertTrue(len(profiles) == 1)
+        profile = profiles[0]
+        self.assertTrue(profile.counters["sub_queries"] == 3)
+        self.assertTrue(profile.counters["comparisons"] == 3)
+        self.assertTrue(profile.counters["values_converted"] == 3)
+        self.assertTrue(profile.counters["whitelist_calls"] > 0)
+        self.assertTrue(profile.counters["nodes_visited"] > 0)
+        self.assertTrue(profile.counters["max_stack_depth"] > 1)
+        self.assertTrue(profile.total >= sum(profile.timings.values()) > 0)
+        self.assertTrue(profile.as_dict()["model"] == "Album")
+        ProfiledMqlBuilder.parse_mql_filters(Album, {"album_id": 1})
+        profiler = ProfiledMqlBuilder.profiler
+        self.assertTrue(profiler.parses == 2)
+        self.assertTrue(profiler.counters["comparisons"] == 4)
+        profiler.reset()
+        self.assertTrue(profiler.parses == 0)
+        # not profiled unless enabled
+        MqlBuilder.parse_mql_filters(Album, {"album_id": 1})
+        self.assertTrue(len(profiles) == 2)
+
+    def test_profiler_error(self):
+        """Test a failed parse is still recorded by the profiler."""
+        profiles = []
+
+        class ProfiledMqlBuilder(MqlBuilder):
+            profiler = MqlProfiler(callback=profiles.append)
+
+        self.assertRaises(
+            MqlFieldError,
+            ProfiledMqlBuilder.parse_mql_filters,
+            model_class=Album,
+            filters={"album_id": {"$gt": "bad"}}
+        )
+        self.assertTrue(ProfiledMqlBuilder.profiler.errors == 1)
+        self.assertTrue(
+            profiles[0].as_dict()["error"] == "MqlFieldError")
+
+    def test_validate(self):
+        """Test validating filters finds every error."""
+        errors = MqlBuilder.validate(
+            model_class=Album,
+            filters={
+                "bad_field": 1,
+                "album_id": {"$gt": "x", "$in": 5},
+                "tracks": 4,
+                "title": {"$elemMatch": {"name": 1}},
+                "$or": {"title": 1},
+                "tracks.name": {"$bad": 1, "$like": "Love"},
+                "artist.name": {"sub_field": 1},
+                "tracks.playlists": {},
+                "artist.artist_id": {"$mod": [2, 1]}
+            }
+        )
+        codes = sorted(error.code for error in errors)
+        self.assertTrue(codes == [
+            "data_conversion_error", "invalid_attr_comp",
+            "invalid_elem_match", "invalid_empty_comp", "invalid_field",
+            "invalid_in_comp", "invalid_logical_op", "invalid_op",
+            "invalid_relation_comp"])
+        errors = MqlBuilder.validate(
+            model_class=Album,
+            filters={"tracks.name": "Love", "title": "Love"},
+            whitelist=["title"]
+        )
+        self.assertTrue(len(errors) == 1)
+        self.assertTrue(isinstance(errors[0], MqlFieldPermissionError))
+        self.assertTrue(errors[0].data_key == "tracks.name")
+
+    def test_validate_valid(self):
+        """Test validating valid filters finds no errors."""
+        filters = {
+            "tracks.playlists.playlist_id": "18",
+            "album_id": {"$in": [1, 48]},
+            "$or": [{"title": {"$like": "Miles"}},
+                    {"artist.name": "Miles Davis"}],
+            "$not": {"tracks": {"$elemMatch": {"bytes": {"$gt": 1}}}}
+        }
+        self.assertTrue(MqlBuilder.validate(Album, filters) == [])
+        self.assertTrue(
+            MqlBuilder.parse_mql_filters(Album, filters) is not None)
+
+    def test_validate_too_complex(self):
+        """Test validating filters over budget stops checking."""
+        errors = MqlBuilder.validate(
+            model_class=Track,
+            filters={"bad_field": 1,
+                     "track_id": {"$in": list(range(100000))}},
+            cost=MqlCost(max_cost=1000)
+        )
+        self.assertTrue(isinstance(errors[-1], MqlTooComplex))
+        errors = MqlBuilder.validate(
+            model_class=Track,
+            filters={"$and": [{"track_id": 1}, {"track_id": 2}]},
+            stack_size_limit=1
+        )
+        self.assertTrue(len(errors) == 1)
+        self.assertTrue(isinstance(errors[0], MqlTooComplex))
+
+    def test_cost(self):
+        """Test the estimated cost of filters is returned."""
+        cost = MqlCost(max_cost=100)
+        stmt = apply_mql_filters(
+            model_class=Album,
+            filters={"tracks.playlists.playlist_id": 18,
+                     "album_id": {"$in": [1, 48]},
+                     "$or": [{"title": {"$like": "Miles"}},
+                             {"artist.name": "Miles Davis"}]},
+            cost=cost
+        )
+        result = self.db_session.execute(stmt).scalars().all()
+        self.assertTrue(len(result) == 1)
+        self.assertTrue(result[0].album_id == 48)
+        # two collection hops, one many to one hop, a $like, three other
+        # comparisons, and two $in values.
+        self.assertTrue(abs(cost.cost - (20 * 2 + 5 + 5 + 3 + 0.1 * 2)) <
+                        1e-9)
+
+    def test_cost_model(self):
+        """Test custom cost weights are used, ignoring the plan cache."""
+        class CostlyMqlBuilder(MqlBuilder):
+            plan_cache = MqlPlanCache()
+            cost_model = MqlCostModel(
+                comparison=2, in_value=1, op_weights={"$or": 3})
+
+        cost = MqlCost()
+        CostlyMqlBuilder.parse_mql_filters(
+            model_class=Track,
+            filters={"$or": [{"track_id": {"$in": [1, 2, 3]}},
+                             {"name": {"$like": "Love"}}]},
+            cost=cost
+        )
+        self.assertTrue(cost.cost == 3 + 2 + 3 + 2)
+        self.assertTrue(len(CostlyMqlBuilder.plan_cache) == 0)
+        cost = MqlCost(cost_model=MqlCostModel(relation=7))
+        CostlyMqlBuilder.parse_mql_filters(
+            model_class=Track, filters={"album.title": "x"}, cost=cost)
+        self.assertTrue(cost.cost == 7 + 1)
+
+    def test_cost_fail(self):
+        """Test filters over budget raise an exception."""
+        self.assertRaises(
+            MqlTooComplex,
+            apply_mql_filters,
+            model_class=Track,
+            filters={"track_id": {"$in": list(range(100000))}},
+            cost=MqlCost(max_cost=1000)
+        )
+        filters = {"album_id": 1}
+        for i in range(12):
+            filters = {"tracks.album": filters}
+        self.assertRaises(
+            MqlTooComplex,
+            apply_mql_filters,
+            model_class=Album,
+            filters=filters,
+            cost=MqlCost(max_cost=200)
+        )
+
+
+    @unittest.skipIf(aiosqlite is None, "aiosqlite isn't installed.")
+    def test_execute_async(self):
+        """Test executing filters with an async session."""
+        connect_string = "sqlite+aiosqlite:///" + os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), "chinook.sqlite")
+
+        async def whitelist(key):
+            await asyncio.sleep(0)
+            return key in ("artist", "artist.name", "album_id")
+
+        async def run():
+            engine = create_async_engine(connect_string)
+            try:
+                async with AsyncSession(engine) as session:
+                    result = await MqlBuilder.execute_mql_filters_async(
+                        session, Album,
+                        filters={"artist.name": "Miles Davis"},
+                        whitelist=whitelist)
+                    albums = result.all()
+                    with self.assertRaises(MqlFieldPermissionError):
+                        await MqlBuilder.execute_mql_filters_async(
+                            session, Album, filters={"title": "Kind of Blue"},
+                            whitelist=whitelist)
+            finally:
+                await engine.dispose()
+            return albums
+
+        result = asyncio.run(run())
+        self.assertTrue(len(result) == 3)
+        self.assertTrue(all(album.artist_id == 68 for album in result))
+
+    def test_apply_async(self):
+        """Test building filters with async callables."""
+        async def convert_key_names(key):
+            return {"albumId": "album_id"}.get(key, key)
+
+        async def run():
+            stmt = await MqlBuilder.apply_mql_filters_async(
+                Album, filters={"albumId": 48},
+                convert_key_names_func=convert_key_names)
+            offloaded_stmt = await MqlBuilder.apply_mql_filters_async(
+                Album, filters={"album_id": 48}, offload=True)
+            expressions = await MqlBuilder.parse_mql_filters_async(
+                Album, filters={"album_id": 48})
+            return stmt, offloaded_stmt, expressions
+
+        stmt, offloaded_stmt, expressions = asyncio.run(run())
+        result = self.db_session.execute(stmt).scalars().all()
+        self.assertTrue(len(result) == 1)
+        self.assertTrue(result[0].album_id == 48)
+        result = self.db_session.execute(offloaded_stmt).scalars().all()
+        self.assertTrue(len(result) == 1)
+        self.assertTrue(len(expressions) == 1)
+
+    def test_stream(self):
+        """Test streaming filtered results in chunks."""
+        chunks = list(MqlBuilder.stream_mql_filters(
+            self.db_session, Invoice,
+            filters={"customer.country": "USA"},
+            chunk_size=10))
+        expected = self.db_session.execute(
+            select(Invoice).join(Invoice.customer).where(
+                Customer.country == "USA")).scalars().all()
+        self.assertTrue(all(len(chunk) <= 10 for chunk in chunks))
+        self.assertTrue(len(chunks) == (len(expected) + 9) // 10)
+        result = [invoice for chunk in chunks for invoice in chunk]
+        self.assertTrue(
+            sorted(invoice.invoice_id for invoice in result) ==
+            sorted(invoice.invoice_id for invoice in expected))
+
+    def test_stream_columns(self):
+        """Test streaming rows of only some columns."""
+        chunks = list(MqlBuilder.stream_mql_filters(
+            self.db_session, Invoice,
+            filters={"customer.country": "USA", "total": {"$gt": 10}},
+            relation_strategy="join",
+            chunk_size=5,
+            columns=["invoice_id", "total"]))
+        rows = [row for chunk in chunks for row in chunk]
+        self.assertTrue(len(rows) > 5)
+        self.assertTrue(all(len(row) == 2 for row in rows))
+        self.assertTrue(all(row.total > 10 for row in rows))
+        self.assertRaises(
+            ValueError,
+            lambda: list(MqlBuilder.stream_mql_filters(
+                self.db_session, Invoice, columns=["customer"])))
+
+    def test_stream_invalid_filters(self):
+        """Test invalid filters raise when streaming is started."""
+        self.assertRaises(
+            InvalidMqlException,
+            MqlBuilder.stream_mql_filters,
+            self.db_session, Invoice, filters={"total": {"$bogus": 1}})
+        self.assertRaises(
+            ValueError,
+            MqlBuilder.stream_mql_filters,
+            self.db_session, Invoice, columns=["customer"])
+
+    @unittest.skipIf(aiosqlite is None, "aiosqlite isn't installed.")
+    def test_stream_async(self):
+        """Test streaming filtered results with an async session."""
+        connect_string = "sqlite+aiosqlite:///" + os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), "chinook.sqlite")
+
+        async def run():
+            engine = create_async_engine(connect_string)
+            chunks = []
+            errors = []
+            try:
+                async with AsyncSession(engine) as session:
+                    stream = await MqlBuilder.stream_mql_filters_async(
+                        session, Track, filters={"album_id": 48},
+                        chunk_size=4)
+                    async for chunk in stream:
+                        chunks.append(chunk)
+                    stream = await MqlBuilder.stream_mql_filters_async(
+                        session, Track, filters={"album_id": 48},
+                        columns=["track_id"])
+                    async for chunk in stream:
+                        rows = chunk
+                    try:
+                        await MqlBuilder.stream_mql_filters_async(
+                            session, Track,
+                            filters={"milliseconds": {"$bogus": 1}})
+                    except InvalidMqlException:
+                        errors.append(True)
+            finally:
+                await engine.dispose()
+            return chunks, rows, errors
+
+        chunks, rows, errors = asyncio.run(run())
+        self.assertTrue(errors == [True])
+        self.assertTrue(all(len(chunk) <= 4 for chunk in chunks))
+        result = [track for chunk in chunks for track in chunk]
+        self.assertTrue(len(result) == len(rows))
+        self.assertTrue(all(track.album_id == 48 for track in result))
+
+    def _paginate(self, model_class, filters, sort, limit):
+        """Get all pages of results using keyset pagination."""
+        pages = []
+        cursor = None
+        while True:
+            stmt = MqlBuilder.paginate_mql_filters(
+                model_class, filters=filters, sort=sort, cursor=cursor,
+                limit=limit)
+            page = self.db_session.execute(stmt).scalars().all()
+            if not page:
+                return pages
+            pages.append(page)
+            cursor = MqlBuilder.get_keyset_cursor(
+                model_class, page[-1], sort)
+
+    def test_paginate(self):
+        """Test keyset pagination matches the full sorted results."""
+        filters = {"genre.name": "Jazz"}
+        sort = {"unit_price": -1, "name": 1}
+        expected = self.db_session.execute(
+            select(Track).join(Track.genre).where(
+                Genre.name == "Jazz").order_by(
+                Track.unit_price.desc(), Track.name, Track.track_id)
+        ).scalars().all()
+        pages = self._paginate(Track, filters, sort, 17)
+        self.assertTrue(all(len(page) <= 17 for page in pages))
+        result = [track for page in pages for track in page]
+        self.assertTrue(
+            [track.track_id for track in result] ==
+            [track.track_id for track in expected])
+
+    def test_paginate_row_values(self):
+        """Test keyset pagination with and without row values."""
+        sort = [("milliseconds", -1), ("track_id", -1)]
+        results = []
+        try:
+            for row_values in (True, False):
+                MqlBuilder.keyset_row_values = row_values
+                pages = self._paginate(Track, {"album_id": 48}, sort, 4)
+                results.append(
+                    [track.track_id for page in pages for track in page])
+        finally:
+            MqlBuilder.keyset_row_values = True
+        self.assertTrue(len(results[0]) > 4)
+        self.assertTrue(results[0] == results[1])
+
+    def test_paginate_fail(self):
+        """Test invalid sorts and cursors are rejected."""
+        with self.assertRaises(MqlFieldPermissionError):
+            MqlBuilder.paginate_mql_filters(
+                Track, sort={"bytes": 1}, whitelist=["name"])
+        for sort in ({"name": 2}, {"album": 1}, {"album.title": 1},
+                     {"bad_field": 1}):
+            with self.assertRaises(MqlFieldError) as context:
+                MqlBuilder.paginate_mql_filters(Track, sort=sort)
+            self.assertTrue(context.exception.code == "invalid_sort")
+        cursor = MqlBuilder.get_keyset_cursor(
+            Track, self.db_session.get(Track, 1), {"name": 1})
+        MqlBuilder.paginate_mql_filters(
+            Track, sort={"name": 1}, cursor=cursor)
+        for invalid_cursor in (cursor + "x", "abc", cursor[:-4]):
+            self.assertRaises(
+                InvalidMqlException,
+                MqlBuilder.paginate_mql_filters,
+                Track, sort={"name": 1}, cursor=invalid_cursor)
+        self.assertRaises(
+            InvalidMqlException,
+            MqlBuilder.paginate_mql_filters,
+            Track, sort={"name": 1, "milliseconds": 1}, cursor=cursor)
+
+    def test_sort(self):
+        """Test sorting filtered results."""
+        stmt = MqlBuilder.apply_mql_filters(
+            Track, filters={"album_id": 48},
+            sort=[("milliseconds", -1), ("name", 1)])
+        result = self.db_session.execute(stmt).scalars().all()
+        self.assertTrue(len(result) > 1)
+        self.assertTrue(
+            [track.milliseconds for track in result] ==
+            sorted([track.milliseconds for track in result], reverse=True))
+        with self.assertRaises(MqlFieldPermissionError):
+            MqlBuilder.apply_mql_filters(
+                Track, filters={"album_id": 48}, sort={"bytes": 1},
+                whitelist=["album_id"])
+
+    def test_projection(self):
+        """Test only projected fields are loaded."""
+        stmt = MqlBuilder.apply_mql_filters(
+            Track, filters={"album_id": 48},
+            projection={"name": 1, "album.artist.name": 1})
+        result = self.db_session.execute(stmt).scalars().all()
+        self.assertTrue(len(result) > 1)
+        track_state = inspect(result[0])
+        self.assertTrue("name" not in track_state.unloaded)
+        self.assertTrue("bytes" in track_state.unloaded)
+        self.assertTrue("genre" in track_state.unloaded)
+        self.assertTrue("album" not in track_state.unloaded)
+        album_state = inspect(track_state.dict["album"])
+        self.assertTrue("title" in album_state.unloaded)
+        self.assertTrue("artist" not in album_state.unloaded)
+        artist = album_state.dict["artist"]
+        self.assertTrue(artist.name == "Miles Davis")
+
+    def test_projection_exclude(self):
+        """Test excluded fields aren't loaded."""
+        stmt = MqlBuilder.apply_mql_filters(
+            Track, filters={"album_id": 48},
+            projection={"bytes": 0, "album.title": 0})
+        result = self.db_session.execute(stmt).scalars().all()
+        track_state = inspect(result[0])
+        self.assertTrue("bytes" in track_state.unloaded)
+        self.assertTrue("name" not in track_state.unloaded)
+        self.assertTrue(result[0].album.artist_id == 68)
+        self.assertTrue("title" in inspect(result[0].album).unloaded)
+
+    def test_projection_fail(self):
+        """Test invalid projections are rejected."""
+        for projection in ({"name": 1, "bytes": 0}, {"name": 2},
+                           {"bad_field": 1}, {"album.0.title": 1}):
+            with self.assertRaises(MqlFieldError) as context:
+                MqlBuilder.apply_mql_filters(Track, projection=projection)
+            self.assertTrue(context.exception.code == "invalid_projection")
+        with self.assertRaises(MqlFieldPermissionError):
+            MqlBuilder.apply_mql_filters(
+                Track, projection=["name", "album.title"],
+                whitelist=["name", "album"])
+
+    def _count_statements(self, func):
+        """Count the statements executed by a function."""
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(
+            self.db_engine, "before_cursor_execute", before_cursor_execute)
+        try:
+            result = func()
+        finally:
+            event.remove(
+                self.db_engine, "before_cursor_execute",
+                before_cursor_execute)
+        return result, len(statements)
+
+    def test_load_plan(self):
+        """Test relationships filtered on are eagerly loaded."""
+        for plan_cache in (None, MqlPlanCache()):
+            load_plan = MqlLoadPlan()
+            try:
+                MqlBuilder.plan_cache = plan_cache
+                stmt = MqlBuilder.apply_mql_filters(
+                    Album,
+                    filters={"tracks.playlists.name": "Grunge",
+                             "artist.name": {"$like": "a"}},
+                    load_plan=load_plan)
+            finally:
+                MqlBuilder.plan_cache = None
+            self.assertTrue(load_plan.paths == {
+                "artist": "joined",
+                "tracks": "selectin",
+                "tracks.playlists": "selectin"})
+            self.assertTrue(load_plan.round_trips == 3)
+
+            def load():
+                albums = self.db_session.execute(
+                    stmt).unique().scalars().all()
+                for album in albums:
+                    album.artist.name
+                    for track in album.tracks:
+                        [playlist.name for playlist in track.playlists]
+                return albums
+
+            result, count = self._count_statements(load)
+            self.assertTrue(len(result) > 1)
+            self.assertTrue(count == load_plan.round_trips)
+            self.db_session.expunge_all()
+
+    def test_load_plan_strategies(self):
+        """Test configuring how each relationship path is loaded."""
+        load_plan = MqlLoadPlan(
+            scalar_strategy="selectin",
+            strategies={"tracks.playlists": "lazy"})
+        MqlBuilder.apply_mql_filters(
+            Album, filters={"tracks.playlists.name": "Grunge",
+                            "artist.name": "Pearl Jam"},
+            load_plan=load_plan)
+        self.assertTrue(load_plan.paths == {
+            "artist": "selectin",
+            "tracks": "selectin",
+            "tracks.playlists": "lazy"})
+        self.assertTrue(load_plan.round_trips == 3)
+        self.assertRaises(
+            ValueError, MqlLoadPlan, strategies={"tracks": "bad"})
+
+    def test_load_plan_projection(self):
+        """Test eager loading follows the projection."""
+        load_plan = MqlLoadPlan()
+        MqlBuilder.apply_mql_filters(
+            Album, filters={"tracks.playlists.name": "Grunge"},
+            projection={"title": 1, "artist.name": 1},
+            load_plan=load_plan)
+        self.assertTrue(load_plan.paths == {"artist": "joined"})
+        load_plan = MqlLoadPlan()
+        stmt = MqlBuilder.apply_mql_filters(
+            Album, filters={"tracks.playlists.name": "Grunge"},
+            projection={"tracks": 0},
+            load_plan=load_plan)
+        self.assertTrue(load_plan.paths == {})
+        result = self.db_session.execute(stmt).scalars().all()
+        self.assertTrue("tracks" in inspect(result[0]).unloaded)
+
+    def test_count(self):
+        """Test counting the results of filters."""
+        filters = {"tracks.playlists.name": "Grunge"}
+        stmt = MqlBuilder.apply_mql_filters(Album, filters=filters)
+        expected = len(self.db_session.execute(stmt).scalars().all())
+        count = MqlBuilder.count_mql_filters(
+            self.db_session, Album, filters=filters)
+        self.assertTrue(count == expected)
+        # joins to a collection are counted distinctly.
+        query = select(Album).join(Album.tracks).order_by(Album.title)
+        count = MqlBuilder.count_mql_filters(
+            self.db_session, Album, query=query.limit(2), filters=filters)
+        self.assertTrue(count == expected)
+        count = MqlBuilder.count_mql_filters(
+            self.db_session, Album, filters=filters, estimate=True)
+        self.assertTrue(count == expected)
+
+    def test_count_cap(self):
+        """Test counting stops after the cap."""
+        count = MqlBuilder.count_mql_filters(
+            self.db_session, Track, filters={"milliseconds": {"$gt": 0}},
+            cap=100)
+        self.assertTrue(count == 101)
+        count = MqlBuilder.count_mql_filters(
+            self.db_session, Track, filters={"album_id": 48}, cap=100)
+        self.assertTrue(count < 100)
+
+    def test_count_cache(self):
+        """Test exact counts are cached until they expire."""
+        now = [0]
+        count_cache = MqlCountCache(ttl=10, timer=lambda: now[0])
+        try:
+            MqlBuilder.count_cache = count_cache
+            count = MqlBuilder.count_mql_filters(
+                self.db_session, Track, filters={"album_id": 48})
+            MqlBuilder.count_mql_filters(
+                self.db_session, Track, filters={"album_id": 48})
+            self.assertTrue(count_cache.hits == 1)
+            other_count = MqlBuilder.count_mql_filters(
+                self.db_session, Track, filters={"album_id": 1})
+            self.assertTrue(count_cache.hits == 1)
+            self.assertTrue(other_count != count)
+            now[0] = 10
+            MqlBuilder.count_mql_filters(
+                self.db_session, Track, filters={"album_id": 48})
+            self.assertTrue(count_cache.hits == 1)
+            self.assertTrue(count_cache.misses == 3)
+            with self.assertRaises(MqlFieldPermissionError):
+                MqlBuilder.count_mql_filters(
+                    self.db_session, Track, filters={"album_id": 48},
+                    whitelist=["name"])
+        finally:
+            MqlBuilder.count_cache = None
+
+    @unittest.skipIf(aiosqlite is None, "aiosqlite isn't installed.")
+    def test_count_async(self):
+        """Test counting the results of filters with an async session."""
+        connect_string = "sqlite+aiosqlite:///" + os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), "chinook.sqlite")
+
+        async def run():
+            engine = create_async_engine(connect_string)
+            try:
+                async with AsyncSession(engine) as session:
+                    return await MqlBuilder.count_mql_filters_async(
+                        session, Track, filters={"album_id": 48})
+            finally:
+                await engine.dispose()
+
+        count = asyncio.run(run())
+        expected = MqlBuilder.count_mql_filters(
+            self.db_session, Track, filters={"album_id": 48})
+        self.assertTrue(count == expected)
+
+    def test_canonicalize(self):
+        """Test equivalent filters are canonicalized the same way."""
+        equivalent = [
+            {"album_id": 48, "name": {"$in": ["b", "a"]}},
+            {"name": {"$in": ["a", "b", "a"]}, "album_id": {"$eq": 48}},
+            {"$and": [{"album_id": 48}, {"name": {"$in": ["a", "b"]}}]},
+            {"$and": [{"$and": [{"name": {"$in": ["a", "b"]}}]},
+                      {"$or": [{"album_id": 48}]}]}
+        ]
+        expected = MqlBuilder.canonicalize_mql_filters(equivalent[0])
+        self.assertTrue(
+            expected == {"album_id": 48, "name": {"$in": ["a", "b"]}})
+        for filters in equivalent:
+            self.assertTrue(
+                MqlBuilder.canonicalize_mql_filters(filters) == expected)
+            self.assertTrue(
+                MqlBuilder.hash_mql_filters(filters) ==
+                MqlBuilder.hash_mql_filters(equivalent[0]))
+        self.assertTrue(
+            MqlBuilder.canonicalize_mql_filters(
+                {"$or": [{"name": "b"}, {"composer": "null"}]}) ==
+            {"$or": [{"composer": None}, {"name": "b"}]})
+        self.assertTrue(
+            MqlBuilder.hash_mql_filters({"album_id": 48}) !=
+            MqlBuilder.hash_mql_filters({"album_id": "48"}))
+        # results of canonicalized filters match the originals.
+        filters = {"$and": [
+            {"milliseconds": {"$gt": 300000}},
+            {"milliseconds": {"$lt": 400000}},
+            {"$or": [{"genre.name": "Metal"}]}]}
+        for merge_relation_filters in (False, True):
+            class Builder(MqlBuilder):
+                pass
+            Builder.merge_relation_filters = merge_relation_filters
+            result = self.db_session.execute(Builder.apply_mql_filters(
+                Track, filters=filters)).scalars().all()
+            canonical_result = self.db_session.execute(
+                Builder.apply_mql_filters(
+                    Track, filters=Builder.canonicalize_mql_filters(filters))
+            ).scalars().all()
+            self.assertTrue(len(result) > 0)
+            self.assertTrue(result == canonical_result)
+
+    def test_canonicalize_null(self):
+        """Test "null" strings are only made None where it's equal."""
+        self.assertTrue(
+            MqlBuilder.canonicalize_mql_filters(
+                {"name": {"$like": "null"}}) ==
+            {"name": {"$like": "null"}})
+        self.assertTrue(
+            MqlBuilder.canonicalize_mql_filters(
+                {"composer": {"$ne": "null", "$nin": ["NULL", "a"]}}) ==
+            {"composer": {"$ne": None, "$nin": ["a", None]}})
+        filters = {"name": {"$like": "null"}}
+        result = self.db_session.execute(MqlBuilder.apply_mql_filters(
+            Track, filters=filters)).scalars().all()
+        canonical_result = self.db_session.execute(
+            MqlBuilder.apply_mql_filters(
+                Track, filters=MqlBuilder.canonicalize_mql_filters(filters))
+        ).scalars().all()
+        self.assertTrue(result == canonical_result)
+
+    def test_result_cache(self):
+        """Test results are cached until their tables change."""
+        result_cache = MqlResultCache()
+        result_cache.listen(self.DBSession)
+        try:
+            MqlBuilder.result_cache = result_cache
+            result, statements = self._count_statements(
+                lambda: MqlBuilder.execute_mql_filters(
+                    self.db_session, Album,
+                    filters={"artist.name": "Miles Davis"}).all())
+            self.assertTrue(len(result) == 3)
+            self.assertTrue(statements == 1)
+            cached_result, statements = self._count_statements(
+                lambda: MqlBuilder.execute_mql_filters(
+                    self.db_session, Album,
+                    filters={"artist.name": {"$eq": "Miles Davis"}}).all())
+            self.assertTrue(statements == 0)
+            self.assertTrue(result_cache.backend.hits == 1)
+            self.assertTrue(cached_result == result)
+            # filters are still checked against the whitelist.
+            with self.assertRaises(MqlFieldPermissionError):
+                MqlBuilder.execute_mql_filters(
+                    self.db_session, Album,
+                    filters={"artist.name": "Miles Davis"},
+                    whitelist=["title"])
+            # changing a related table invalidates the results.
+            artist = self.db_session.get(Artist, 68)
+            artist.name = "Miles"
+            self.db_session.flush()
+            result, statements = self._count_statements(
+                lambda: MqlBuilder.execute_mql_filters(
+                    self.db_session, Album,
+                    filters={"artist.name": "Miles Davis"}).all())
+            self.assertTrue(statements == 1)
+            self.assertTrue(len(result) == 0)
+            self.db_session.rollback()
+            result = MqlBuilder.execute_mql_filters(
+                self.db_session, Album,
+                filters={"artist.name": "Miles Davis"}).all()
+            self.assertTrue(len(result) == 3)
+            # unrelated tables don't.
+            customer = self.db_session.get(Customer, 1)
+            customer.company = "Test"
+            self.db_session.flush()
+            _, statements = self._count_statements(
+                lambda: MqlBuilder.execute_mql_filters(
+                    self.db_session, Album,
+                    filters={"artist.name": "Miles Davis"}).all())
+            self.assertTrue(statements == 0)
+            self.db_session.rollback()
+        finally:
+            MqlBuilder.result_cache = None
+            result_cache.remove(self.DBSession)
+
+    def test_result_cache_query_tables(self):
+        """Test tables joined by a provided query invalidate results."""
+        result_cache = MqlResultCache()
+        result_cache.listen(self.DBSession)
+        query = select(Album).join(Album.artist).where(
+            Artist.name == "AC/DC")
+        try:
+            MqlBuilder.result_cache = result_cache
+            result = MqlBuilder.execute_mql_filters(
+                self.db_session, Album, query=query).all()
+            self.assertTrue(
+                [album.album_id for album in result] == [1, 4])
+            artist = self.db_session.get(Artist, 1)
+            artist.name = "ACDC"
+            self.db_session.flush()
+            result = MqlBuilder.execute_mql_filters(
+                self.db_session, Album, query=query).all()
+            self.assertTrue(result == [])
+            self.db_session.rollback()
+        finally:
+            MqlBuilder.result_cache = None
+            result_cache.remove(self.DBSession)
+
+    @unittest.skipIf(aiosqlite is None, "aiosqlite isn't installed.")
+    def test_result_cache_async(self):
+        """Test results are cached with an async session."""
+        connect_string = "sqlite+aiosqlite:///" + os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), "chinook.sqlite")
+
+        async def run():
+            engine = create_async_engine(connect_string)
+            try:
+                async with AsyncSession(engine) as session:
+                    results = []
+                    for i in range(2):
+                        result = await MqlBuilder.execute_mql_filters_async(
+                            session, Album,
+                            filters={"artist.name": "Miles Davis"})
+                        results.append(result.all())
+                    return results
+            finally:
+                await engine.dispose()
+
+        try:
+            MqlBuilder.result_cache = MqlResultCache()
+            first, second = asyncio.run(run())
+            self.assertTrue(MqlBuilder.result_cache.backend.hits == 1)
+        finally:
+            MqlBuilder.result_cache = None
+        self.assertTrue(len(first) == 3)
+        self.assertTrue(first == second)
+
+    def test_normalize(self):
+        """Test filters are simplified."""
+        cases = [
+            ({"$and": [{"$and": [{"name": "a"}]}, {"album_id": 1}]},
+             {"name": "a", "album_id": 1}),
+            ({"$or": [{"track_id": 1}, {"track_id": {"$eq": 2}},
+                      {"$or": [{"track_id": {"$in": [3, 1]}}]}]},
+             {"track_id": {"$in": [1, 2, 3]}}),
+            ({"milliseconds": {"$gt": 5, "$gte": 7, "$lte": 100}},
+             {"milliseconds": {"$gte": 7, "$lte": 100}}),
+            ({"$and": [{"milliseconds": {"$gt": 5}},
+                       {"milliseconds": {"$lt": 10}}]},
+             {"milliseconds": {"$gt": 5, "$lt": 10}}),
+            ({"$not": {"$not": {"name": "a"}}}, {"name": "a"}),
+            ({"track_id": {"$in": [1, 1, 2]}, "name": {"$nin": []}},
+             {"track_id": {"$in": [1, 2]}}),
+            ({"$or": [{"track_id": {"$in": []}}, {"name": "a"}]},
+             {"name": "a"}),
+            ({"name": "a", "milliseconds": {"$gt": 5, "$lt": 3}},
+             {"$alwaysFalse": 1}),
+            ({"$nor": [{"track_id": {"$in": []}}]}, {}),
+            # unknown for NULL, so not the same as false when negated.
+            ({"$not": {"milliseconds": {"$gt": 5, "$lt": 3}}},
+             {"$not": {"milliseconds": {"$gt": 5, "$lt": 3}}}),
+            # strings aren't compared as numbers.
+            ({"$and": [{"name": {"$gt": "b"}}, {"name": {"$gt": "a"}}]},
+             {"$and": [{"name": {"$gt": "b"}}, {"name": {"$gt": "a"}}]}),
+            # may match different related records.
+            ({"$and": [{"playlists.playlist_id": {"$gt": 5}},
+                       {"playlists.playlist_id": {"$lt": 3}}]},
+             {"$and": [{"playlists.playlist_id": {"$gt": 5}},
+                       {"playlists.playlist_id": {"$lt": 3}}]}),
+            ({"playlists": {"$elemMatch": {
+                "playlist_id": {"$gt": 5, "$lt": 3}}}},
+             {"$alwaysFalse": 1})
+        ]
+        for filters, expected in cases:
+            self.assertTrue(
+                MqlBuilder.normalize_mql_filters(Track, filters) == expected)
+
+    def test_normalize_results(self):
+        """Test normalized filters match the same records."""
+        class NormalizedBuilder(MqlBuilder):
+            normalize_filters = True
+        filters_list = [
+            {"$or": [{"album_id": 1}, {"album_id": 2},
+                     {"milliseconds": {"$lt": 100000, "$lte": 200000}}]},
+            {"$not": {"composer": {"$gt": 5, "$lt": 3}}},
+            {"$nor": [{"$or": [{"track_id": {"$in": []}},
+                               {"album_id": {"$in": [1, 1]}}]}]},
+            {"$and": [{"milliseconds": {"$gt": 300000}},
+                      {"milliseconds": {"$lt": 400000}},
+                      {"$not": {"$not": {"genre.name": "Metal"}}}]}
+        ]
+        for relation_strategy in ("exists", "join"):
+            for filters in filters_list:
+                stmt = select(Track.track_id).order_by(Track.track_id)
+                expected = self.db_session.execute(
+                    MqlBuilder.apply_mql_filters(
+                        Track, stmt, filters,
+                        relation_strategy=relation_strategy)
+                ).scalars().all()
+                result = self.db_session.execute(
+                    NormalizedBuilder.apply_mql_filters(
+                        Track, stmt, filters,
+                        relation_strategy=relation_strategy)
+                ).scalars().all()
+                self.assertTrue(len(expected) > 0)
+                self.assertTrue(result == expected)
+        stmt = NormalizedBuilder.apply_mql_filters(
+            Track, filters={"track_id": {"$gt": 5, "$lt": 3}})
+        self.assertTrue(self.db_session.execute(stmt).first() is None)
+
+    def test_normalize_repeated_ops(self):
+        """Test conjuncts repeating an op are only merged for numbers."""
+        class NormalizedBuilder(MqlBuilder):
+            normalize_filters = True
+        cases = [
+            ({"$and": [{"milliseconds": {"$gt": 300000}},
+                       {"milliseconds": {"$gt": "5"}}]}, 1069),
+            ({"$and": [{"milliseconds": {"$gt": "5"}},
+                       {"milliseconds": {"$gt": 300000, "$lt": 400000}}]},
+             594),
+            ({"$and": [{"milliseconds": {"$gt": 5}},
+                       {"milliseconds": {"$gt": 300000}}]}, 1069)
+        ]
+        for filters, expected in cases:
+            normalized = NormalizedBuilder.normalize_mql_filters(
+                Track, filters)
+            for builder, value in ((MqlBuilder, filters),
+                                   (MqlBuilder, normalized),
+                                   (NormalizedBuilder, filters)):
+                result = self.db_session.execute(builder.apply_mql_filters(
+                    Track, select(Track.track_id), value)).scalars().all()
+                self.assertTrue(len(result) == expected)
+        self.assertTrue(
+            MqlBuilder.normalize_mql_filters(Track, cases[2][0]) ==
+            {"milliseconds": {"$gt": 300000}})
+
+    def test_normalize_converted_bounds(self):
+        """Test bounds are folded as they're converted for the column."""
+        class NormalizedBuilder(MqlBuilder):
+            normalize_filters = True
+        cases = [
+            ({"track_id": {"$gte": 5.9, "$lte": 5.1}}, 1),
+            ({"track_id": {"$eq": 5, "$gte": 5.5}}, 1),
+            ({"$and": [{"track_id": {"$gt": 4.5}},
+                       {"track_id": {"$lt": 5.5}}]}, 0),
+            ({"unit_price": {"$gte": 5.9, "$lte": 5.1}}, 0)
+        ]
+        for filters, expected in cases:
+            for builder in (MqlBuilder, NormalizedBuilder):
+                result = self.db_session.execute(builder.apply_mql_filters(
+                    Track, select(Track.track_id), filters)).scalars().all()
+                self.assertTrue(len(result) == expected)
+        self.assertTrue(
+            MqlBuilder.normalize_mql_filters(Track, cases[0][0]) ==
+            cases[0][0])
+        self.assertTrue(
+            MqlBuilder.get_mql_filters_constant(Track, cases[1][0]) is None)
+        self.assertTrue(
+            MqlBuilder.get_mql_filters_constant(Track, cases[3][0]) is False)
+
+    def test_constant_ops(self):
+        """Test $alwaysTrue and $alwaysFalse."""
+        for plan_cache in (None, MqlPlanCache()):
+            class Builder(MqlBuilder):
+                pass
+            Builder.plan_cache = plan_cache
+            for filters, expected in (({"$alwaysTrue": 1}, 3503),
+                                      ({"$alwaysFalse": 1}, 0),
+                                      ({"$or": [{"$alwaysFalse": 1},
+                                                {"album_id": 1}]}, 10)):
+                result = self.db_session.execute(Builder.apply_mql_filters(
+                    Track, filters=filters)).scalars().all()
+                self.assertTrue(len(result) == expected)
+        track = self.db_session.get(Track, 1)
+        self.assertTrue(
+            MqlBuilder.compile_predicate(Track, {"$alwaysTrue": 1})(track))
+        self.assertFalse(
+            MqlBuilder.compile_predicate(Track, {"$alwaysFalse": 1})(track))
+        self.assertTrue(
+            MqlBuilder.validate(Track, {"$alwaysFalse": 1}) == [])
+
+    def test_filters_constant(self):
+        """Test filters known to match everything or nothing are found."""
+        cases = [
+            ({"track_id": {"$in": []}}, False),
+            ({"track_id": {"$gt": 5, "$lt": 3}}, False),
+            ({"name": "x", "$not": {"name": "x"}}, False),
+            ({"$and": [{"album_id": 1}, {"$not": {"album_id": 1}}]}, False),
+            ({"track_id": {"$eq": 1, "$ne": 1}}, False),
+            ({"track_id": {"$in": [1, 2], "$nin": [2, 1, 3]}}, False),
+            ({"$or": [{"track_id": {"$in": []}},
+                      {"$alwaysFalse": 1}]}, False),
+            ({}, True),
+            ({"track_id": {"$nin": []}}, True),
+            ({"$nor": [{"track_id": {"$in": []}}]}, True),
+            ({"name": "x"}, None),
+            # unknown, rather than false, when name is NULL.
+            ({"$not": {"name": "x", "$not": {"name": "x"}}}, None),
+            ({"$or": [{"name": "x"}, {"$not": {"name": "x"}}]}, None),
+            (None, None)
+        ]
+        for filters, expected in cases:
+            self.assertTrue(
+                MqlBuilder.get_mql_filters_constant(Track, filters) is
+                expected)
+
+    def test_filters_constant_merged_relations(self):
+        """Test separate relationship groups don't contradict a $not."""
+        class MergedBuilder(MqlBuilder):
+            merge_relation_filters = True
+            normalize_filters = True
+        required = {"tracks.name": "Fast As a Shark",
+                    "tracks.composer": "Deaffy & R.A. Smith-Diesel"}
+        filters = {
+            "$and": [{"tracks.name": required["tracks.name"]},
+                     {"tracks.composer": required["tracks.composer"]}],
+            "$not": required}
+        self.assertTrue(
+            MergedBuilder.get_mql_filters_constant(Album, filters) is None)
+        result = MergedBuilder.execute_mql_filters(
+            self.db_session, Album, filters=filters).all()
+        self.assertTrue([album.album_id for album in result] == [3])
+        # the same group, as a whole, is still a contradiction.
+        filters = {"$and": [required], "$not": required}
+        self.assertTrue(
+            MergedBuilder.get_mql_filters_constant(Album, filters) is False)
+
+    def test_empty_filters_skip_database(self):
+        """Test filters matching nothing don't run a query."""
+        class NormalizedBuilder(MqlBuilder):
+            normalize_filters = True
+        filters = {"milliseconds": {"$gt": 300000, "$lte": 200000}}
+        stmt = NormalizedBuilder.apply_mql_filters(Track, filters=filters)
+        self.assertTrue(
+            stmt.get_execution_options()["mqlalchemy_constant"] is False)
+        self.assertTrue(self.db_session.execute(stmt).first() is None)
+        stmt = NormalizedBuilder.apply_mql_filters(
+            Track, filters={"track_id": {"$nin": []}})
+        self.assertTrue(
+            stmt.get_execution_options()["mqlalchemy_constant"] is True)
+        stmt = NormalizedBuilder.apply_mql_filters(
+            Track, filters={"track_id": 1})
+        self.assertFalse("mqlalchemy_constant" in stmt.get_execution_options())
+        result, statements = self._count_statements(
+            lambda: NormalizedBuilder.execute_mql_filters(
+                self.db_session, Track, filters=filters).all())
+        self.assertTrue(result == [])
+        self.assertTrue(statements == 0)
+        count, statements = self._count_statements(
+            lambda: NormalizedBuilder.count_mql_filters(
+                self.db_session, Track, filters=filters))
+        self.assertTrue(count == 0)
+        self.assertTrue(statements == 0)
+        chunks, statements = self._count_statements(
+            lambda: list(NormalizedBuilder.stream_mql_filters(
+                self.db_session, Track, filters=filters)))
+        self.assertTrue(chunks == [])
+        self.assertTrue(statements == 0)
+        with self.assertRaises(ValueError):
+            list(NormalizedBuilder.stream_mql_filters(
+                self.db_session, Track, filters=filters, columns=["bad"]))
+        # filters are only analyzed when normalized.
+        _, statements = self._count_statements(
+            lambda: MqlBuilder.execute_mql_filters(
+                self.db_session, Track, filters=filters).all())
+        self.assertTrue(statements == 1)
+
+    def test_frame_parser(self):
+        """Test the frame parser matches the default parser."""
+        class FrameBuilder(MqlBuilder):
+            frame_parser = True
+        rng = random.Random(25)
+        fields = ["track_id", "name", "milliseconds", "composer", "nope",
+                  "album", "album.title", "album.artist.name", "album.bad",
+                  "playlists", "playlists.name", "playlists.tracks.name",
+                  "genre.name", "album.tracks.name"]
+        ops = ["$eq", "$ne", "$gt", "$in", "$nin", "$like", "$exists",
+               "$mod", "$elemMatch", "$bad", "$alwaysFalse"]
+        values = [1, 5, 200000, "Rock", None, [1, 2], {}, True, "x"]
+
+        def generate(depth):
+            choice = rng.random()
+            if depth > 0 and choice < 0.4:
+                op = rng.choice(["$and", "$or", "$nor", "$not"])
+                if op == "$not":
+                    return {op: generate(depth - 1)}
+                return {op: [generate(depth - 1)
+                             for i in range(rng.randint(0, 3))]}
+            elif depth > 0 and choice < 0.6:
+                filters = {}
+                for i in range(rng.randint(2, 3)):
+                    filters.update(generate(depth - 1))
+                return filters
+            field = rng.choice(fields)
+            if choice < 0.75:
+                return {field: rng.choice(values)}
+            elif depth > 0 and choice < 0.85:
+                return {field: {"$elemMatch": generate(depth - 1)}}
+            elif depth > 0 and choice < 0.9:
+                return {field: generate(depth - 1)}
+            return {field: {rng.choice(ops): rng.choice(values)}}
+
+        def run(builder, filters, kwargs):
+            try:
+                cost = MqlCost()
+                errors = builder.validate(Track, filters, cost=cost, **kwargs)
+                results = [
+                    (type(error), getattr(error, "code", None),
+                     getattr(error, "data_key", None),
+                     getattr(error, "filters", None)) for error in errors]
+                results.append(cost.cost)
+                results.append(builder.compile_predicate(
+                    Track, filters, **kwargs)(track))
+            except (InvalidMqlException, AttributeError) as exc:
+                results = [type(exc), str(exc)]
+            for relation_strategy in ("exists", "join", "semi_join_in"):
+                try:
+                    compiled = builder.apply_mql_filters(
+                        Track, filters=filters,
+                        relation_strategy=relation_strategy,
+                        **kwargs).compile()
+                    results.append((str(compiled), compiled.params))
+                except (InvalidMqlException, AttributeError) as exc:
+                    results.append((type(exc), str(exc)))
+            return results
+        track = self.db_session.get(Track, 1)
+        for merge_relation_filters in (False, True):
+            MqlBuilder.merge_relation_filters = merge_relation_filters
+            try:
+                for i in range(100):
+                    filters = generate(3)
+                    kwargs = {}
+                    if rng.random() < 0.3:
+                        kwargs["stack_size_limit"] = rng.randint(1, 10)
+                    if rng.random() < 0.3:
+                        kwargs["whitelist"] = rng.sample(fields, 6)
+                    self.assertTrue(
+                        run(MqlBuilder, filters, kwargs) ==
+                        run(FrameBuilder, filters, kwargs))
+            finally:
+                MqlBuilder.merge_relation_filters = False
+        # strings can't be mistaken for the default parser's markers.
+        filters = {"playlists": {"$elemMatch": "POP_query_tree_stack"},
+                   "name": "Balls to the Wall"}
+        result = self.db_session.execute(FrameBuilder.apply_mql_filters(
+            Track, filters=filters)).scalars().all()
+        self.assertTrue(len(result) == 1)
+
+
+class FrameParserTests(MQLAlchemyTests):
+
+    """Runs the MQLAlchemy tests using the frame parser."""
+
+    def setUp(self):
+        """Use the frame parser by default."""
+        super(FrameParserTests, self).setUp()
+        MqlBuilder.frame_parser = True
+
+    def tearDown(self):
+        """Restore the default parser."""
+        MqlBuilder.frame_parser = False
+        super(FrameParserTests, self).tearDown()
+
 
 if __name__ == '__main__':    # pragma no cover
     unittest.main()